@@ -0,0 +1,139 @@
+"""Times the make / build pipeline on a synthetic corpus against a stub Spotlight / SPARQL server.
+
+Usage: python -m benchmarks.run [--speeches 1000] [--latency-ms 0] [--neo4j [--neo4j-database unscnebenchmark]]
+                                [--save-baseline]
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Optional
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+BASELINES = Path(REPO_ROOT, "benchmarks", "baselines")
+# --neo4j clears the database it loads into, so it gets one of its own
+BENCHMARK_DATABASE = "unscnebenchmark"
+sys.path.insert(0, str(REPO_ROOT))
+
+from benchmarks.stub_server import start_stub_server
+from benchmarks.synthetic import generate_corpus
+
+
+@contextmanager
+def timed(timings, name):
+    print(f"[BENCH] {name}..")
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[name] = round(time.perf_counter() - started, 3)
+        print(f"[BENCH] {name}: {timings[name]} s")
+
+
+def point_endpoints_at(base_url):
+    # the pipeline modules import their endpoints from config by name, so they are overridden where they are used
+    from unscne import ner
+    from unscne.client import register_budget
+    # the stub matches none of HTTP_BUDGETS, the default budget would make the timings measure its rate limit
+    register_budget("benchmark_stub", base_url, rate=100000, burst=100000, initial_concurrency=32,
+                    max_concurrency=32, max_retries=0, deadline=600)
+    ner.URL_TO_DBPEDIA_SERVICE = f"{base_url}/rest/annotate"
+    ner.URL_TO_DBPEDIA_ENDPOINT = f"{base_url}/sparql"
+    ner.WD_SPARQL_ENDPOINT = f"{base_url}/sparql"
+    ner.WD_GFS_ENDPOINT = f"{base_url}/"
+
+
+def run_pipeline(neo4j_database: Optional[str]):
+    import config
+    from unscne import load_meta, ner
+    from unscne.util import load_tsv
+
+    timings = {}
+    Path("needs_annotation").mkdir(exist_ok=True)
+    with timed(timings, "parse"):
+        load_meta.parse_corpus()
+    with timed(timings, "annotate"):
+        ner.make_dbpedia_dump()
+    with timed(timings, "inject_sids"):
+        load_meta.inject_sids_from_pids(config.DBPEDIA_NERS)
+    uris = sorted({row["uri"] for row in load_tsv(config.DBPEDIA_NERS)})
+    with timed(timings, "link_wikidata"):
+        ner.make_dbpedia_to_wikidata_dump(uris, config.DBPEDIA_TO_WIKIDATA)
+    if neo4j_database is not None:
+        # LOAD CSV resolves file:/// against the server's import directory, which has to point at the workspace
+        from unscne.graph import connect_graph
+        graph = connect_graph(neo4j_database)
+        graph.clear()
+        with timed(timings, "graph_schema"):
+            graph.create_indices_and_constraints()
+        with timed(timings, "graph_meta"):
+            load_meta.load_metadata_into_graph(graph)
+        with timed(timings, "graph_sentences"):
+            load_meta.load_sentences_into_graph(graph)
+        with timed(timings, "graph_speakers"):
+            load_meta.add_speech_meta_to_nodes(graph)
+        with timed(timings, "graph_mentions"):
+            ner.write_dbpedia_annotations_to_graph(graph)
+        graph.close()
+    return timings
+
+
+def compare_to_baseline(result, baseline_path):
+    if not baseline_path.is_file():
+        print(f"[BENCH] No baseline at {baseline_path}, use --save-baseline to record one.")
+        return
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = json.load(f)
+    print(f"{'stage':20} {'baseline (s)':>12} {'now (s)':>10} {'change':>8}")
+    for name, seconds in result["timings"].items():
+        before = baseline["timings"].get(name)
+        change = f"{(seconds - before) / before:+.0%}" if before else "n/a"
+        print(f"{name:20} {before if before is not None else '-':>12} {seconds:>10} {change:>8}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--speeches", type=int, default=1000, help="number of synthetic speeches (1k to 100k)")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="latency of every stub response")
+    parser.add_argument("--neo4j", action="store_true", help="also time loading into neo4j")
+    parser.add_argument("--neo4j-database", default=BENCHMARK_DATABASE,
+                        help="database the benchmark wipes and loads into, never the one of config.py")
+    parser.add_argument("--workspace", help="folder to generate the corpus in, a temporary one by default")
+    parser.add_argument("--save-baseline", action="store_true")
+    args = parser.parse_args()
+    import config
+    if args.neo4j and args.neo4j_database == config.NEO4J_DATABASE_NAME:
+        parser.error(f"--neo4j-database must not be {config.NEO4J_DATABASE_NAME}, the benchmark wipes it")
+
+    workspace = Path(args.workspace or tempfile.mkdtemp(prefix="unscne_bench_")).resolve()
+    print(f"[BENCH] Generating {args.speeches} speeches in {workspace}..")
+    corpus = generate_corpus(str(workspace), args.speeches, args.seed)
+    server, base_url = start_stub_server(args.latency_ms)
+    # config paths are relative to the working directory
+    os.chdir(workspace)
+    point_endpoints_at(base_url)
+    try:
+        timings = run_pipeline(args.neo4j_database if args.neo4j else None)
+    finally:
+        server.shutdown()
+    result = {"corpus": corpus, "latency_ms": args.latency_ms, "neo4j": args.neo4j, "timings": timings,
+              "python": platform.python_version(), "machine": platform.machine()}
+    print(json.dumps(result, indent=2))
+    baseline_path = Path(BASELINES, f"speeches_{args.speeches}_latency_{args.latency_ms:g}.json")
+    if args.save_baseline:
+        BASELINES.mkdir(parents=True, exist_ok=True)
+        with open(baseline_path, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=2, sort_keys=True)
+        print(f"[BENCH] Saved baseline to {baseline_path}")
+    else:
+        compare_to_baseline(result, baseline_path)
+
+
+if __name__ == "__main__":
+    main()
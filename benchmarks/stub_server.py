@@ -0,0 +1,94 @@
+import json
+import re
+import threading
+import time
+import zlib
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Tuple
+from urllib.parse import urlparse, parse_qs, quote
+
+from benchmarks.synthetic import SURFACE_FORMS
+
+SURFACE_FORM_PATTERN = re.compile("|".join(re.escape(form) for form in sorted(SURFACE_FORMS, key=len, reverse=True)))
+IRI_PATTERN = re.compile(r"<(http[^>]+)>")
+
+
+def dbpedia_uri(surface_form: str) -> str:
+    return f"http://dbpedia.org/resource/{quote(surface_form.replace(' ', '_'))}"
+
+
+def wikidata_uri(uri: str) -> str:
+    return f"http://www.wikidata.org/entity/Q{zlib.crc32(uri.encode('utf-8')) % 10 ** 7}"
+
+
+def annotate(text: str):
+    resources = []
+    for match in SURFACE_FORM_PATTERN.finditer(text):
+        resources.append({"@URI": dbpedia_uri(match.group(0)), "@support": "1234", "@types": "",
+                          "@surfaceForm": match.group(0), "@offset": str(match.start()),
+                          "@similarityScore": "0.99", "@percentageOfSecondRank": "0.01"})
+    result = {"@text": text, "@confidence": "0.5"}
+    if resources:
+        result["Resources"] = resources
+    return result
+
+
+def sparql(query: str):
+    # skip PREFIX declarations, which end in a separator
+    iris = [iri for iri in IRI_PATTERN.findall(query) if not iri.endswith(("/", "#"))]
+    if "owl:sameAs" in query:
+        # every tenth resource has two Wikidata equivalents, so the linking also writes ambiguous links
+        same_as = [wikidata_uri(iri) for iri in iris[:1]]
+        same_as += [wikidata_uri(iri + "#alt") for iri in iris[:1] if zlib.crc32(iri.encode("utf-8")) % 10 == 0]
+        bindings = [{"sameAs": {"type": "uri", "value": uri}} for uri in same_as]
+    elif "wd:P31" in query:
+        bindings = [{"instance": {"value": iri}, "class": {"value": wikidata_uri(iri + "#class")}} for iri in iris]
+    elif "wd:P279" in query:
+        bindings = [{"class": {"value": iri}, "superclass": {"value": wikidata_uri(iri + "#super")}} for iri in iris]
+    else:
+        bindings = [{"uri": {"value": iri}, "uriLabel": {"value": iri.rsplit("/", 1)[-1]}} for iri in iris]
+    return {"head": {"vars": []}, "results": {"bindings": bindings}}
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    latency = 0.0
+
+    def _params(self):
+        params = parse_qs(urlparse(self.path).query)
+        if self.command == "POST":
+            length = int(self.headers.get("Content-Length", 0))
+            params.update(parse_qs(self.rfile.read(length).decode("utf-8")))
+        return {key: values[0] for key, values in params.items()}
+
+    def _respond(self):
+        time.sleep(self.latency)
+        path = urlparse(self.path).path
+        params = self._params()
+        if path.endswith("/rest/annotate"):
+            body = annotate(params.get("text", ""))
+        elif path.endswith("/sparql"):
+            body = sparql(params.get("query", ""))
+        else:
+            # global.dbpedia.org lookup
+            body = {"locals": []}
+        encoded = json.dumps(body).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(encoded)))
+        self.end_headers()
+        self.wfile.write(encoded)
+
+    do_GET = _respond
+    do_POST = _respond
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stub_server(latency_ms: float = 0.0, port: int = 0) -> Tuple[ThreadingHTTPServer, str]:
+    """Starts a server imitating Spotlight's /rest/annotate and SPARQL JSON endpoints, returns it and its base url."""
+    handler = type("ConfiguredStubHandler", (StubHandler,), {"latency": latency_ms / 1000})
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
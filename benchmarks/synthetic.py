@@ -0,0 +1,82 @@
+import csv
+import random
+from pathlib import Path
+from typing import Dict, List
+
+COUNTRIES = ["France", "China", "Russian Federation", "United Kingdom", "United States", "Germany", "Brazil",
+             "Syria", "Iraq", "Afghanistan", "Sudan", "Somalia", "Libya", "Mali", "Ukraine", "Lebanon", "Israel",
+             "Egypt", "Japan", "India", "Pakistan", "Nigeria", "Kenya", "Colombia", "Haiti", "Yemen", "Iran"]
+CONCEPTS = ["United Nations", "Security Council", "General Assembly", "peacekeeping", "humanitarian assistance",
+            "ceasefire", "sanctions", "human rights", "terrorism", "refugees", "nuclear weapons", "African Union",
+            "European Union", "International Criminal Court", "climate change", "children in armed conflict"]
+FILLER = ["we", "welcome", "the", "report", "of", "and", "call", "upon", "all", "parties", "to", "ensure", "that",
+          "situation", "in", "remains", "deeply", "concerning", "delegation", "supports", "efforts", "by",
+          "resolution", "implementation", "process", "political", "stability", "region", "commend", "work"]
+AGENDA_ITEMS = ["The situation in the Middle East", "Threats to international peace and security",
+                "Protection of civilians in armed conflict", "Women and peace and security", "Reports of the "
+                "Secretary-General on the Sudan and South Sudan", "The situation in Afghanistan", "Non-proliferation"]
+PARTICIPANT_TYPES = ["Mentioned", "The President", "Guest"]
+ROLES = ["Permanent member", "Elected member", "Non-member"]
+
+SURFACE_FORMS = COUNTRIES + CONCEPTS
+
+
+def make_sentence(rng: random.Random) -> str:
+    words = [rng.choice(FILLER) for _ in range(rng.randint(8, 24))]
+    for _ in range(rng.randint(0, 3)):
+        words.insert(rng.randrange(len(words)), rng.choice(SURFACE_FORMS))
+    sentence = " ".join(words)
+    return sentence[0].upper() + sentence[1:] + "."
+
+
+def make_speech(rng: random.Random, country: str) -> str:
+    paragraphs = []
+    for _ in range(rng.randint(2, 8)):
+        # sentences end with a full stop and paragraphs are split on `.` followed by blank lines
+        paragraphs.append(" ".join(make_sentence(rng) for _ in range(rng.randint(1, 6)))[:-1])
+    return f"Mr. Speaker ({country}) (spoke in French): " + ".\n\n".join(paragraphs) + ".\n"
+
+
+def generate_corpus(target: str, number_of_speeches: int, seed: int = 42, speeches_per_meeting: int = 15) -> Dict:
+    """Writes speeches, speaker.tsv and meta.tsv in the layout of the UNSC debates corpus below `target`."""
+    rng = random.Random(seed)
+    data = Path(target, "data")
+    speeches = Path(data, "speeches")
+    speeches.mkdir(parents=True, exist_ok=True)
+    speaker_rows: List[Dict[str, str]] = []
+    meta_rows: List[Dict[str, str]] = []
+    characters = 0
+    meeting = 0
+    written = 0
+    while written < number_of_speeches:
+        meeting += 1
+        year = 1995 + meeting % 26
+        month, day = rng.randint(1, 12), rng.randint(1, 28)
+        basename = f"UNSC_{year}_SPV.{4000 + meeting}"
+        num_speeches = min(speeches_per_meeting, number_of_speeches - written)
+        agenda = rng.sample(AGENDA_ITEMS, 3)
+        meta_rows.append({"basename": basename, "date": f"{year}-{month:02d}-{day:02d}",
+                          "num_speeches": str(num_speeches), "topic": agenda[0], "pressrelease": "",
+                          "outcome": "", "year": str(year), "month": str(month), "day": str(day)})
+        for index in range(1, num_speeches + 1):
+            country = rng.choice(COUNTRIES)
+            filename = f"{basename}_spch{index:03d}.txt"
+            text = make_speech(rng, country)
+            characters += len(text)
+            with open(Path(speeches, filename), "w", encoding="utf-8") as f:
+                f.write(text)
+            speaker_rows.append({"filename": filename, "speaker": f"Speaker {rng.randint(1, 500)}",
+                                 "participanttype": rng.choice(PARTICIPANT_TYPES), "role_in_un": rng.choice(ROLES),
+                                 "country": country, "agenda_item1": agenda[0], "agenda_item2": agenda[1],
+                                 "agenda_item3": agenda[2]})
+            written += 1
+    _write_tsv(Path(data, "speaker.tsv"), speaker_rows)
+    _write_tsv(Path(data, "meta.tsv"), meta_rows)
+    return {"speeches": written, "meetings": meeting, "characters": characters, "seed": seed}
+
+
+def _write_tsv(path, rows):
+    with open(path, "w", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, list(rows[0].keys()), delimiter="\t")
+        writer.writeheader()
+        writer.writerows(rows)
@@ -15,16 +15,119 @@ SPEECHES_FOLDER = "data/speeches/"
 PARAGRAPHS_PATH = "data/paragraphs/"
 PARSED_DATA = "data/main.tsv"
 PARAGRAPH_META = "data/paragraph_meta.tsv"
+# integer uids of speeches, paragraphs and sentences
+ID_MAP = "data/id_map.tsv"
 WD_LABELS = "data/labels_wd.tsv"
 WD_HIERARCHY = "data/hierarchy_wd.tsv"
+# incremental builds
+MANIFEST_FOLDER = "data/manifests/"
+DELTA_FOLDER = "data/delta/"
+# `make.py pipeline` parses and annotates at the same time, keeping its checkpoints here until it finishes
+PIPELINE_FOLDER = "data/pipeline/"
+# parsed speeches waiting for annotation
+PIPELINE_QUEUE_SIZE = 32
+PIPELINE_ANNOTATORS = 4
+# parsed speeches are only checkpointed together with the id map, which is rewritten every this many speeches
+PIPELINE_CHECKPOINT_EVERY = 100
+# `serve.py` ingests single speeches posted to http://INGEST_HOST:INGEST_PORT/speeches or dropped as JSON files into
+# INGEST_INBOX, which are moved to done/ or failed/ in there afterwards
+INGEST_HOST = "127.0.0.1"
+INGEST_PORT = 8765
+INGEST_INBOX = "data/inbox/"
+INGEST_POLL_SECONDS = 1
+INGEST_WORKERS = 4
+# speeches accepted on top of the ones being worked on, the http endpoint answers 503 beyond that
+INGEST_BACKLOG = 32
+# seconds a request waits for its speech to be ingested before it is answered with 202
+INGEST_WAIT_SECONDS = 60
+# finished speeches whose status can still be requested
+INGEST_JOB_HISTORY = 1000
+# stage scheduling
+CHECKPOINTS = "data/checkpoints.tsv"
+MAX_PARALLEL_STAGES = 3
+# per run metrics reports
+REPORTS_FOLDER = "data/reports/"
+# set to "EXPLAIN" or "PROFILE" to capture the plan of every build statement into the run report,
+# PROFILE runs every statement that can be sampled on its first PROFILE_SAMPLE_ROWS rows, read from LOAD CSV or by
+# the clauses before its first write, and rolls it back. The others, e.g. batched deletes, are only explained
+NEO4J_PROFILE_MODE = None
+PROFILE_SAMPLE_ROWS = 1000
 # dbpedia
 URL_TO_DBPEDIA_SERVICE = "http://192.168.178.28:2222/rest/annotate"
 URL_TO_DBPEDIA_ENDPOINT = "https://dbpedia.org/sparql"
+# paragraphs are joined into requests of up to this many characters, 0 sends one request per paragraph
+SPOTLIGHT_BATCH_CHARACTERS = 10000
+# the first batches are also annotated paragraph by paragraph to check that batching does not change results
+SPOTLIGHT_BATCH_VERIFICATION_SAMPLE = 20
+SPOTLIGHT_BATCH_MIN_AGREEMENT = 0.95
+# outcome (ok / empty / failed) of every annotated paragraph, and the failed ones for `make.py retry-failed`
+ANNOTATION_STATUS = "data/annotation_status.tsv"
+ANNOTATION_DEAD_LETTER = "data/dead_letter.tsv"
+SPOTLIGHT_RETRY_WORKERS = 4
+# filters applied to the Spotlight mentions of ners.tsv when they are written to the graph, the file itself stays
+# unfiltered. 0 disables a filter. Top-k keeps the k best scored mentions per sentence
+MENTION_MIN_SCORE = 0.0
+MENTION_MIN_SUPPORT = 0
+MENTION_TOP_K = 0
+# surface forms to drop, one per line and compared case insensitively, ignored if the file does not exist
+MENTION_STOPLIST = "data/mention_stoplist.txt"
+# compressed sentence text store, keyed by s_uid
+TEXT_STORE = "data/text/"
+TEXT_STORE_CHUNK_SIZE = 512
+TEXT_STORE_CACHE_CHUNKS = 64
+# keep only the first TEXT_PREVIEW_CHARACTERS characters of each sentence in neo4j and read the text from the store
+COMPACT_TEXT = False
+TEXT_PREVIEW_CHARACTERS = 80
+# sparse mention matrices for analytics
+ANALYTICS_FOLDER = "data/analytics/"
+# spacy
+SPACY_ENTITIES = "data/spacy_entities.tsv"
+SPACY_SENTIMENT = "data/spacy_sentiment.tsv"
+SPACY_BATCH_SIZE = 256
+SPACY_PROCESSES = 4
 # wikidata
 WD_SPARQL_ENDPOINT = "https://query.wikidata.org/sparql"
 WD_GFS_ENDPOINT = "https://global.dbpedia.org/"
+# request budgets shared by everything calling an endpoint, matched by url prefix:
+# rate / burst feed a token bucket, concurrency adapts between its bounds (halved on 429 / 503),
+# failure_threshold consecutive failures open the circuit for cooldown seconds, after which a single probe request
+# decides whether it closes again,
+# deadline bounds the total seconds a request may take including its retries
+HTTP_BUDGETS = {
+    "spotlight": {"url": URL_TO_DBPEDIA_SERVICE, "rate": 50, "burst": 50, "initial_concurrency": 8,
+                  "max_concurrency": 32, "max_retries": 5, "deadline": 120},
+    "dbpedia": {"url": URL_TO_DBPEDIA_ENDPOINT, "rate": 5, "burst": 10, "initial_concurrency": 2,
+                "max_concurrency": 8, "max_retries": 8, "deadline": 600},
+    "dbpedia_global": {"url": WD_GFS_ENDPOINT, "rate": 5, "burst": 10, "initial_concurrency": 2,
+                       "max_concurrency": 8, "max_retries": 8, "deadline": 600},
+    "wikidata": {"url": WD_SPARQL_ENDPOINT, "rate": 2, "burst": 5, "initial_concurrency": 1,
+                 "max_concurrency": 5, "max_retries": 8, "deadline": 900},
+}
+HTTP_DEFAULT_BUDGET = {"rate": 10, "burst": 10}
 # neo4j settings
 NEO4J_BOLT_URL = "bolt://localhost:7687"
 NEO4J_USER = "neo4j"
 NEO4J_PASSWORD = "12345"
 NEO4J_DATABASE_NAME = "unscne"
+# number of records pulled per round trip when streaming query results
+NEO4J_FETCH_SIZE = 1000
+# rows per inner transaction when wiping the database in batches
+WIPE_BATCH_SIZE = 10000
+# rows per transaction when writing UNWIND batches
+WRITE_BATCH_SIZE = 5000
+# concurrent writers of DBpedia MENTIONS, each one owns the sentences hashed to it
+MENTION_WRITERS = 4
+# "csv" lets the server LOAD CSV the intermediates from its import directory, which has to mirror data/,
+# "bolt" streams the rows from the local files as parameters, for servers without access to them
+NEO4J_LOADER = "csv"
+BOLT_WRITERS = 4
+# seconds to wait for new indexes to be populated
+NEO4J_INDEX_TIMEOUT = 3600
+# run the Wikidata enrichment of finalize.py as an asyncio pipeline, which reads URIs, queries Wikidata and writes
+# the results to the graph at the same time. Needs the async API of the neo4j driver (>= 4.4)
+ASYNC_ENRICHMENT = False
+# SPARQL requests in flight, the Wikidata budget in HTTP_BUDGETS still applies on top
+ENRICHMENT_WORKERS = 4
+# batches waiting between the pipeline steps
+ENRICHMENT_QUEUE_SIZE = 8
+ENRICHMENT_WRITE_BATCH_SIZE = 1000
@@ -1,15 +1,14 @@
 import sys
 
 from unscne.graph import connect_graph
-from unscne.ner import link_dbpedia_with_wikidata, get_classes_for_wd, get_class_hierarchy_for_wd, get_label_for_wd
+from unscne.metrics import write_report_at_exit
+from unscne.pipeline import finalize_stages
+from unscne.stages import StageScheduler
 
 graph = connect_graph()
+write_report_at_exit("finalize")
 force = False
 if "-force" in sys.argv:
     force = True
 
-link_dbpedia_with_wikidata(graph, force)
-get_classes_for_wd(graph)
-
-get_class_hierarchy_for_wd(graph)
-get_label_for_wd(graph)
+StageScheduler(graph, finalize_stages(graph, force)).run(force="-rerun" in sys.argv)
@@ -3,62 +3,28 @@ import sys
 import tarfile
 from pathlib import Path
 
-from tqdm import tqdm
-
-from config import PARSED_DATA, PARAGRAPH_META, SPEECHES_FOLDER, PARAGRAPHS_PATH, CORPUS_TAR
-from unscne.load_meta import split_speech_into_paragraphs, split_into_sentences
-from unscne.ner import make_dbpedia_dump
-from unscne.util import get_number_of_files_in_path, remove_initial_stub, load_file, dump_tsv, log, LogLevel, write_to_path, \
-    required_files_are_present
+from config import SPEECHES_FOLDER, CORPUS_TAR, COMPACT_TEXT
+from unscne.analytics import build_mention_matrices
+from unscne.ids import add_uids_to_parsed_data
+from unscne.incremental import commit_stage, compute_fingerprints, invalidate_annotations, update_parsed_data, \
+    record_baseline
+from unscne.load_meta import parse_corpus, add_positions_to_parsed_data
+from unscne.metrics import write_report_at_exit
+from unscne.ner import make_dbpedia_dump, retry_failed_annotations
+from unscne.spacy_ner import annotate_sentences_with_spacy
+from unscne.streaming import run_pipeline
+from unscne.textstore import build_text_store
+from unscne.util import log, LogLevel, required_files_are_present, timer
 
 if not Path("needs_annotation").exists():
     Path("needs_annotation").mkdir()
 
+@timer
 def main():
-    path_to_speeches, path_to_paragraphs, meta_dump_path = SPEECHES_FOLDER, PARAGRAPHS_PATH, PARSED_DATA
-    log("Splitting speeches into paragraphs, sentences and removing clutter.")
-    Path(path_to_paragraphs).mkdir(parents=True, exist_ok=True)
-    indices = []
-    paragraph_stuff = []
-    with os.scandir(path_to_speeches) as root_dir:
-        total = get_number_of_files_in_path(path_to_speeches)
-        if total == 0:
-            log(f"No files in {path_to_speeches}!", LogLevel.WARNING)
-        for path in tqdm(root_dir, total=total):
-            if path.is_file():
-                speech_name = ".".join(path.name.split(".")[:-1])
-
-                basename = "_".join(speech_name.split("_")[:-1])
-                raw_speech = remove_initial_stub(load_file(path))
-                for p_index, paragraph in enumerate(split_speech_into_paragraphs(raw_speech)):
-                    paragraph_folder = Path(path_to_paragraphs, f"{speech_name}")
-                    paragraph_folder.mkdir(parents=True, exist_ok=True)
-
-                    paragraph_id = Path(paragraph_folder, f"{p_index}")
-                    paragraph_path = Path(paragraph_folder, f"{p_index}.txt")
-                    clean_paragraph = []
-
-                    for s_index, sentence in enumerate(split_into_sentences(paragraph)):
-                        sentence = sentence.strip().replace("\t", " ")
-                        if len(sentence.strip()):
-                            clean_paragraph.append(sentence)
-                            s_id = f"{paragraph_id}_{s_index}"
-                            indices.append({
-                                "speech_name": speech_name,
-                                "speech_basename": basename,
-                                "paragraph_path": paragraph_path,
-                                "p_index": p_index,
-                                "s_index": s_index,
-                                "s_id": s_id,
-                                "p_id": paragraph_id,
-                                "text": sentence,
-                                "filename": path.name}
-                            )
-
-                    write_to_path("\n".join(clean_paragraph), paragraph_path)
-                    paragraph_stuff.append({"p_id": paragraph_id, "paragraph_path": paragraph_path})
-    dump_tsv(meta_dump_path, indices, list(indices[0].keys()))
-    dump_tsv(PARAGRAPH_META, paragraph_stuff)
+    parse_corpus()
+    commit_stage("parse", compute_fingerprints())
+    if COMPACT_TEXT:
+        build_text_store()
 
 
 def count_number_of_files_in_path(path: str) -> int:
@@ -79,10 +45,41 @@ def unpack_speeches():
         log("Done")
 
 
+@timer
+def annotate():
+    fingerprints = invalidate_annotations()
+    make_dbpedia_dump()
+    commit_stage("annotate", fingerprints)
+
+
+@timer
+def pipeline():
+    run_pipeline()
+    if COMPACT_TEXT:
+        build_text_store()
+
+
+@timer
+def update():
+    update_parsed_data()
+    if COMPACT_TEXT:
+        build_text_store()
+    annotate()
+
+
 function_map = {
     "setup": unpack_speeches,
     "parse": main,
-    "annotate": make_dbpedia_dump
+    "annotate": annotate,
+    "pipeline": pipeline,
+    "retry-failed": retry_failed_annotations,
+    "spacy": annotate_sentences_with_spacy,
+    "analytics": build_mention_matrices,
+    "textstore": build_text_store,
+    "ids": add_uids_to_parsed_data,
+    "positions": add_positions_to_parsed_data,
+    "update": update,
+    "baseline": record_baseline
 }
 
 if not required_files_are_present():
@@ -90,6 +87,7 @@ if not required_files_are_present():
     log(f"Unpack recent dataset into data/ folder.\nShould be available at {url_to_download_folder}", LogLevel.ERROR)
     sys.exit(1)
 
+write_report_at_exit("make")
 
 unknown = set()
 if len(sys.argv) > 1:
@@ -106,4 +104,5 @@ if len(sys.argv) > 1:
 else:
     unpack_speeches()
     main()
-    make_dbpedia_dump()
+    annotate()
+    annotate_sentences_with_spacy()
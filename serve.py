@@ -0,0 +1,38 @@
+import sys
+import threading
+import time
+
+from unscne.graph import connect_graph
+from unscne.ingest import Ingestor, serve_http, watch_inbox
+from unscne.metrics import write_report_at_exit
+from unscne.util import log, LogLevel
+
+function_map = {
+    "http": serve_http,
+    "watch": watch_inbox
+}
+
+commands = sys.argv[1:] or list(function_map.keys())
+unknown = [arg for arg in commands if arg not in function_map.keys()]
+if len(unknown) >= 1:
+    log(
+        f"Available commands: {', '.join(function_map.keys())}\n{len(unknown)} unknown command(s): {', '.join(unknown)}",
+        LogLevel.WARNING)
+    sys.exit(1)
+
+graph = connect_graph()
+write_report_at_exit("serve")
+ingestor = Ingestor(graph)
+threads = [threading.Thread(target=function_map[command], args=(ingestor,), name=command, daemon=True)
+           for command in commands]
+for thread in threads:
+    thread.start()
+try:
+    # a failing listener, e.g. on a port in use, stops the service
+    while all(thread.is_alive() for thread in threads):
+        time.sleep(1)
+except KeyboardInterrupt:
+    log("Stopping, waiting for the speeches in progress..")
+finally:
+    ingestor.close()
+    graph.close()
@@ -0,0 +1,112 @@
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+import numpy as np
+from scipy import sparse
+
+from config import COUNTRY_MAPPING
+from unscne.analytics import MentionMatrix, build_mention_matrices, COUNTRY_WDCONCEPT, YEAR_DBCONCEPT
+from unscne.graph import HelloWorldExample
+from unscne.util import timer, log, LogLevel, load_tsv
+
+MENTIONED_QUERY = """
+UNWIND $rows AS row
+MATCH (a:Institution {name: row.source})
+MERGE (b:Institution {name: row.target})
+SET b:Country
+MERGE (a)-[r:MENTIONED]->(b)
+SET r.weight = row.weight
+"""
+
+FREQ_QUERY = """
+UNWIND $rows AS row
+MATCH (c:DBConcept {uri: row.uri})
+MERGE (y:Year {year: row.year})
+MERGE (c)-[f:FREQ]->(y)
+SET f.year = row.year, f.count = row.count
+"""
+
+
+def _nonzero(mention_matrix: MentionMatrix, rows: Optional[Set[str]] = None):
+    coo = mention_matrix.matrix.tocoo()
+    for i, j, value in zip(coo.row, coo.col, coo.data):
+        row = mention_matrix.rows[i]
+        if rows is None or row in rows:
+            yield row, mention_matrix.columns[j], int(value)
+
+
+def compute_country_mentions(country_concept: MentionMatrix) -> MentionMatrix:
+    """Folds the WDConcept columns that stand for countries into one column per country."""
+    countries = {line["uri"]: line["Country"] for line in load_tsv(COUNTRY_MAPPING, delimiter=";")}
+    targets = sorted(set(countries.values()))
+    target_index = {name: i for i, name in enumerate(targets)}
+    linked = [(j, target_index[countries[uri]]) for j, uri in enumerate(country_concept.columns) if uri in countries]
+    columns, codes = zip(*linked) if linked else ((), ())
+    fold = sparse.csr_matrix((np.ones(len(codes), dtype=np.int32), (columns, codes)),
+                             shape=(len(country_concept.columns), len(targets)))
+    return MentionMatrix((country_concept.matrix @ fold).tocsr(), country_concept.rows, targets)
+
+
+def make_mention_rows(country_mentions: MentionMatrix, sources: Optional[Set[str]] = None) -> List[Dict]:
+    return [{"source": source, "target": target, "weight": weight}
+            for source, target, weight in _nonzero(country_mentions, sources)]
+
+
+def make_frequency_rows(year_concept: MentionMatrix, years: Optional[Set[str]] = None) -> List[Dict]:
+    return [{"uri": uri, "year": int(year), "count": count} for year, uri, count in _nonzero(year_concept, years)]
+
+
+def _delete_aggregates(graph: HelloWorldExample, sources: Optional[Set[str]], years: Optional[Set[str]]):
+    if sources is None:
+        graph.execute_query_without_transaction("""
+        MATCH ()-[r:MENTIONED]->()
+        CALL { WITH r DELETE r } IN TRANSACTIONS""")
+    elif sources:
+        graph.execute_query("MATCH (a:Institution)-[r:MENTIONED]->() WHERE a.name IN $sources DELETE r",
+                            {"sources": sorted(sources)})
+    if years is None:
+        graph.execute_query_without_transaction("""
+        MATCH ()-[f:FREQ]->(:Year)
+        CALL { WITH f DELETE f } IN TRANSACTIONS""")
+    elif years:
+        graph.execute_query_without_transaction("""
+        MATCH ()-[f:FREQ]->(y:Year) WHERE y.year IN $years
+        CALL { WITH f DELETE f } IN TRANSACTIONS""", {"years": sorted(int(year) for year in years)})
+
+
+@timer
+def write_aggregates(graph: HelloWorldExample, sources: Optional[Iterable[str]] = None,
+                     years: Optional[Iterable[str]] = None):
+    """Writes MENTIONED weights between countries and per year FREQ counts of DBConcepts, optionally only for the
+    given source institutions and years."""
+    sources = None if sources is None else set(sources)
+    years = None if years is None else set(years)
+    if not Path(COUNTRY_MAPPING).is_file():
+        log(f"{COUNTRY_MAPPING} does not exist, run the country stage first.", LogLevel.WARNING)
+        return
+    matrices = build_mention_matrices()
+    mentions = make_mention_rows(compute_country_mentions(matrices[COUNTRY_WDCONCEPT]), sources)
+    frequencies = make_frequency_rows(matrices[YEAR_DBCONCEPT], years)
+    log(f"Writing {len(mentions)} MENTIONED and {len(frequencies)} FREQ relationships..")
+    _delete_aggregates(graph, sources, years)
+    graph.write_batches(MENTIONED_QUERY, mentions, desc="MENTIONED")
+    graph.write_batches(FREQ_QUERY, frequencies, desc="FREQ")
+    log("Done.")
+
+
+def get_aggregate_keys(graph: HelloWorldExample, speeches: Iterable[str]) -> Tuple[Set[str], Set[str]]:
+    """Returns the institutions and years whose aggregates depend on the given speeches."""
+    query = """
+    UNWIND $speeches AS name
+    MATCH (sp:Speech {id: name})
+    OPTIONAL MATCH (sp)<-[:SPOKE]-(:Speaker)-[:REPRESENTS]->(i:Institution)
+    OPTIONAL MATCH (sp)-[:HAS_METADATA]->(m:Meta)
+    RETURN i.name, toString(m.year)
+    """
+    sources, years = set(), set()
+    for source, year in graph.stream(query, {"speeches": sorted(speeches)}, as_tuples=True):
+        if source is not None:
+            sources.add(source)
+        if year is not None:
+            years.add(year)
+    return sources, years
@@ -0,0 +1,195 @@
+import csv
+from pathlib import Path
+from typing import Dict, List, NamedTuple
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from config import DBPEDIA_NERS, PARSED_DATA, SPEAKER, META, DBPEDIA_TO_WIKIDATA, DBPEDIA_TO_WIKIDATA_INTERNAL, \
+    ANALYTICS_FOLDER
+from unscne.mention_filters import MentionFilter
+from unscne.ner import check_if_sids_in_ners_inject_if_not
+from unscne.util import timer, log, LogLevel
+
+SPEECH_DBCONCEPT = "speech_dbconcept"
+COUNTRY_WDCONCEPT = "country_wdconcept"
+YEAR_DBCONCEPT = "year_dbconcept"
+
+
+class MentionMatrix(NamedTuple):
+    matrix: sparse.csr_matrix
+    rows: List[str]
+    columns: List[str]
+
+    def row(self, key: str) -> np.ndarray:
+        return self.matrix[self.rows.index(key)].toarray().ravel()
+
+    def column(self, key: str) -> np.ndarray:
+        return self.matrix[:, self.columns.index(key)].toarray().ravel()
+
+
+def _read_tsv(path, columns) -> pd.DataFrame:
+    return pd.read_csv(path, sep="\t", usecols=columns, dtype=str, keep_default_na=False, encoding="utf-8")
+
+
+def _index(values: pd.Series):
+    codes, vocabulary = pd.factorize(values, sort=True)
+    return codes, list(vocabulary)
+
+
+def _indicator(codes: np.ndarray, shape) -> sparse.csr_matrix:
+    # maps each row to the column given by its code, rows with code -1 (unknown) stay empty
+    known = codes >= 0
+    rows = np.arange(len(codes))[known]
+    return sparse.csr_matrix((np.ones(len(rows), dtype=np.int32), (rows, codes[known])), shape=shape)
+
+
+def _load_linking() -> pd.DataFrame:
+    if Path(DBPEDIA_TO_WIKIDATA_INTERNAL).is_file():
+        return _read_tsv(DBPEDIA_TO_WIKIDATA_INTERNAL, ["db_uri", "wd_uri"])
+    if Path(DBPEDIA_TO_WIKIDATA).is_file():
+        log(f"{DBPEDIA_TO_WIKIDATA_INTERNAL} does not exist yet, using the unambiguous links of {DBPEDIA_TO_WIKIDATA}.",
+            LogLevel.WARNING)
+        linking = _read_tsv(DBPEDIA_TO_WIKIDATA, ["db_uri", "wd_uri"])
+        return linking[~linking["db_uri"].duplicated(keep=False)]
+    return pd.DataFrame(columns=["db_uri", "wd_uri"])
+
+
+def _read_mentions(path) -> pd.DataFrame:
+    """The p_id and uri of the mentions in `path` that pass the mention filters, so the matrices and the aggregates
+    built from them count the same mentions as the MENTIONS relationships in the graph."""
+    mention_filter = MentionFilter()
+    if not mention_filter.active:
+        return _read_tsv(path, ["p_id", "uri"])
+    if mention_filter.top_k and "s_id" not in pd.read_csv(path, sep="\t", nrows=0).columns:
+        if path != DBPEDIA_NERS:
+            raise ValueError(f"{path} has no s_id column, which MENTION_TOP_K needs.")
+        check_if_sids_in_ners_inject_if_not()
+    with open(path, encoding="utf-8", newline="") as f:
+        rows = [(row["p_id"], row["uri"]) for row in mention_filter.filter(csv.DictReader(f, delimiter="\t"))]
+    return pd.DataFrame(rows, columns=["p_id", "uri"], dtype=str)
+
+
+@timer
+def build_mention_matrices(ners=DBPEDIA_NERS, parsed=PARSED_DATA, speaker=SPEAKER, meta=META,
+                           target=ANALYTICS_FOLDER) -> Dict[str, MentionMatrix]:
+    log("Building mention matrices..")
+    speeches = _read_tsv(parsed, ["speech_name", "speech_basename"]).drop_duplicates("speech_name")
+    speeches = speeches.sort_values("speech_name").reset_index(drop=True)
+    speech_vocabulary = list(speeches["speech_name"])
+    speech_codes = pd.Index(speech_vocabulary)
+
+    mentions = _read_mentions(ners)
+    mention_speeches = speech_codes.get_indexer(mentions["p_id"].str.extract(r"([^/\\]+)[/\\][^/\\]+$")[0])
+    mentions = mentions[mention_speeches >= 0]
+    mention_speeches = mention_speeches[mention_speeches >= 0]
+    concept_codes, concept_vocabulary = _index(mentions["uri"])
+    speech_concept = sparse.csr_matrix(
+        (np.ones(len(concept_codes), dtype=np.int32), (mention_speeches, concept_codes)),
+        shape=(len(speech_vocabulary), len(concept_vocabulary)))
+    result = {SPEECH_DBCONCEPT: MentionMatrix(speech_concept, speech_vocabulary, concept_vocabulary)}
+
+    years = _read_tsv(meta, ["basename", "year"]).drop_duplicates("basename").set_index("basename")["year"]
+    year_codes, year_vocabulary = _index(speeches["speech_basename"].map(years).fillna(""))
+    if year_vocabulary and year_vocabulary[0] == "":
+        year_codes, year_vocabulary = year_codes - 1, year_vocabulary[1:]
+    speech_year = _indicator(year_codes, (len(speech_vocabulary), len(year_vocabulary)))
+    result[YEAR_DBCONCEPT] = MentionMatrix((speech_year.T @ speech_concept).tocsr(), year_vocabulary,
+                                           concept_vocabulary)
+
+    speakers = _read_tsv(speaker, ["filename", "country"])
+    speakers["speech_name"] = speakers["filename"].str.replace(r"\.[^.]*$", "", regex=True)
+    countries = speakers[speakers["country"] != ""].drop_duplicates("speech_name").set_index("speech_name")["country"]
+    country_codes, country_vocabulary = _index(speeches["speech_name"].map(countries).dropna())
+    speech_country_codes = np.full(len(speech_vocabulary), -1)
+    speech_country_codes[speeches["speech_name"].map(countries).notna().to_numpy()] = country_codes
+    speech_country = _indicator(speech_country_codes, (len(speech_vocabulary), len(country_vocabulary)))
+    linking = _load_linking()
+    linking = linking[linking["db_uri"].isin(concept_vocabulary)]
+    wd_codes, wd_vocabulary = _index(linking["wd_uri"])
+    db_wd = sparse.csr_matrix(
+        (np.ones(len(wd_codes), dtype=np.int32), (pd.Index(concept_vocabulary).get_indexer(linking["db_uri"]), wd_codes)),
+        shape=(len(concept_vocabulary), len(wd_vocabulary)))
+    result[COUNTRY_WDCONCEPT] = MentionMatrix((speech_country.T @ speech_concept @ db_wd).tocsr(), country_vocabulary,
+                                              wd_vocabulary)
+
+    for name, mention_matrix in result.items():
+        save_matrix(name, mention_matrix, target)
+        log(f"{name}: {mention_matrix.matrix.shape[0]} x {mention_matrix.matrix.shape[1]}, "
+            f"{mention_matrix.matrix.nnz} non-zero entries.")
+    log("Done.")
+    return result
+
+
+def _write_vocabulary(path, vocabulary):
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f, delimiter="\t")
+        writer.writerow(["key"])
+        writer.writerows([key] for key in vocabulary)
+
+
+def _read_vocabulary(path) -> List[str]:
+    with open(path, encoding="utf-8", newline="") as f:
+        reader = csv.reader(f, delimiter="\t")
+        next(reader)
+        return [row[0] for row in reader]
+
+
+def save_matrix(name, mention_matrix: MentionMatrix, target=ANALYTICS_FOLDER):
+    # one .npy per CSR array instead of an .npz archive, since only plain .npy files can be memory mapped
+    folder = Path(target, name)
+    folder.mkdir(parents=True, exist_ok=True)
+    matrix = mention_matrix.matrix
+    for array in ("data", "indices", "indptr"):
+        np.save(Path(folder, f"{array}.npy"), getattr(matrix, array))
+    _write_vocabulary(Path(folder, "rows.tsv"), mention_matrix.rows)
+    _write_vocabulary(Path(folder, "columns.tsv"), mention_matrix.columns)
+
+
+def load_matrix(name, source=ANALYTICS_FOLDER, mmap=True) -> MentionMatrix:
+    folder = Path(source, name)
+    if not folder.is_dir():
+        log(f"No matrix {name} in {source}, run `python make.py analytics` first.", LogLevel.ERROR)
+        raise FileNotFoundError(folder)
+    mode = "r" if mmap else None
+    data, indices, indptr = (np.load(Path(folder, f"{array}.npy"), mmap_mode=mode)
+                             for array in ("data", "indices", "indptr"))
+    rows = _read_vocabulary(Path(folder, "rows.tsv"))
+    columns = _read_vocabulary(Path(folder, "columns.tsv"))
+    matrix = sparse.csr_matrix((data, indices, indptr), shape=(len(rows), len(columns)), copy=False)
+    return MentionMatrix(matrix, rows, columns)
+
+
+def cooccurrence(mention_matrix: MentionMatrix) -> MentionMatrix:
+    """Number of rows (e.g. speeches) in which two columns occur together."""
+    occurs = (mention_matrix.matrix > 0).astype(np.int32)
+    return MentionMatrix((occurs.T @ occurs).tocsr(), mention_matrix.columns, mention_matrix.columns)
+
+
+def tf_idf(mention_matrix: MentionMatrix) -> MentionMatrix:
+    matrix = mention_matrix.matrix.astype(np.float64)
+    lengths = np.asarray(matrix.sum(axis=1)).ravel()
+    lengths[lengths == 0] = 1
+    document_frequency = np.bincount(matrix.indices, minlength=matrix.shape[1])
+    idf = np.log((1 + matrix.shape[0]) / (1 + document_frequency)) + 1
+    weighted = sparse.diags(1 / lengths) @ matrix @ sparse.diags(idf)
+    return MentionMatrix(weighted.tocsr(), mention_matrix.rows, mention_matrix.columns)
+
+
+def relative_frequencies(mention_matrix: MentionMatrix) -> MentionMatrix:
+    matrix = mention_matrix.matrix.astype(np.float64)
+    totals = np.asarray(matrix.sum(axis=1)).ravel()
+    totals[totals == 0] = 1
+    return MentionMatrix((sparse.diags(1 / totals) @ matrix).tocsr(), mention_matrix.rows, mention_matrix.columns)
+
+
+def trend(mention_matrix: MentionMatrix, column: str) -> pd.Series:
+    """Share of all mentions per row (e.g. year) that went to `column`."""
+    return pd.Series(relative_frequencies(mention_matrix).column(column), index=mention_matrix.rows, name=column)
+
+
+def top_columns(mention_matrix: MentionMatrix, row: str, k=10) -> pd.Series:
+    values = mention_matrix.row(row)
+    best = np.argsort(-values, kind="stable")[:k]
+    return pd.Series(values[best], index=[mention_matrix.columns[i] for i in best], name=row)
@@ -0,0 +1,106 @@
+import csv
+import threading
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from config import ANNOTATION_STATUS, ANNOTATION_DEAD_LETTER
+from unscne.ids import paragraph_path_of
+from unscne.metrics import metrics
+
+OK = "ok"
+EMPTY = "empty"
+FAILED = "failed"
+
+STATUS_HEADER = ["p_id", "status", "error"]
+DEAD_LETTER_HEADER = ["p_id", "paragraph_path", "error", "message"]
+
+
+def _append(path, header, rows):
+    exists = Path(path).is_file() and Path(path).stat().st_size > 0
+    with open(path, "a", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f, delimiter="\t")
+        if not exists:
+            writer.writerow(header)
+        writer.writerows(rows)
+
+
+class AnnotationStatus:
+    """Outcome of the last Spotlight request of every paragraph. Both files are append only while annotating, the
+    last line of a paragraph wins. `compact` rewrites them to one line per paragraph."""
+
+    def __init__(self, path=ANNOTATION_STATUS, dead_letter=ANNOTATION_DEAD_LETTER):
+        self.path = path
+        self.dead_letter = dead_letter
+        self.status: Dict[str, Tuple[str, str]] = {}
+        self.failures: Dict[str, Dict[str, str]] = {}
+        self._lock = threading.Lock()
+        if Path(path).is_file():
+            with open(path, encoding="utf-8", newline="") as f:
+                for row in csv.DictReader(f, delimiter="\t"):
+                    self.status[row["p_id"]] = (row["status"], row["error"])
+        if Path(dead_letter).is_file():
+            with open(dead_letter, encoding="utf-8", newline="") as f:
+                for row in csv.DictReader(f, delimiter="\t"):
+                    self.failures[row["p_id"]] = row
+
+    def get(self, p_id) -> Optional[str]:
+        entry = self.status.get(str(p_id))
+        return entry[0] if entry else None
+
+    def is_settled(self, p_id) -> bool:
+        """Whether annotating `p_id` again is pointless: it has no entities, or it failed and waits for a retry.
+        Paragraphs marked ok are only settled if their annotations are in the NER file, which callers check."""
+        return self.get(p_id) in (EMPTY, FAILED)
+
+    def record(self, paragraph_metas, status, error: Optional[BaseException] = None):
+        error_class = type(error).__name__ if error is not None else ""
+        p_ids = [str(paragraph_meta["p_id"]) for paragraph_meta in paragraph_metas]
+        if not p_ids:
+            return
+        with self._lock:
+            _append(self.path, STATUS_HEADER, [(p_id, status, error_class) for p_id in p_ids])
+            for p_id in p_ids:
+                self.status[p_id] = (status, error_class)
+            if status == FAILED:
+                failures = [{"p_id": p_id, "paragraph_path": paragraph_path_of(p_id),
+                             "error": error_class, "message": str(error).replace("\t", " ").replace("\n", " ")}
+                            for p_id, paragraph_meta in zip(p_ids, paragraph_metas)]
+                _append(self.dead_letter, DEAD_LETTER_HEADER, [[row[key] for key in DEAD_LETTER_HEADER]
+                                                               for row in failures])
+                self.failures.update((row["p_id"], row) for row in failures)
+            else:
+                for p_id in p_ids:
+                    self.failures.pop(p_id, None)
+        metrics.incr(f"annotate.paragraphs_{status}", len(p_ids))
+        if error is not None:
+            metrics.incr(f"annotate.errors.{error_class}", len(p_ids))
+
+    def record_annotated(self, batch, entries):
+        """Marks the paragraphs of a successfully annotated batch as ok or empty, depending on `entries`."""
+        annotated = {str(paragraph_meta["p_id"]) for paragraph_meta, _ in entries}
+        paragraph_metas = [paragraph_meta for paragraph_meta, _ in batch]
+        self.record([p for p in paragraph_metas if str(p["p_id"]) in annotated], OK)
+        self.record([p for p in paragraph_metas if str(p["p_id"]) not in annotated], EMPTY)
+
+    def failed(self) -> List[Dict[str, str]]:
+        return [self.failures[p_id] for p_id, (status, _) in self.status.items()
+                if status == FAILED and p_id in self.failures]
+
+    def counts(self) -> Dict[str, int]:
+        counts = {OK: 0, EMPTY: 0, FAILED: 0}
+        for status, _ in self.status.values():
+            counts[status] = counts.get(status, 0) + 1
+        return counts
+
+    def compact(self):
+        with self._lock:
+            for path, header, rows in ((self.path, STATUS_HEADER,
+                                        [(p_id, status, error) for p_id, (status, error) in self.status.items()]),
+                                       (self.dead_letter, DEAD_LETTER_HEADER,
+                                        [[row[key] for key in DEAD_LETTER_HEADER] for row in self.failed()])):
+                tmp = f"{path}.tmp"
+                with open(tmp, "w", encoding="utf-8", newline="") as f:
+                    writer = csv.writer(f, delimiter="\t")
+                    writer.writerow(header)
+                    writer.writerows(rows)
+                Path(tmp).replace(path)
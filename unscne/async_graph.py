@@ -0,0 +1,73 @@
+from typing import AsyncIterator, Iterable, List
+
+from neo4j import AsyncGraphDatabase
+
+from config import NEO4J_PASSWORD, NEO4J_USER, NEO4J_BOLT_URL, NEO4J_DATABASE_NAME, NEO4J_FETCH_SIZE, \
+    WRITE_BATCH_SIZE
+from unscne.metrics import metrics
+from unscne.statements import plan_cache, CYPHER
+
+
+class AsyncGraph:
+    """The asyncio counterpart of HelloWorldExample for code that overlaps graph access with other I/O."""
+
+    def __init__(self, uri=NEO4J_BOLT_URL, user=NEO4J_USER, password=NEO4J_PASSWORD,
+                 database_name=NEO4J_DATABASE_NAME):
+        self.database_name = database_name
+        self.driver = AsyncGraphDatabase.driver(uri, auth=(user, password))
+
+    async def close(self):
+        await self.driver.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    async def stream(self, query, parameters=None, fetch_size=NEO4J_FETCH_SIZE) -> AsyncIterator:
+        rows = 0
+        plan_cache.record(CYPHER, query)
+        try:
+            async with self.driver.session(database=self.database_name, fetch_size=fetch_size) as session:
+                result = await session.run(query, parameters)
+                async for record in result:
+                    rows += 1
+                    yield record
+        finally:
+            metrics.incr("rows_read", rows)
+
+    async def stream_column(self, query, parameters=None, fetch_size=NEO4J_FETCH_SIZE) -> AsyncIterator:
+        async for record in self.stream(query, parameters, fetch_size):
+            yield record[0]
+
+    async def execute_query(self, query, parameters=None):
+        plan_cache.record(CYPHER, query)
+        async def work(tx):
+            result = await tx.run(query, parameters)
+            return await result.consume()
+
+        async with self.driver.session(database=self.database_name) as session:
+            summary = await session.write_transaction(work)
+        metrics.record_summary(summary)
+        return summary
+
+    async def write_batches(self, query, rows: List, batch_size=WRITE_BATCH_SIZE):
+        for i in range(0, len(rows), batch_size):
+            await self.execute_query(query, {"rows": rows[i:i + batch_size]})
+
+
+async def batched_async(items: AsyncIterator, batch_size) -> AsyncIterator[List]:
+    batch = []
+    async for item in items:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+async def iterate(items: Iterable) -> AsyncIterator:
+    for item in items:
+        yield item
@@ -0,0 +1,255 @@
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from typing import Dict, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from config import HTTP_BUDGETS, HTTP_DEFAULT_BUDGET
+from unscne.metrics import metrics
+
+THROTTLING_STATUS = {429, 503}
+RETRYING_STATUS = {429, 500, 502, 503, 504}
+
+
+class CircuitOpenError(requests.exceptions.RequestException):
+    pass
+
+
+class DeadlineExceeded(requests.exceptions.RequestException):
+    pass
+
+
+class TokenBucket:
+    """Allows `rate` requests per second on average and bursts of up to `capacity` requests."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, deadline: float):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                missing = (1 - self.tokens) / self.rate
+            if now + missing > deadline:
+                raise DeadlineExceeded("Deadline exceeded while waiting for the rate limit")
+            time.sleep(missing)
+
+
+class AdaptiveLimiter:
+    """Bounds concurrent requests, growing the bound additively on success and halving it on throttling."""
+
+    def __init__(self, initial: int, minimum: int, maximum: int):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.in_flight = 0
+        self._condition = threading.Condition()
+
+    def acquire(self, deadline: float):
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise DeadlineExceeded("Deadline exceeded while waiting for a free request slot")
+                self._condition.wait(remaining)
+            self.in_flight += 1
+
+    def release(self, throttled: bool):
+        with self._condition:
+            self.in_flight -= 1
+            if throttled:
+                self.limit = max(self.minimum, self.limit / 2)
+            else:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self._condition.notify_all()
+
+
+class CircuitBreaker:
+    """Opens after `threshold` consecutive failures. After `cooldown` it is half open and lets a single probe
+    request through, everyone else waits until the probe closes the circuit or opens it for another cooldown."""
+
+    def __init__(self, threshold: int, cooldown: float):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened = None
+        self.probing = False
+        self._condition = threading.Condition()
+
+    def wait_until_closed(self, deadline: float, name: str) -> bool:
+        """Returns once a request may be sent, True if it is the probe, whose outcome has to be recorded."""
+        with self._condition:
+            while True:
+                if self.opened is None:
+                    return False
+                now = time.monotonic()
+                reopens = self.opened + self.cooldown
+                if not self.probing and now >= reopens:
+                    self.probing = True
+                    return True
+                # without a probe in flight the circuit stays open until `reopens`, with one until its outcome
+                until = deadline if self.probing else reopens
+                if until > deadline or now >= deadline:
+                    raise CircuitOpenError(f"Circuit for {name} is open")
+                self._condition.wait(until - now)
+
+    def record(self, success: bool, name: str, probe: bool = False):
+        with self._condition:
+            if probe:
+                self.probing = False
+            if success:
+                self.failures = 0
+                if probe:
+                    self.opened = None
+            else:
+                self.failures += 1
+                if probe or (self.failures >= self.threshold and self.opened is None):
+                    # a failed probe starts another cooldown
+                    self.opened = time.monotonic()
+                    metrics.incr(f"http.{name}.circuit_opened")
+            self._condition.notify_all()
+
+    def release_probe(self):
+        """Hands the probe to the next waiting request, for a probe that ended before it got an answer."""
+        with self._condition:
+            self.probing = False
+            self._condition.notify_all()
+
+
+class Budget:
+
+    def __init__(self, name: str, url: str = "", rate: float = 10, burst: float = 10, initial_concurrency: int = 4,
+                 min_concurrency: int = 1, max_concurrency: int = 16, max_retries: int = 8, backoff: float = 1.0,
+                 max_backoff: float = 120.0, deadline: float = 600.0, failure_threshold: int = 10,
+                 cooldown: float = 60.0):
+        self.name = name
+        self.url = url
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.deadline = deadline
+        self.bucket = TokenBucket(rate, burst)
+        self.limiter = AdaptiveLimiter(initial_concurrency, min_concurrency, max_concurrency)
+        self.breaker = CircuitBreaker(failure_threshold, cooldown)
+
+    def backoff_for(self, attempt: int) -> float:
+        # full jitter keeps concurrent callers from retrying in lockstep
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+
+_budgets: Dict[str, Budget] = {}
+_budgets_lock = threading.Lock()
+
+
+def _load_budgets():
+    if not _budgets:
+        for name, settings in HTTP_BUDGETS.items():
+            _budgets[name] = Budget(name, **settings)
+        _budgets["default"] = Budget("default", **HTTP_DEFAULT_BUDGET)
+
+
+def register_budget(name: str, url: str, **settings) -> Budget:
+    """Adds or replaces the budget `name` for the endpoint at `url`, e.g. for a local server that none of
+    HTTP_BUDGETS matches."""
+    with _budgets_lock:
+        _load_budgets()
+        budget = _budgets[name] = Budget(name, url, **settings)
+    return budget
+
+
+def get_budget(url: str) -> Budget:
+    """Returns the shared budget of the configured endpoint with the longest matching url prefix."""
+    with _budgets_lock:
+        _load_budgets()
+        matching = [budget for budget in _budgets.values() if budget.url and url.startswith(budget.url)]
+    if not matching:
+        return _budgets["default"]
+    return max(matching, key=lambda budget: len(budget.url))
+
+
+def get_retry_after(response: requests.Response) -> Optional[float]:
+    value = response.headers.get("Retry-After")
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class RateLimitedSession(requests.Session):
+    """A session whose requests share per endpoint rate limits, concurrency bounds, retries and deadlines."""
+
+    def request(self, method, url, *args, **kwargs):
+        budget = get_budget(url)
+        deadline = time.monotonic() + budget.deadline
+        attempt = 0
+        fixed_timeout = "timeout" in kwargs
+        while True:
+            probe = budget.breaker.wait_until_closed(deadline, budget.name)
+            try:
+                budget.bucket.acquire(deadline)
+                budget.limiter.acquire(deadline)
+                response, error, throttled = None, None, False
+                try:
+                    if not fixed_timeout:
+                        kwargs["timeout"] = max(1.0, deadline - time.monotonic())
+                    response = super().request(method, url, *args, **kwargs)
+                    throttled = response.status_code in THROTTLING_STATUS
+                except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                    error = e
+                finally:
+                    budget.limiter.release(throttled)
+            except BaseException:
+                # otherwise the other requests would wait for the outcome of this probe until their deadline
+                if probe:
+                    budget.breaker.release_probe()
+                raise
+            failed = error is not None or response.status_code in RETRYING_STATUS
+            budget.breaker.record(not failed, budget.name, probe)
+            if not failed:
+                return response
+            if throttled:
+                metrics.incr(f"http.{budget.name}.throttled")
+            if attempt >= budget.max_retries:
+                break
+            pause = budget.backoff_for(attempt)
+            if response is not None:
+                retry_after = get_retry_after(response)
+                if retry_after is not None:
+                    pause = max(pause, retry_after)
+            if time.monotonic() + pause > deadline:
+                break
+            metrics.incr(f"http.{budget.name}.retries")
+            time.sleep(pause)
+            attempt += 1
+        if error is not None:
+            raise error
+        return response
+
+
+def create_session() -> RateLimitedSession:
+    http = RateLimitedSession()
+    # retries are handled by the session itself, so they can honor Retry-After and the shared budgets
+    adapter = HTTPAdapter(pool_maxsize=max(settings.get("max_concurrency", 16) for settings in
+                                           list(HTTP_BUDGETS.values()) + [HTTP_DEFAULT_BUDGET]))
+    http.mount("https://", adapter)
+    http.mount("http://", adapter)
+    http.hooks["response"].append(lambda response, *args, **kwargs: metrics.record_response(response))
+    return http
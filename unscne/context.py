@@ -0,0 +1,36 @@
+from typing import Dict, Iterable, List, Optional
+
+from unscne.graph import HelloWorldExample
+from unscne.textstore import TextStore
+
+CONTEXT_QUERY = """
+UNWIND $uids AS uid
+MATCH (s:Sentence {uid: uid})
+WITH uid, s.speech_uid AS speech_uid, s.index_in_speech AS position
+MATCH (c:Sentence)
+USING INDEX c:Sentence(speech_uid, index_in_speech)
+WHERE c.speech_uid = speech_uid AND c.index_in_speech >= position - $k AND c.index_in_speech <= position + $k
+RETURN uid, c.uid AS s_uid, c.id AS s_id, c.index_in_speech - position AS offset, coalesce(c.text, c.preview) AS text,
+       c.text IS NULL AS preview
+ORDER BY uid, offset
+"""
+
+
+def get_context_windows(graph: HelloWorldExample, s_uids: Iterable[int], k=2,
+                        store: Optional[TextStore] = None) -> Dict[int, List[Dict]]:
+    """The sentences up to `k` positions before and after each of `s_uids` within its speech, in reading order.
+    `offset` is the position relative to the requested sentence, which has offset 0. All windows are read in one
+    query, as ranges on the (speech_uid, index_in_speech) index. Only previews are stored in compact mode, their full
+    texts are read from `store` if given."""
+    s_uids = list(dict.fromkeys(int(s_uid) for s_uid in s_uids))
+    windows: Dict[int, List[Dict]] = {s_uid: [] for s_uid in s_uids}
+    for record in graph.stream(CONTEXT_QUERY, {"uids": s_uids, "k": k}):
+        windows[record["uid"]].append({key: record[key] for key in ("s_uid", "s_id", "offset", "text", "preview")})
+    if store is not None:
+        sentences = [sentence for window in windows.values() for sentence in window if sentence["preview"]]
+        texts = store.get_many(sentence["s_uid"] for sentence in sentences)
+        for sentence in sentences:
+            if sentence["s_uid"] in texts:
+                sentence["text"] = texts[sentence["s_uid"]]
+                sentence["preview"] = False
+    return windows
@@ -0,0 +1,180 @@
+import asyncio
+import csv
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import AsyncIterator, Callable, List, Set
+
+from config import WD_CLASSES, WD_HIERARCHY, WD_LABELS, ENRICHMENT_WORKERS, ENRICHMENT_QUEUE_SIZE, \
+    ENRICHMENT_WRITE_BATCH_SIZE
+from unscne import ner
+from unscne.async_graph import AsyncGraph, batched_async, iterate
+from unscne.graph import HelloWorldExample
+from unscne.metrics import metrics
+from unscne.util import timer, log
+
+# materialized on the server before the first record is sent, so WDConcepts added by the writer while the URIs
+# are still being streamed are not selected as well
+SELECT_WD_URIS = "MATCH (wd:WDConcept) WITH collect(DISTINCT wd.uri) AS uris UNWIND uris AS uri RETURN uri"
+
+WRITE_CLASSES_QUERY = """
+UNWIND $rows AS row
+MATCH (a:WDConcept {uri: row.instance})
+MERGE (b:WDConcept {uri: row.class})
+MERGE (a)-[:wd_P31]->(b)
+"""
+
+WRITE_HIERARCHY_QUERY = """
+UNWIND $rows AS row
+MERGE (class:WDConcept {uri: row.class})
+MERGE (super:WDConcept {uri: row.superclass})
+MERGE (class)-[:wd_P279]->(super)
+"""
+
+WRITE_LABELS_QUERY = """
+UNWIND $rows AS row
+MATCH (a:WDConcept {uri: row.uri})
+SET a.label = row.uri_label
+"""
+
+
+async def _produce(batches: AsyncIterator[List], todo: asyncio.Queue, workers: int):
+    async for batch in batches:
+        await todo.put(batch)
+    for _ in range(workers):
+        await todo.put(None)
+
+
+async def _fetch(fetch: Callable, todo: asyncio.Queue, done: asyncio.Queue, executor: ThreadPoolExecutor):
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = await todo.get()
+        if batch is None:
+            break
+        # requests is blocking, the shared session enforces the Wikidata budget across the executor threads
+        rows = await loop.run_in_executor(executor, metrics.bind(fetch), batch, ner.http)
+        metrics.incr("enrichment.batches")
+        await done.put(rows)
+    await done.put(None)
+
+
+async def _write(graph: AsyncGraph, query, done: asyncio.Queue, workers: int, writer: csv.DictWriter,
+                 batch_size: int, on_rows: Callable = None) -> int:
+    pending, finished, written = [], 0, 0
+    while finished < workers:
+        rows = await done.get()
+        if rows is None:
+            finished += 1
+            continue
+        writer.writerows(rows)
+        if on_rows is not None:
+            on_rows(rows)
+        pending.extend(rows)
+        if len(pending) >= batch_size:
+            await graph.write_batches(query, pending, batch_size)
+            written += len(pending)
+            pending = []
+    if pending:
+        await graph.write_batches(query, pending, batch_size)
+        written += len(pending)
+    metrics.incr("enrichment.rows_written", written)
+    return written
+
+
+async def run_pipeline(graph: AsyncGraph, batches: AsyncIterator[List], fetch: Callable, query, writer: csv.DictWriter,
+                       workers=ENRICHMENT_WORKERS, queue_size=ENRICHMENT_QUEUE_SIZE,
+                       batch_size=ENRICHMENT_WRITE_BATCH_SIZE, on_rows: Callable = None) -> int:
+    """Reads `batches`, runs `fetch(batch, http)` for `workers` batches at a time and writes the returned rows to
+    `writer` and the graph. All three run concurrently and the bounded queues in between keep a slow stage from
+    piling up work in the others."""
+    todo, done = asyncio.Queue(maxsize=queue_size), asyncio.Queue(maxsize=queue_size)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = await asyncio.gather(
+            _produce(batches, todo, workers),
+            *(_fetch(fetch, todo, done, executor) for _ in range(workers)),
+            _write(graph, query, done, workers, writer, batch_size, on_rows))
+    return results[-1]
+
+
+def _open_tsv(path, fieldnames):
+    f = open(f"{path}.tmp", "w", encoding="utf-8", newline="")
+    writer = csv.DictWriter(f, fieldnames, delimiter="\t")
+    writer.writeheader()
+    return f, writer
+
+
+def _fetch_classes(batch, http):
+    return [{"instance": instance, "class": clazz} for instance, clazz in ner.query_wd_for_P31(batch, http)]
+
+
+def _fetch_superclasses(batch, http):
+    return [{"class": clazz, "superclass": superclazz} for clazz, superclazz in ner.query_wd_for_P279(batch, http)]
+
+
+def _fetch_labels(batch, http):
+    return [{"uri": uri, "uri_label": label} for uri, label in ner.query_wd_for_label(batch, http)]
+
+
+async def enrich_classes(graph: AsyncGraph, target=WD_CLASSES):
+    f, writer = _open_tsv(target, ["instance", "class"])
+    with f:
+        written = await run_pipeline(graph, batched_async(graph.stream_column(SELECT_WD_URIS), 100),
+                                     _fetch_classes, WRITE_CLASSES_QUERY, writer)
+    Path(f"{target}.tmp").replace(target)
+    log(f"Wrote {written} wd:P31 relations.")
+
+
+async def enrich_hierarchy(graph: AsyncGraph, target=WD_HIERARCHY, depth=5):
+    uris: List[str] = [uri async for uri in graph.stream_column(SELECT_WD_URIS)]
+    already_queried: Set[str] = set()
+    written = 0
+    f, writer = _open_tsv(target, ["superclass", "class"])
+    with f:
+        for level in range(depth):
+            if not uris:
+                break
+            found = []
+            already_queried.update(uris)
+            written += await run_pipeline(graph, batched_async(iterate(uris), 100), _fetch_superclasses,
+                                          WRITE_HIERARCHY_QUERY, writer, on_rows=found.extend)
+            uris = sorted({row["superclass"] for row in found} - already_queried)
+            log(f"Level {level + 1}: {len(found)} wd:P279 relations, {len(uris)} new superclasses.")
+    Path(f"{target}.tmp").replace(target)
+    log(f"Wrote {written} wd:P279 relations.")
+
+
+async def enrich_labels(graph: AsyncGraph, target=WD_LABELS):
+    f, writer = _open_tsv(target, ["uri", "uri_label"])
+    with f:
+        written = await run_pipeline(graph, batched_async(graph.stream_column(SELECT_WD_URIS), 100),
+                                     _fetch_labels, WRITE_LABELS_QUERY, writer)
+    Path(f"{target}.tmp").replace(target)
+    log(f"Set {written} labels.")
+
+
+async def _run(graph: HelloWorldExample, enrich: Callable):
+    async with AsyncGraph(database_name=graph.database_name) as async_graph:
+        await enrich(async_graph)
+
+
+def _enrich_or_load(graph: HelloWorldExample, target, enrich: Callable, load: Callable):
+    # an existing dump is loaded as before, the pipeline writes the graph while it creates the dump
+    if Path(target).is_file():
+        load(graph)
+        return
+    log(f"{target} does not exist, creating and writing it to the graph concurrently..")
+    asyncio.run(_run(graph, enrich))
+
+
+@timer
+def get_classes_for_wd(graph: HelloWorldExample):
+    _enrich_or_load(graph, WD_CLASSES, enrich_classes, ner.get_classes_for_wd)
+
+
+@timer
+def get_class_hierarchy_for_wd(graph: HelloWorldExample):
+    _enrich_or_load(graph, WD_HIERARCHY, enrich_hierarchy, ner.get_class_hierarchy_for_wd)
+
+
+@timer
+def get_label_for_wd(graph: HelloWorldExample):
+    _enrich_or_load(graph, WD_LABELS, enrich_labels, ner.get_label_for_wd)
@@ -1,5 +1,7 @@
-import math
+import csv
 import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from typing import Optional
 
 import neo4j
@@ -7,15 +9,28 @@ from neo4j import GraphDatabase
 from neo4j.exceptions import ServiceUnavailable
 from tqdm import tqdm
 
-from config import NEO4J_PASSWORD, NEO4J_USER, NEO4J_BOLT_URL, NEO4J_DATABASE_NAME
-from unscne.util import log, LogLevel
+from config import NEO4J_PASSWORD, NEO4J_USER, NEO4J_BOLT_URL, NEO4J_DATABASE_NAME, NEO4J_FETCH_SIZE, \
+    WIPE_BATCH_SIZE, WRITE_BATCH_SIZE, NEO4J_PROFILE_MODE, NEO4J_INDEX_TIMEOUT, NEO4J_LOADER
+from unscne.metrics import metrics
+from unscne.profiling import QueryProfiler
+from unscne.statements import plan_cache, CYPHER
+from unscne.util import log, LogLevel, count_lines_in_file
+
+FULLTEXT_SENTENCE_TEXT = "fulltext_sentence_text"
+FULLTEXT_WD_LABEL = "fulltext_wd_label"
+FULLTEXT_AGENDA_NAME = "fulltext_agenda_name"
 
 
 class HelloWorldExample:
 
-    def __init__(self, uri, user, password, database_name = NEO4J_DATABASE_NAME):
-        self._create_database_if_not_exists(uri, user, password)
+    def __init__(self, uri, user, password, database_name = NEO4J_DATABASE_NAME, profile_mode=NEO4J_PROFILE_MODE):
+        self._create_database_if_not_exists(uri, user, password, database_name)
+        self.database_name = database_name
+        self.profiler = None
+        if profile_mode:
+            self.enable_profiling(profile_mode)
         self.driver = GraphDatabase.driver(uri, database=database_name, auth=(user, password))
+        self.system_driver = GraphDatabase.driver(uri, database="system", auth=(user, password))
 
 
     def _create_database(self, uri, user, password, database_name):
@@ -25,13 +40,14 @@ class HelloWorldExample:
             session.run(f"CREATE DB {database_name}")
         driver.close()
 
-    def _create_database_if_not_exists(self, uri, user, password):
+    def _create_database_if_not_exists(self, uri, user, password, database_name=NEO4J_DATABASE_NAME):
         tmp = GraphDatabase.driver(uri, database="system", auth=(user, password))
         with tmp.session() as session:
-            session.run(f"CREATE DATABASE {NEO4J_DATABASE_NAME} IF NOT EXISTS")
+            session.run(f"CREATE DATABASE {database_name} IF NOT EXISTS")
 
     def close(self):
         self.driver.close()
+        self.system_driver.close()
 
     @staticmethod
     def _get_number_of_nodes_in_graph(tx):
@@ -57,20 +73,55 @@ class HelloWorldExample:
         log("Done.")
 
     def clear(self):
-        self.clear_data()
+        # dropping the schema first spares the deletes below from maintaining indexes
         self.clear_constraints()
         self.clear_indices()
+        self.clear_data()
 
-    def clear_data(self):
-        batch_number = 10000
+    def reset(self):
+        try:
+            self.drop_and_recreate_database()
+        except (neo4j.exceptions.ClientError, neo4j.exceptions.DatabaseError) as e:
+            log(f"Could not recreate {self.database_name} ({e.message}), deleting in batches instead.", LogLevel.WARNING)
+            self.clear()
+
+    def drop_and_recreate_database(self):
+        log(f"Dropping and recreating {self.database_name}..")
+        with self.system_driver.session() as session:
+            session.run(f"CREATE OR REPLACE DATABASE {self.database_name} WAIT").consume()
+        log("Done.")
+
+    def _delete_in_batches(self, match, delete, total, desc, batch_size=WIPE_BATCH_SIZE):
         query = f"""
-        MATCH (n)
-        WITH n LIMIT {batch_number}
-        DETACH DELETE n;  
+        {match}
+        WITH x LIMIT {batch_size * 10}
+        CALL {{ WITH x {delete} x }} IN TRANSACTIONS OF {batch_size} ROWS
         """
+        with tqdm(total=total, desc=desc) as progress:
+            while True:
+                plan_cache.record(CYPHER, query)
+                with self.driver.session() as session:
+                    summary = session.run(query).consume()
+                metrics.record_summary(summary)
+                counters = summary.counters
+                deleted = counters.relationships_deleted + counters.nodes_deleted
+                if deleted == 0:
+                    break
+                progress.update(deleted)
+
+    def _count(self, query):
+        with self.driver.session() as session:
+            return session.run(query).single()[0]
+
+    def clear_data(self):
         log("Clearing data..")
-        for _ in tqdm(range(math.ceil(self.get_number_of_nodes_in_graph() / batch_number))):
-            self.execute_query(query)
+        for rel_type in list(self.stream_column("CALL db.relationshipTypes()")):
+            total = self._count(f"MATCH ()-[r:`{rel_type}`]->() RETURN count(r)")
+            self._delete_in_batches(f"MATCH ()-[x:`{rel_type}`]->()", "DELETE", total, rel_type)
+        for label in list(self.stream_column("CALL db.labels()")):
+            total = self._count(f"MATCH (n:`{label}`) RETURN count(n)")
+            self._delete_in_batches(f"MATCH (x:`{label}`)", "DETACH DELETE", total, label)
+        self._delete_in_batches("MATCH (x)", "DETACH DELETE", self.get_number_of_nodes_in_graph(), "unlabeled")
         log("Done.")
 
     @staticmethod
@@ -107,6 +158,7 @@ class HelloWorldExample:
             session.write_transaction(self._add_speech, speech, country, speaker, participanttype, role_in_un)
 
     def select(self, query):
+        plan_cache.record(CYPHER, query)
         with self.driver.session() as session:
             return session.read_transaction(self._select, query)
 
@@ -117,6 +169,22 @@ class HelloWorldExample:
             data.append(result)
         return data
 
+    def stream(self, query, parameters=None, fetch_size=NEO4J_FETCH_SIZE, as_tuples=False):
+        # the session stays open until the generator is exhausted, records are pulled `fetch_size` at a time
+        rows = 0
+        plan_cache.record(CYPHER, query)
+        try:
+            with self.driver.session(fetch_size=fetch_size, default_access_mode=neo4j.READ_ACCESS) as session:
+                for record in session.run(query, parameters):
+                    rows += 1
+                    yield tuple(record.values()) if as_tuples else record
+        finally:
+            metrics.incr("rows_read", rows)
+
+    def stream_column(self, query, parameters=None, fetch_size=NEO4J_FETCH_SIZE):
+        for values in self.stream(query, parameters, fetch_size, as_tuples=True):
+            yield values[0]
+
     @staticmethod
     def _merge_speech_text(tx, basename, text):
         query = """
@@ -130,9 +198,31 @@ class HelloWorldExample:
         with self.driver.session() as session:
             session.write_transaction(self._merge_speech_text, basename, text)
 
-    def execute_query(self, query):
+    def enable_profiling(self, mode):
+        log(f"Capturing query plans with {mode}.")
+        self.profiler = QueryProfiler(mode)
+
+    def execute_query(self, query, parameters=None):
+        plan_cache.record(CYPHER, query)
+        if self.profiler is not None:
+            self.profiler.capture(self.driver, query, parameters)
+        with self.driver.session() as session:
+            summary = session.write_transaction(lambda tx: tx.run(query, parameters).consume())
+        metrics.record_summary(summary)
+        return summary
+
+    def execute_transaction(self, statements):
+        """Runs the (query, parameters) pairs of `statements` in one write transaction, so either all of them are
+        committed or none. The driver retries the whole transaction on transient errors such as deadlocks."""
+        statements = list(statements)
+        for query, _ in statements:
+            plan_cache.record(CYPHER, query)
         with self.driver.session() as session:
-            return session.write_transaction(lambda tx: tx.run(query))
+            summaries = session.write_transaction(
+                lambda tx: [tx.run(query, parameters).consume() for query, parameters in statements])
+        for summary in summaries:
+            metrics.record_summary(summary)
+        return summaries
 
     def execute_query_and_ignore_exceptions(self, query):
         try:
@@ -140,22 +230,31 @@ class HelloWorldExample:
         except neo4j.exceptions.ClientError:
             pass
 
-    def execute_query_without_transaction(self, query):
+    def execute_query_without_transaction(self, query, parameters=None):
+        plan_cache.record(CYPHER, query)
+        if self.profiler is not None:
+            self.profiler.capture(self.driver, query, parameters)
         with self.driver.session() as session:
-            return session.run(query)
+            summary = session.run(query, parameters).consume()
+        metrics.record_summary(summary)
+        return summary
 
     def create_indices_and_constraints(self):
         print("Creating indexes and constraints..")
         self.create_constraints_if_they_dont_exist()
+        self.create_indices_if_they_dont_exist()
         print("DONE")
 
     def create_constraints_if_they_dont_exist(self):
         constraints = ["CREATE CONSTRAINT constraint_speech_id IF NOT EXISTS ON (s:Speech) ASSERT (s.filename) IS NODE KEY",
                        "CREATE CONSTRAINT constraint_agenda_name_name IF NOT EXISTS ON (a:AgendaItem) ASSERT (a.name) IS NODE KEY",
-                       "CREATE CONSTRAINT constraint_paragraph_index IF NOT EXISTS ON (p:Paragraph) ASSERT (p.id) IS NODE KEY",
+                       "CREATE CONSTRAINT constraint_speech_uid IF NOT EXISTS ON (s:Speech) ASSERT (s.uid) IS NODE KEY",
+                       "CREATE CONSTRAINT constraint_paragraph_uid IF NOT EXISTS ON (p:Paragraph) ASSERT (p.uid) IS NODE KEY",
                        "CREATE CONSTRAINT constraint_db_uri IF NOT EXISTS ON (d:DBConcept) ASSERT (d.uri) IS NODE KEY",
                        "CREATE CONSTRAINT constraint_wd_uri IF NOT EXISTS ON (w:WDConcept) ASSERT (w.uri) IS NODE KEY",
-                       "CREATE CONSTRAINT constraint_sentence_id IF NOT EXISTS ON (s:Sentence) ASSERT (s.id) IS NODE KEY",
+                       "CREATE CONSTRAINT constraint_sentence_uid IF NOT EXISTS ON (s:Sentence) ASSERT (s.uid) IS NODE KEY",
+                       "CREATE CONSTRAINT constraint_spacy_entity IF NOT EXISTS ON (e:SpacyEntity) ASSERT (e.text, e.label) IS NODE KEY",
+                       "CREATE CONSTRAINT constraint_year IF NOT EXISTS ON (y:Year) ASSERT (y.year) IS NODE KEY",
                        "CREATE CONSTRAINT constraint_institution_name IF NOT EXISTS ON (i:Institution) ASSERT (i.name) IS NODE KEY",
                        "CREATE CONSTRAINT constraint_speaker IF NOT EXISTS ON (s:Speaker) ASSERT (s.name, s.participanttype, s.role_in_un, s.country) IS NODE KEY"
                        ]
@@ -164,9 +263,22 @@ class HelloWorldExample:
 
     def create_indices_if_they_dont_exist(self):
         indices = [
-            "CREATE INDEX index_meta_basename IF NOT EXISTS FOR (m:Meta) ON m.basename"]
+            "CREATE INDEX index_meta_basename IF NOT EXISTS FOR (m:Meta) ON (m.basename)",
+            "CREATE INDEX index_meta_year IF NOT EXISTS FOR (m:Meta) ON (m.year)",
+            "CREATE INDEX index_meta_month IF NOT EXISTS FOR (m:Meta) ON (m.month)",
+            "CREATE INDEX index_meta_date IF NOT EXISTS FOR (m:Meta) ON (m.date)",
+            "CREATE INDEX index_speech_id IF NOT EXISTS FOR (s:Speech) ON (s.id)",
+            "CREATE INDEX index_speech_basename IF NOT EXISTS FOR (s:Speech) ON (s.basename)",
+            # context windows are read as ranges of positions within one speech
+            "CREATE INDEX index_sentence_position IF NOT EXISTS FOR (s:Sentence) ON (s.speech_uid, s.index_in_speech)",
+            "CREATE INDEX index_paragraph_position IF NOT EXISTS FOR (p:Paragraph) ON (p.speech_uid, p.index_in_speech)",
+            f"CREATE FULLTEXT INDEX {FULLTEXT_SENTENCE_TEXT} IF NOT EXISTS FOR (s:Sentence) ON EACH [s.text]",
+            f"CREATE FULLTEXT INDEX {FULLTEXT_WD_LABEL} IF NOT EXISTS FOR (w:WDConcept) ON EACH [w.label]",
+            f"CREATE FULLTEXT INDEX {FULLTEXT_AGENDA_NAME} IF NOT EXISTS FOR (a:AgendaItem) ON EACH [a.name]"]
         for index in indices:
             self.execute_query(index)
+        # indexes are populated in the background, also for nodes that already exist
+        self.execute_query_without_transaction(f"CALL db.awaitIndexes({NEO4J_INDEX_TIMEOUT})")
 
     def make_index(self):
         query = """
@@ -175,28 +287,81 @@ class HelloWorldExample:
         """
         self.execute_query(query)
 
-    @staticmethod
-    def _create_or_update_mention(tx, source, target):
-        query = """
-        MERGE (A:Country {name: $source})
-        MERGE (B:Country {name: $target})
-        MERGE (A)-[r:MENTIONED]->(B)
-        ON CREATE SET r.weight = 1
-        ON MATCH  SET r.weight = r.weight + 1
-        """
-        tx.run(query, source=source, target=target)
-
     @staticmethod
     def generate_batches(data, batch_size, batch_desc="BATCH"):
         for i in tqdm(range(0, len(data), batch_size), desc=batch_desc):
             yield data[i:i + batch_size]
 
+    def write_batches(self, query, rows, batch_size=WRITE_BATCH_SIZE, desc="BATCH"):
+        """Runs `query` once per batch of `rows`, which it receives as the list parameter `$rows`."""
+        for batch in self.generate_batches(rows, batch_size, desc):
+            self.execute_query(query, {"rows": batch})
+
+    def load_file(self, path, body, batch_size=5000, delimiter="\t", concurrency=1, group_by=None, loader=None,
+                  parameters=None):
+        """Runs the Cypher `body` for every `row` of the delimited file at `path`, with `parameters` bound. With the
+        csv loader the server reads the file from its import directory, with the bolt loader the rows are sent as
+        parameters.
+
+        Up to `concurrency` bolt batches are written at once. Batches are only cut where the `group_by` column
+        changes, so rows that write the same nodes can be kept in one transaction."""
+        loader = loader or NEO4J_LOADER
+        if loader == "csv":
+            statement = f"""
+            USING PERIODIC COMMIT {batch_size}
+            LOAD CSV WITH HEADERS FROM 'file:///{path}' AS row
+            FIELDTERMINATOR "{delimiter}"
+            {body}
+            """
+            return self.execute_query_without_transaction(statement, parameters)
+        if loader != "bolt":
+            raise ValueError(f"Unknown loader {loader}, expected 'csv' or 'bolt'.")
+        self._stream_file(path, f"UNWIND $rows AS row\n{body}", batch_size, delimiter, concurrency, group_by,
+                          parameters or {})
+
+    def _stream_file(self, path, query, batch_size, delimiter, concurrency, group_by, parameters):
+        # two batches per writer are in flight, so the next one is read while the previous ones are written
+        in_flight = threading.BoundedSemaphore(2 * concurrency)
+        errors = []
+
+        def done(future):
+            in_flight.release()
+            if future.exception() is not None:
+                errors.append(future.exception())
+
+        # the writers count towards the spans of the caller
+        execute = metrics.bind(self.execute_query)
+
+        def submit(batch):
+            in_flight.acquire()
+            if errors:
+                in_flight.release()
+                raise errors[0]
+            pool.submit(execute, query, {**parameters, "rows": batch}).add_done_callback(done)
+
+        with ThreadPoolExecutor(concurrency) as pool, open(path, encoding="utf-8", newline="") as f:
+            batch, key = [], None
+            reader = csv.DictReader(f, delimiter=delimiter)
+            for row in tqdm(reader, total=count_lines_in_file(path) - 1, desc=str(path)):
+                row_key = row[group_by] if group_by else None
+                if len(batch) >= batch_size and (group_by is None or row_key != key):
+                    submit(batch)
+                    batch = []
+                key = row_key
+                # LOAD CSV reads empty fields as null
+                batch.append({column: value if value != "" else None for column, value in row.items()})
+            if batch:
+                submit(batch)
+        if errors:
+            raise errors[0]
+
     def add_batch(self, query, data, batch_size=1000):
         for batch in self.generate_batches(data, batch_size):
+            plan_cache.record(CYPHER, query)
             with self.driver.session() as session:
                 tx = session.begin_transaction()
                 for params in batch:
-                    tx.run(query, params)
+                    metrics.record_summary(tx.run(query, params).consume())
                 tx.commit()
                 tx.close()
 
@@ -208,9 +373,9 @@ class HelloWorldExample:
         self.add_batch(query, data)
 
 
-def connect_graph() -> Optional[HelloWorldExample]:
+def connect_graph(database_name=NEO4J_DATABASE_NAME) -> Optional[HelloWorldExample]:
     try:
-        return HelloWorldExample(NEO4J_BOLT_URL, NEO4J_USER, NEO4J_PASSWORD)
+        return HelloWorldExample(NEO4J_BOLT_URL, NEO4J_USER, NEO4J_PASSWORD, database_name)
     except ServiceUnavailable:
         log(f"Please start neo4j under {NEO4J_BOLT_URL}", LogLevel.ERROR)
         sys.exit(1)
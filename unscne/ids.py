@@ -0,0 +1,124 @@
+import csv
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from config import ID_MAP, PARSED_DATA, PARAGRAPH_META, DBPEDIA_NERS
+from unscne.util import log
+
+SPEECH = "speech"
+PARAGRAPH = "paragraph"
+SENTENCE = "sentence"
+KINDS = (SPEECH, PARAGRAPH, SENTENCE)
+
+
+class IdMap:
+    """Dictionary encodes speech names, p_ids and s_ids as integers. Once assigned, an integer is never reused, so
+    uids stay the same across incremental runs, also for speeches that were removed and come back."""
+
+    def __init__(self, path=ID_MAP):
+        self.path = path
+        self.uids: Dict[str, Dict[str, int]] = {kind: {} for kind in KINDS}
+        self.next_uid = {kind: 1 for kind in KINDS}
+        self.added = 0
+        self.new: List[Tuple[str, int, str]] = []
+        if Path(path).is_file():
+            with open(path, encoding="utf-8", newline="") as f:
+                for row in csv.DictReader(f, delimiter="\t"):
+                    if row["id"] is None:
+                        # a line cut off while `save_new` appended it
+                        continue
+                    uid = int(row["uid"])
+                    self.uids[row["kind"]][row["id"]] = uid
+                    self.next_uid[row["kind"]] = max(self.next_uid[row["kind"]], uid + 1)
+
+    def assign(self, kind: str, key) -> int:
+        key = str(key)
+        uid = self.uids[kind].get(key)
+        if uid is None:
+            uid = self.uids[kind][key] = self.next_uid[kind]
+            self.next_uid[kind] += 1
+            self.added += 1
+            self.new.append((kind, uid, key))
+        return uid
+
+    def get(self, kind: str, key) -> Optional[int]:
+        return self.uids[kind].get(str(key))
+
+    def save(self):
+        if not self.added:
+            return
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w", encoding="utf-8", newline="") as f:
+            writer = csv.writer(f, delimiter="\t")
+            writer.writerow(["kind", "uid", "id"])
+            for kind in KINDS:
+                writer.writerows((kind, uid, key) for key, uid in self.uids[kind].items())
+        Path(tmp).replace(self.path)
+        self.added = 0
+        self.new.clear()
+
+    def save_new(self):
+        """Appends only the uids assigned since the last save, for callers that save after every speech and can't
+        afford to rewrite the whole map each time."""
+        if not Path(self.path).is_file():
+            self.save()
+            return
+        if not self.new:
+            return
+        # a line cut off by a crash is ended first, the loader skips it
+        with open(self.path, "rb") as f:
+            f.seek(-1, 2)
+            cut_off = f.read(1) != b"\n"
+        with open(self.path, "a", encoding="utf-8", newline="") as f:
+            if cut_off:
+                f.write("\r\n")
+            csv.writer(f, delimiter="\t").writerows(self.new)
+        self.added = 0
+        self.new.clear()
+
+
+def paragraph_path_of(p_id) -> str:
+    """The text file of a paragraph, which the intermediates no longer repeat next to its p_id."""
+    return f"{p_id}.txt"
+
+
+def _migrate_columns(path, columns, redundant=()):
+    """Adds the uid `columns` that `path` misses and drops the `redundant` ones, which are derived from other
+    columns. Returns whether the file was rewritten."""
+    if not Path(path).is_file():
+        return False
+    with open(path, encoding="utf-8", newline="") as f:
+        reader = csv.DictReader(f, delimiter="\t")
+        fieldnames = list(reader.fieldnames or [])
+        added = [column for column, _, _ in columns if column not in fieldnames]
+        if not added and not any(column in fieldnames for column in redundant):
+            return False
+        rows = list(reader)
+    tmp = f"{path}.tmp"
+    with open(tmp, "w", encoding="utf-8", newline="") as f:
+        writer = csv.DictWriter(f, [column for column in fieldnames if column not in redundant] + added,
+                                delimiter="\t", extrasaction="ignore")
+        writer.writeheader()
+        for row in rows:
+            for column, kind, key in columns:
+                if column in added:
+                    row[column] = IDS.assign(kind, row[key])
+            writer.writerow(row)
+    Path(tmp).replace(path)
+    return True
+
+
+def add_uids_to_parsed_data():
+    """Migrates main.tsv, paragraph_meta.tsv and ners.tsv written before uids existed: adds the uid columns and
+    drops `s_id` and `paragraph_path` where they only repeat the p_id."""
+    changed = _migrate_columns(PARSED_DATA, [("speech_uid", SPEECH, "speech_name"), ("p_uid", PARAGRAPH, "p_id"),
+                                             ("s_uid", SENTENCE, "s_id")], ("s_id", "paragraph_path"))
+    changed |= _migrate_columns(PARAGRAPH_META, [("p_uid", PARAGRAPH, "p_id")], ("paragraph_path",))
+    changed |= _migrate_columns(DBPEDIA_NERS, [], ("paragraph_path",))
+    if changed:
+        IDS.save()
+        log(f"Migrated {PARSED_DATA}, {PARAGRAPH_META} and {DBPEDIA_NERS} to uids.")
+
+
+IDS = IdMap()
@@ -0,0 +1,288 @@
+import csv
+import hashlib
+import shutil
+from pathlib import Path
+from typing import Dict, Set, Tuple, Iterable
+
+import config
+from unscne import aggregates, load_meta, spacy_ner
+from unscne.graph import HelloWorldExample
+from unscne.ids import IDS, SENTENCE, add_uids_to_parsed_data
+from unscne.load_meta import get_speech_name, get_speech_basename
+from unscne.metrics import metrics
+from unscne.ner import write_dbpedia_annotations_to_graph, check_if_sids_in_ners_inject_if_not
+from unscne.util import log, LogLevel, get_speech_file_paths, load_tsv, dump_tsv, timer
+
+# which inputs of a speech invalidate the output of a stage
+STAGE_INPUTS = {
+    "parse": ("speech",),
+    "annotate": ("speech",),
+    "load": ("speech", "speaker", "meta"),
+}
+
+
+def hash_bytes(data: bytes) -> str:
+    return hashlib.sha1(data).hexdigest()
+
+
+def hash_row(row: Dict[str, str]) -> str:
+    return hash_bytes("\t".join(f"{key}={value}" for key, value in sorted(row.items())).encode("utf-8"))
+
+
+def hash_rows(rows: Iterable[Dict[str, str]]) -> str:
+    """Same as the hash `compute_fingerprints` gives the rows of one speech, if they are all of its rows in file
+    order."""
+    return hash_bytes("".join(hash_row(row) for row in rows).encode("utf-8"))
+
+
+def hash_file(path) -> str:
+    with open(path, "rb") as f:
+        return hash_bytes(f.read())
+
+
+def _hash_rows_by_key(path, key_func) -> Dict[str, str]:
+    rows = {}
+    with open(path, encoding="utf-8") as f:
+        for row in csv.DictReader(f, delimiter="\t"):
+            key = key_func(row)
+            rows[key] = rows.get(key, "") + hash_row(row)
+    return {key: hash_bytes(value.encode("utf-8")) for key, value in rows.items()}
+
+
+def compute_fingerprints() -> Dict[str, Dict[str, str]]:
+    speaker_hashes = _hash_rows_by_key(config.SPEAKER, lambda row: get_speech_name(row["filename"]))
+    meta_hashes = _hash_rows_by_key(config.META, lambda row: row["basename"])
+    fingerprints = {}
+    for path in get_speech_file_paths():
+        speech_name = get_speech_name(path.name)
+        fingerprints[speech_name] = {
+            "speech": hash_file(path),
+            "speaker": speaker_hashes.get(speech_name, ""),
+            "meta": meta_hashes.get(get_speech_basename(speech_name), "")
+        }
+    return fingerprints
+
+
+def stage_digest(fingerprint: Dict[str, str], stage: str) -> str:
+    return hash_bytes("".join(fingerprint[key] for key in STAGE_INPUTS[stage]).encode("utf-8"))
+
+
+def get_manifest_path(stage: str) -> Path:
+    return Path(config.MANIFEST_FOLDER, f"{stage}.tsv")
+
+
+def load_manifest(stage: str) -> Dict[str, str]:
+    path = get_manifest_path(stage)
+    if not path.is_file():
+        return {}
+    return {row["speech_name"]: row["hash"] for row in load_tsv(path)}
+
+
+def diff_stage(stage: str, fingerprints: Dict[str, Dict[str, str]]) -> Tuple[Set[str], Set[str]]:
+    """Returns the speeches that are new or changed since `stage` last ran, and those that were removed."""
+    manifest = load_manifest(stage)
+    changed = {name for name, fingerprint in fingerprints.items()
+               if manifest.get(name) != stage_digest(fingerprint, stage)}
+    removed = set(manifest.keys()) - set(fingerprints.keys())
+    return changed, removed
+
+
+def commit_stage(stage: str, fingerprints: Dict[str, Dict[str, str]]):
+    Path(config.MANIFEST_FOLDER).mkdir(parents=True, exist_ok=True)
+    rows = [{"speech_name": name, "hash": stage_digest(fingerprint, stage)}
+            for name, fingerprint in sorted(fingerprints.items())]
+    dump_tsv(get_manifest_path(stage), rows, ["speech_name", "hash"])
+
+
+def update_manifest(stage: str, fingerprints: Dict[str, Dict[str, str]]):
+    """Records `fingerprints` of some speeches in the manifest of `stage` and keeps the others. A manifest that
+    does not exist yet is not started, as `invalidate_annotations` would then drop the annotations of every speech
+    missing from it."""
+    path = get_manifest_path(stage)
+    if not path.is_file():
+        return
+    manifest = load_manifest(stage)
+    manifest.update((name, stage_digest(fingerprint, stage)) for name, fingerprint in fingerprints.items())
+    tmp = f"{path}.tmp"
+    dump_tsv(tmp, [{"speech_name": name, "hash": digest} for name, digest in sorted(manifest.items())],
+             ["speech_name", "hash"])
+    Path(tmp).replace(path)
+
+
+def record_baseline():
+    log("Recording current inputs as processed for all stages..")
+    fingerprints = compute_fingerprints()
+    for stage in STAGE_INPUTS.keys():
+        commit_stage(stage, fingerprints)
+    log("Done.")
+
+
+def speech_name_of_paragraph(p_id: str) -> str:
+    return Path(p_id).parent.name
+
+
+def filter_tsv(source, target, keep) -> int:
+    kept = 0
+    with open(source, encoding="utf-8") as inf, open(target, "w", encoding="utf-8") as outf:
+        reader = csv.DictReader(inf, delimiter="\t")
+        writer = csv.DictWriter(outf, reader.fieldnames, delimiter="\t")
+        writer.writeheader()
+        for row in reader:
+            if keep(row):
+                writer.writerow(row)
+                kept += 1
+    return kept
+
+
+def _replace_with_filtered(path, keep):
+    tmp = f"{path}.tmp"
+    filter_tsv(path, tmp, keep)
+    shutil.move(tmp, path)
+
+
+def update_parsed_data():
+    fingerprints = compute_fingerprints()
+    changed, removed = diff_stage("parse", fingerprints)
+    metrics.incr("parse.speeches_unchanged", len(fingerprints) - len(changed))
+    if not changed and not removed:
+        log("Parsed data is up to date.")
+        return
+    log(f"Parsing {len(changed)} new or changed speeches, dropping {len(removed)} removed ones..")
+    if Path(config.PARSED_DATA).is_file():
+        add_uids_to_parsed_data()
+        load_meta.add_positions_to_parsed_data()
+    stale = changed | removed
+    for speech_name in removed:
+        shutil.rmtree(Path(config.PARAGRAPHS_PATH, speech_name), ignore_errors=True)
+    new_indices, new_paragraphs = [], []
+    for path in get_speech_file_paths():
+        if get_speech_name(path.name) in changed:
+            shutil.rmtree(Path(config.PARAGRAPHS_PATH, get_speech_name(path.name)), ignore_errors=True)
+            speech_indices, speech_paragraphs = load_meta.parse_speech_file(path)
+            new_indices.extend(speech_indices)
+            new_paragraphs.extend(speech_paragraphs)
+    if Path(config.PARSED_DATA).is_file():
+        _replace_with_filtered(config.PARSED_DATA, lambda row: row["speech_name"] not in stale)
+        _replace_with_filtered(config.PARAGRAPH_META, lambda row: speech_name_of_paragraph(row["p_id"]) not in stale)
+    _append_tsv(config.PARSED_DATA, new_indices)
+    _append_tsv(config.PARAGRAPH_META, new_paragraphs)
+    IDS.save()
+    commit_stage("parse", fingerprints)
+    log("Done.")
+
+
+def _append_tsv(path, rows):
+    if not rows:
+        return
+    exists = Path(path).is_file()
+    with open(path, "a", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, list(rows[0].keys()), delimiter="\t")
+        if not exists:
+            writer.writeheader()
+        for row in rows:
+            writer.writerow(row)
+
+
+def invalidate_annotations():
+    """Drops the NER rows of new, changed or removed speeches so the resumable annotation picks them up again."""
+    fingerprints = compute_fingerprints()
+    if not get_manifest_path("annotate").is_file():
+        # nothing recorded yet, keep whatever a previous (possibly unfinished) run annotated
+        return fingerprints
+    changed, removed = diff_stage("annotate", fingerprints)
+    stale = changed | removed
+    if stale and Path(config.DBPEDIA_NERS).is_file():
+        log(f"Invalidating annotations of {len(stale)} speeches..")
+        _replace_with_filtered(config.DBPEDIA_NERS, lambda row: speech_name_of_paragraph(row["p_id"]) not in stale)
+    if stale and Path(config.SPACY_SENTIMENT).is_file():
+        # uids follow the s_id, so a changed sentence keeps its uid and would keep its old spaCy annotations
+        spacy_ner.migrate_spacy_files()
+        s_uids = {str(uid) for s_id, uid in IDS.uids[SENTENCE].items() if speech_name_of_paragraph(s_id) in stale}
+        for path in (config.SPACY_ENTITIES, config.SPACY_SENTIMENT):
+            if Path(path).is_file():
+                _replace_with_filtered(path, lambda row: row["s_uid"] not in s_uids)
+    # otherwise the changed paragraphs would be skipped as empty or failed
+    for path in (config.ANNOTATION_STATUS, config.ANNOTATION_DEAD_LETTER):
+        if stale and Path(path).is_file():
+            _replace_with_filtered(path, lambda row: speech_name_of_paragraph(row["p_id"]) not in stale)
+    return fingerprints
+
+
+def _write_delta(source, name, keep) -> str:
+    Path(config.DELTA_FOLDER).mkdir(parents=True, exist_ok=True)
+    target = str(Path(config.DELTA_FOLDER, name))
+    filter_tsv(source, target, keep)
+    return target
+
+
+DELETE_SPEECHES_QUERY = """
+UNWIND $speeches AS name
+MATCH (sp:Speech {id: name})
+OPTIONAL MATCH (sp)-[:CONTAINS]->(x)
+WITH sp, collect(x) AS contained
+FOREACH (x IN contained | DETACH DELETE x)
+DETACH DELETE sp
+"""
+
+
+def _delete_speeches(graph: HelloWorldExample, speech_names: Iterable[str]):
+    for batch in graph.generate_batches(sorted(speech_names), 100, "Deleting speeches"):
+        graph.execute_query(DELETE_SPEECHES_QUERY, {"speeches": batch})
+
+
+def _delete_meta(graph: HelloWorldExample, basenames: Iterable[str]):
+    graph.execute_query("MATCH (m:Meta) WHERE m.basename IN $basenames DETACH DELETE m",
+                        {"basenames": list(basenames)})
+
+
+@timer
+def update_graph(graph: HelloWorldExample):
+    fingerprints = compute_fingerprints()
+    if not get_manifest_path("load").is_file():
+        log(f"No manifest found in {config.MANIFEST_FOLDER}, every speech will be reloaded. "
+            f"Run `python make.py baseline` first if the graph is already built.", LogLevel.WARNING)
+    changed, removed = diff_stage("load", fingerprints)
+    metrics.incr("load.speeches_unchanged", len(fingerprints) - len(changed))
+    if not changed and not removed:
+        log("Graph is up to date.")
+        return
+    log(f"Upserting {len(changed)} new or changed speeches, removing {len(removed)}..")
+    speeches = sorted(changed)
+    basenames = sorted({get_speech_basename(name) for name in changed})
+    main = _write_delta(config.PARSED_DATA, "main.tsv", lambda row: row["speech_name"] in changed)
+    speaker = _write_delta(config.SPEAKER, "speaker.tsv", lambda row: get_speech_name(row["filename"]) in changed)
+    meta = _write_delta(config.META, "meta.tsv", lambda row: row["basename"] in basenames)
+
+    # the aggregates of the institutions and years of the old versions have to be refreshed as well
+    sources, years = aggregates.get_aggregate_keys(graph, changed | removed)
+    sources.update(row["country"] for row in load_tsv(speaker) if row["country"])
+    years.update(row["year"] for row in load_tsv(meta) if row["year"])
+    _delete_speeches(graph, changed | removed)
+    _delete_meta(graph, basenames)
+    load_meta.load_metadata_into_graph(graph, meta)
+    load_meta.load_sentences_into_graph(graph, main)
+    load_meta.link_meta_to_speeches(graph, basenames)
+    load_meta.create_next_speech_relation(graph, basenames)
+    load_meta.create_next_sentence_relation(graph, speeches)
+    load_meta.create_next_paragraph_relation(graph, speeches)
+    load_meta.add_speech_meta_to_nodes(graph, speaker)
+    load_meta.link_paragraph_and_sentence_to_speakers(graph, speeches)
+    load_meta.add_president_label(graph)
+    if Path(config.DBPEDIA_NERS).is_file():
+        check_if_sids_in_ners_inject_if_not()
+        ners = _write_delta(config.DBPEDIA_NERS, "ners.tsv",
+                            lambda row: speech_name_of_paragraph(row["p_id"]) in changed)
+        write_dbpedia_annotations_to_graph(graph, ners)
+    else:
+        log(f"File with DBpedia annotations does not exist ({config.DBPEDIA_NERS}).", LogLevel.WARNING)
+    # deleting the sentences dropped their spaCy annotations as well
+    if Path(config.SPACY_SENTIMENT).is_file():
+        spacy_ner.migrate_spacy_files()
+        s_uids = {row["s_uid"] for row in load_tsv(main)}
+        spacy_ner.load_spacy_annotations_into_graph(
+            graph, _write_delta(config.SPACY_ENTITIES, "spacy_entities.tsv", lambda row: row["s_uid"] in s_uids),
+            _write_delta(config.SPACY_SENTIMENT, "spacy_sentiment.tsv", lambda row: row["s_uid"] in s_uids))
+    if graph.select("MATCH (y:Year) RETURN y LIMIT 1"):
+        aggregates.write_aggregates(graph, sources, years)
+    commit_stage("load", fingerprints)
+    log("Done.")
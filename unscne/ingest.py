@@ -0,0 +1,484 @@
+import csv
+import json
+import re
+import shutil
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Dict, List, NamedTuple, Optional, Tuple
+from urllib.parse import parse_qs, unquote, urlparse
+
+import config
+from unscne import load_meta
+from unscne.annotation_status import AnnotationStatus
+from unscne.graph import HelloWorldExample
+from unscne.ids import IDS, SENTENCE, add_uids_to_parsed_data
+from unscne.incremental import DELETE_SPEECHES_QUERY, filter_tsv, hash_file, hash_rows, speech_name_of_paragraph, \
+    update_manifest
+from unscne.mention_filters import MentionFilter
+from unscne.metrics import metrics
+from unscne.ner import WRITE_MENTIONS_QUERY, LINK_WIKIDATA_QUERY, annotate_paragraphs, get_ner_header, \
+    get_wikidata_equivalent_for_dbpedia_uri, http, make_mention_row, make_ner_row, ners_have_sids
+from unscne.statements import INSTITUTION_ENTITY, LOAD_SENTENCES, cypher_name
+from unscne.util import log, LogLevel, load_tsv
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+PROCESSING = "processing"
+
+COUNTRY = "Country"
+# <basename>_<speech>.txt, the basename names the meeting in meta.tsv
+SPEECH_FILENAME = re.compile(r"^[^/\\]+_[^/\\_]+\.txt$")
+
+SENTENCES_QUERY = f"UNWIND $rows AS row\n{LOAD_SENTENCES.text}"
+PRESIDENT_QUERY = f"""
+UNWIND $rows AS row
+MATCH (s:Speaker {load_meta.SPEAKER_KEY})
+WHERE s.participanttype = "The President"
+SET s :President
+"""
+CONCEPTS_QUERY = "UNWIND $rows AS uri MERGE (:DBConcept {uri: uri})"
+LINKS_QUERY = f"UNWIND $rows AS row\n{LINK_WIKIDATA_QUERY}"
+COUNTRIES_QUERY = f"UNWIND $rows AS row\n{INSTITUTION_ENTITY.text % cypher_name(COUNTRY)}"
+
+
+class IngestError(ValueError):
+    """A submitted speech that can't be ingested as it is."""
+
+
+class IngestBusy(Exception):
+    pass
+
+
+class Submission(NamedTuple):
+    filename: str
+    text: str
+    speaker: List[Dict[str, str]]
+    meta: Dict[str, str]
+
+    @property
+    def speech_name(self) -> str:
+        return load_meta.get_speech_name(self.filename)
+
+    @property
+    def basename(self) -> str:
+        return load_meta.get_speech_basename(self.speech_name)
+
+
+def _text_row(row: Dict) -> Dict[str, str]:
+    return {key: "" if value is None else str(value) for key, value in row.items()}
+
+
+def parse_submission(payload) -> Submission:
+    """Checks a submitted speech, a JSON object with the `filename` and `text` of the speech file, its `speaker`
+    row (or rows) of speaker.tsv and the `meta` row of its meeting in meta.tsv. The filename and basename columns
+    of the rows can be left out."""
+    if not isinstance(payload, dict):
+        raise IngestError("Expected a JSON object.")
+    filename = payload.get("filename")
+    if not isinstance(filename, str) or not SPEECH_FILENAME.match(filename):
+        raise IngestError(f"Not a speech filename: {filename!r}, expected <basename>_<speech>.txt.")
+    text = payload.get("text")
+    if not isinstance(text, str) or not text.strip():
+        raise IngestError(f"{filename} has no text.")
+    speaker = payload.get("speaker")
+    if isinstance(speaker, dict):
+        speaker = [speaker]
+    if not speaker or not isinstance(speaker, list) or not all(isinstance(row, dict) for row in speaker):
+        raise IngestError(f"Expected the speaker.tsv rows of {filename}.")
+    meta = payload.get("meta")
+    if not isinstance(meta, dict):
+        raise IngestError(f"Expected the meta.tsv row of {filename}.")
+    submission = Submission(filename, text, [_text_row({"filename": filename, **row}) for row in speaker],
+                            _text_row({"basename": "", **meta}))
+    if any(row["filename"] != filename for row in submission.speaker):
+        raise IngestError(f"The speaker rows belong to another speech than {filename}.")
+    if submission.meta["basename"] not in ("", submission.basename):
+        raise IngestError(f"The meta row belongs to another meeting than {submission.basename}.")
+    submission.meta["basename"] = submission.basename
+    return submission
+
+
+def _read_header(path) -> Optional[List[str]]:
+    if not Path(path).is_file() or Path(path).stat().st_size == 0:
+        return None
+    with open(path, encoding="utf-8", newline="") as f:
+        return next(csv.reader(f, delimiter="\t"))
+
+
+def _append_rows(path, rows, fieldnames=None):
+    """Appends `rows` under the header the file already has, columns it does not have are left out."""
+    if not rows:
+        return
+    header = _read_header(path)
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "a", encoding="utf-8", newline="") as f:
+        writer = csv.DictWriter(f, header or fieldnames or list(rows[0].keys()), delimiter="\t", restval="",
+                                extrasaction="ignore")
+        if header is None:
+            writer.writeheader()
+        writer.writerows(rows)
+
+
+def _drop_rows(path, drop):
+    if not Path(path).is_file():
+        return
+    tmp = f"{path}.tmp"
+    filter_tsv(path, tmp, lambda row: not drop(row))
+    Path(tmp).replace(path)
+
+
+def _replace_rows(path, rows: List[Dict[str, str]], belongs) -> List[Dict[str, str]]:
+    """Makes `rows` the rows of `path` that `belongs` to a speech or meeting. Returns them in the columns of the
+    file, as they are read back from it."""
+    header = _read_header(path) or list(rows[0].keys())
+    rows = [{key: row.get(key, "") for key in header} for row in rows]
+    existing = []
+    if Path(path).is_file():
+        with open(path, encoding="utf-8", newline="") as f:
+            existing = [row for row in csv.DictReader(f, delimiter="\t") if belongs(row)]
+    if existing == rows:
+        return rows
+    if existing:
+        _drop_rows(path, belongs)
+    _append_rows(path, rows, header)
+    return rows
+
+
+def load_country_mapping(path=config.COUNTRY_MAPPING) -> Dict[str, List[str]]:
+    countries: Dict[str, List[str]] = {}
+    if Path(path).is_file():
+        for row in load_tsv(path, delimiter=";"):
+            countries.setdefault(row[COUNTRY], []).append(row["uri"])
+    return countries
+
+
+class LinkCache:
+    """DBpedia -> Wikidata links of the concepts seen before, from the consolidated links and the link dump. New
+    concepts are looked up once and added to the dump, ambiguous ones also to the file for manual annotation, so
+    finalize.py consolidates them like all others. Only unambiguous links are written to the graph right away."""
+
+    def __init__(self, consolidated=config.DBPEDIA_TO_WIKIDATA_INTERNAL, dump=config.DBPEDIA_TO_WIKIDATA,
+                 ambiguous=config.DBPEDIA_TO_WIKIDATA_AMBIGUOUS):
+        self.dump = dump
+        self.ambiguous = ambiguous
+        self.links: Dict[str, str] = {}
+        self.candidates: Dict[str, List[str]] = {}
+        self._lock = threading.Lock()
+        if Path(dump).is_file():
+            for row in load_tsv(dump):
+                self.candidates.setdefault(row["db_uri"], []).append(row["wd_uri"])
+        if Path(consolidated).is_file():
+            self.links = {row["db_uri"]: row["wd_uri"] for row in load_tsv(consolidated)}
+
+    def _add(self, uri: str, candidates: List[str]):
+        with self._lock:
+            if uri in self.candidates:
+                return
+            self.candidates[uri] = candidates
+            # without a dump finalize.py looks up every concept of the graph anyway
+            if not candidates or not Path(self.dump).is_file():
+                return
+            rows = [{"db_uri": uri, "wd_uri": candidate, "keep": ""} for candidate in candidates]
+            _append_rows(self.dump, rows)
+            if len(candidates) > 1:
+                _append_rows(self.ambiguous, rows)
+
+    def resolve(self, uri: str) -> Optional[str]:
+        if uri in self.links:
+            metrics.incr("ingest.link_cache_hits")
+            return self.links[uri]
+        candidates = self.candidates.get(uri)
+        if candidates is None:
+            metrics.incr("ingest.link_lookups")
+            candidates = list(dict.fromkeys(get_wikidata_equivalent_for_dbpedia_uri(uri, http)))
+            self._add(uri, candidates)
+        else:
+            metrics.incr("ingest.link_cache_hits")
+        if len(candidates) > 1:
+            metrics.incr("ingest.links_ambiguous")
+        return candidates[0] if len(candidates) == 1 else None
+
+    def lookup(self, uris) -> List[Dict[str, str]]:
+        links = []
+        for uri in uris:
+            wd_uri = self.resolve(uri)
+            if wd_uri is not None:
+                links.append({"db_uri": uri, "wd_uri": wd_uri})
+        return links
+
+
+class Ingestor:
+    """Ingests single speeches: stores the inputs, splits the speech, annotates it with Spotlight, links the concepts
+    from the cached lookups and upserts its subgraph in one transaction. Up to `workers` speeches are ingested at
+    once and `backlog` more wait for a worker. Parsing, which assigns uids and appends to the intermediates, and
+    writing the annotations each take a lock. The requests and graph writes of different speeches run concurrently.
+
+    The results are also appended to the intermediates and recorded in the parse and annotate manifests, so
+    `make.py update` doesn't redo them. The load manifest is left alone: `build.py update` upserts the speeches
+    once more and refreshes the aggregates they touch."""
+
+    def __init__(self, graph: HelloWorldExample, workers=config.INGEST_WORKERS, backlog=config.INGEST_BACKLOG,
+                 history=config.INGEST_JOB_HISTORY):
+        self.graph = graph
+        self.workers = workers
+        self.history = history
+        if Path(config.PARSED_DATA).is_file():
+            add_uids_to_parsed_data()
+            load_meta.add_positions_to_parsed_data()
+        self.status = AnnotationStatus()
+        self.links = LinkCache()
+        self.countries = load_country_mapping()
+        # rows follow ners.tsv, once s_ids were injected offsets are relative to the sentence
+        self.sids_injected = ners_have_sids()
+        self.jobs: "OrderedDict[str, Dict]" = OrderedDict()
+        self._pool = ThreadPoolExecutor(workers)
+        self._slots = threading.BoundedSemaphore(workers + backlog)
+        self._parse_lock = threading.Lock()
+        self._ner_lock = threading.Lock()
+        self._jobs_lock = threading.Lock()
+        self._speech_locks: Dict[str, threading.Lock] = defaultdict(threading.Lock)
+
+    def _store(self, submission: Submission) -> Tuple[Submission, Path, Dict[str, str]]:
+        """Writes the speech file and its rows in speaker.tsv and meta.tsv, returns the rows as stored and the
+        fingerprint of the speech."""
+        Path(config.SPEECHES_FOLDER).mkdir(parents=True, exist_ok=True)
+        path = Path(config.SPEECHES_FOLDER, submission.filename)
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(submission.text)
+        speaker = _replace_rows(config.SPEAKER, submission.speaker,
+                                lambda row: row["filename"] == submission.filename)
+        meta = _replace_rows(config.META, [submission.meta], lambda row: row["basename"] == submission.basename)
+        fingerprint = {"speech": hash_file(path), "speaker": hash_rows(speaker), "meta": hash_rows(meta)}
+        return submission._replace(speaker=speaker, meta=meta[0]), path, fingerprint
+
+    def _parse(self, speech_name: str, path: Path):
+        if Path(config.PARAGRAPHS_PATH, speech_name).is_dir():
+            log(f"{speech_name} was parsed before, replacing it rewrites the intermediates..", LogLevel.WARNING)
+            shutil.rmtree(Path(config.PARAGRAPHS_PATH, speech_name))
+            _drop_rows(config.PARSED_DATA, lambda row: row["speech_name"] == speech_name)
+            _drop_rows(config.PARAGRAPH_META, lambda row: speech_name_of_paragraph(row["p_id"]) == speech_name)
+            with self._ner_lock:
+                _drop_rows(config.DBPEDIA_NERS, lambda row: speech_name_of_paragraph(row["p_id"]) == speech_name)
+        indices, paragraphs = load_meta.parse_speech_file(path)
+        # uids have to be saved before any row refers to them
+        IDS.save_new()
+        _append_rows(config.PARSED_DATA, indices)
+        _append_rows(config.PARAGRAPH_META, paragraphs, ["p_id", "p_uid"])
+        return indices, paragraphs
+
+    def _annotate(self, paragraphs) -> Tuple[List[Dict], int]:
+        """Annotates the paragraphs and appends the results to ners.tsv. Returns the mentions with their s_id and
+        the number of paragraphs that failed, which are left to `make.py retry-failed`."""
+        results = annotate_paragraphs(paragraphs, self.status)
+        rows, mentions = [], []
+        for _, entries in results:
+            for paragraph_meta, ner in entries:
+                rows.append(make_ner_row(paragraph_meta, dict(ner), self.sids_injected))
+                if not self.sids_injected:
+                    mentions.append(make_ner_row(paragraph_meta, dict(ner), True))
+        with self._ner_lock:
+            _append_rows(config.DBPEDIA_NERS, rows, get_ner_header(self.sids_injected))
+            for batch, entries in results:
+                self.status.record_annotated(batch, entries)
+        failed = len(paragraphs) - sum(len(batch) for batch, _ in results)
+        return rows if self.sids_injected else mentions, failed
+
+    def _statements(self, submission: Submission, indices, mentions, links, countries):
+        speeches = {"speeches": [submission.speech_name]}
+        basenames = {"basenames": [submission.basename]}
+        # ingested sentences keep their full text, the text store only holds what make.py put into it
+        sentences = {"rows": [{key: str(value) for key, value in row.items()} for row in indices], "compact": False,
+                     "preview_characters": config.TEXT_PREVIEW_CHARACTERS}
+        statements = [(DELETE_SPEECHES_QUERY, speeches),
+                      (load_meta.UPSERT_META, {"rows": [submission.meta]}),
+                      (SENTENCES_QUERY, sentences),
+                      (load_meta.LINK_META_SCOPED, basenames),
+                      (load_meta.NEXT_SPEECH_SCOPED, basenames),
+                      (load_meta.NEXT_SENTENCE_SCOPED, speeches),
+                      (load_meta.NEXT_PARAGRAPH_SCOPED, speeches)]
+        meta = load_meta.collect_speech_meta(submission.speaker)
+        statements.extend((query, {"rows": rows}) for _, query, rows in load_meta.speech_meta_statements(meta) if rows)
+        statements.append((load_meta.SPOKE_SCOPED, speeches))
+        statements.append((PRESIDENT_QUERY, {"rows": meta["speakers"]}))
+        if mentions:
+            statements.append((CONCEPTS_QUERY, {"rows": sorted({mention["uri"] for mention in mentions})}))
+            statements.append((WRITE_MENTIONS_QUERY, {"rows": mentions}))
+        if links:
+            statements.append((LINKS_QUERY, {"rows": links}))
+        if countries:
+            statements.append((COUNTRIES_QUERY, {"rows": countries, "column": COUNTRY}))
+        return statements
+
+    def ingest(self, submission: Submission) -> Dict[str, int]:
+        speech_name = submission.speech_name
+        with self._parse_lock:
+            submission, path, fingerprint = self._store(submission)
+            indices, paragraphs = self._parse(speech_name, path)
+        ners, failed = self._annotate(paragraphs)
+        mention_filter = MentionFilter()
+        mentions = []
+        for row in mention_filter.filter(ners):
+            s_uid = IDS.get(SENTENCE, row["s_id"])
+            if s_uid is None:
+                metrics.incr("mentions.unknown_sentence")
+                continue
+            mentions.append(make_mention_row(row, s_uid))
+        links = self.links.lookup(sorted({mention["uri"] for mention in mentions}))
+        countries = [{COUNTRY: row["name"], "uri": uri} for row in load_meta.collect_speech_meta(
+            submission.speaker)["institutions"] for uri in self.countries.get(row["name"], [])]
+        self.graph.execute_transaction(self._statements(submission, indices, mentions, links, countries))
+        with self._parse_lock:
+            for stage in ("parse", "annotate"):
+                update_manifest(stage, {speech_name: fingerprint})
+        return {"paragraphs": len(paragraphs), "sentences": len(indices), "mentions": len(mentions),
+                "links": len(links), "failed_paragraphs": failed}
+
+    def _run(self, submission: Submission, job: Dict) -> Dict:
+        with self._jobs_lock:
+            lock = self._speech_locks[submission.speech_name]
+        # two versions of the same speech are ingested one after the other
+        with lock:
+            job["state"] = RUNNING
+            start = time.perf_counter()
+            try:
+                job.update(self.ingest(submission))
+            except Exception as e:
+                job.update(state=FAILED, error=f"{type(e).__name__}: {e}",
+                           seconds=round(time.perf_counter() - start, 3))
+                metrics.incr("ingest.speeches_failed")
+                log(f"Could not ingest {submission.filename}: {e}", LogLevel.ERROR)
+                raise
+            job.update(state=DONE, seconds=round(time.perf_counter() - start, 3))
+        metrics.incr("ingest.speeches")
+        metrics.observe("ingest.seconds", job["seconds"])
+        return job
+
+    def submit(self, submission: Submission, block=False) -> Tuple[Dict, Future]:
+        """Queues `submission` and returns its job, which is updated as it progresses, and the future of its run.
+        Raises IngestBusy if the backlog is full, unless `block` waits for a free place."""
+        if not self._slots.acquire(blocking=block):
+            metrics.incr("ingest.rejected")
+            raise IngestBusy(f"{self.workers} speeches are being ingested and the backlog is full.")
+        job = {"speech": submission.speech_name, "state": QUEUED, "submitted": time.time()}
+        with self._jobs_lock:
+            self.jobs.pop(submission.speech_name, None)
+            self.jobs[submission.speech_name] = job
+            while len(self.jobs) > self.history:
+                self.jobs.popitem(last=False)
+        future = self._pool.submit(self._run, submission, job)
+        future.add_done_callback(lambda _: self._slots.release())
+        return job, future
+
+    def job(self, speech_name: str) -> Optional[Dict]:
+        with self._jobs_lock:
+            job = self.jobs.get(speech_name)
+            return dict(job) if job is not None else None
+
+    def health(self) -> Dict:
+        with self._jobs_lock:
+            states = [job["state"] for job in self.jobs.values()]
+        return {"workers": self.workers, **{state: states.count(state) for state in (QUEUED, RUNNING, DONE, FAILED)}}
+
+    def close(self):
+        self._pool.shutdown(wait=True)
+        self.status.compact()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    ingestor: Ingestor = None
+
+    def _reply(self, code: int, body, headers=None):
+        data = json.dumps(body, default=str).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        path = urlparse(self.path).path.rstrip("/")
+        if path == "/health":
+            self._reply(200, self.ingestor.health())
+        elif path.startswith("/speeches/"):
+            job = self.ingestor.job(unquote(path[len("/speeches/"):]))
+            if job is None:
+                self._reply(404, {"error": "Unknown speech."})
+            else:
+                self._reply(200, job)
+        else:
+            self._reply(404, {"error": "Not found."})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path.rstrip("/") != "/speeches":
+            self._reply(404, {"error": "Not found."})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            submission = parse_submission(json.loads(self.rfile.read(length)))
+        except ValueError as e:
+            self._reply(400, {"error": str(e)})
+            return
+        try:
+            job, future = self.ingestor.submit(submission)
+        except IngestBusy as e:
+            self._reply(503, {"error": str(e)}, {"Retry-After": "1"})
+            return
+        # ?wait=0 only queues the speech, its status is at /speeches/<speech_name>
+        if parse_qs(url.query).get("wait", ["1"])[0] != "0":
+            wait([future], timeout=config.INGEST_WAIT_SECONDS)
+        self._reply({DONE: 200, FAILED: 500}.get(job["state"], 202), dict(job))
+
+
+def serve_http(ingestor: Ingestor, host=config.INGEST_HOST, port=config.INGEST_PORT):
+    handler = type("IngestHandler", (_Handler,), {"ingestor": ingestor})
+    server = ThreadingHTTPServer((host, port), handler)
+    log(f"Accepting speeches at http://{host}:{port}/speeches..")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+def _settle(claimed: Path, outcome: str, error: Optional[BaseException] = None):
+    target = Path(claimed.parent.parent, outcome, claimed.name)
+    claimed.replace(target)
+    if error is not None:
+        with open(f"{target}.error", "w", encoding="utf-8") as f:
+            f.write(f"{type(error).__name__}: {error}\n")
+
+
+def watch_inbox(ingestor: Ingestor, folder=config.INGEST_INBOX, interval=config.INGEST_POLL_SECONDS,
+                stop: Optional[threading.Event] = None):
+    """Ingests the speeches dropped into `folder` as JSON files with the same content as a POST to /speeches.
+    Write them under another name first and rename them to `*.json`, so they are never picked up half written."""
+    stop = stop or threading.Event()
+    inbox = Path(folder)
+    for name in (PROCESSING, DONE, FAILED):
+        Path(inbox, name).mkdir(parents=True, exist_ok=True)
+    # files claimed by an interrupted run are picked up again
+    for path in Path(inbox, PROCESSING).glob("*.json"):
+        path.replace(Path(inbox, path.name))
+    log(f"Watching {inbox} for speeches..")
+    while not stop.is_set():
+        for path in sorted(inbox.glob("*.json")):
+            claimed = Path(inbox, PROCESSING, path.name)
+            path.replace(claimed)
+            try:
+                with open(claimed, encoding="utf-8") as f:
+                    submission = parse_submission(json.load(f))
+            except ValueError as e:
+                _settle(claimed, FAILED, e)
+                continue
+            _, future = ingestor.submit(submission, block=True)
+            future.add_done_callback(lambda future, claimed=claimed: _settle(
+                claimed, DONE if future.exception() is None else FAILED, future.exception()))
+        stop.wait(interval)
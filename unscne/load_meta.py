@@ -1,29 +1,44 @@
+import os
 import re
-from typing import List
+from pathlib import Path
+from typing import Dict, List, Tuple
 
 from tqdm import tqdm
 
 import config
 from unscne.graph import HelloWorldExample
+from unscne.ids import IDS, SPEECH, PARAGRAPH, SENTENCE, add_uids_to_parsed_data, paragraph_path_of
+from unscne.statements import LOAD_SENTENCES
 import csv
 
-from unscne.util import timer, log, sentence_splitter, count_lines_in_file, dump_tsv
+from unscne.util import timer, log, sentence_splitter, count_lines_in_file, dump_tsv, remove_initial_stub, load_file, \
+    write_to_path, get_number_of_files_in_path, LogLevel, load_tsv
 
 
 @timer
-def load_metadata_into_graph(graph: HelloWorldExample):
-    add_meta_query = f"""
-    USING PERIODIC COMMIT 1000
-    LOAD CSV WITH HEADERS FROM 'file:///{config.META}' AS row
-    FIELDTERMINATOR "\t"
-    CREATE (n:Meta {{basename: row.basename, date: row.date, num_speeches: row.num_speeches, topic: row.topic,
-pressrelease: row.pressrelease, outcome: row.outcome, year: row.year, month: row.month, day : row.day}})
+def load_metadata_into_graph(graph: HelloWorldExample, file_path=config.META):
+    # merged, so the stage can be rerun on top of an earlier load
+    add_meta_query = """
+    MERGE (n:Meta {basename: row.basename})
+    SET n.date = CASE WHEN row.date <> "" THEN date(row.date) END, n.num_speeches = row.num_speeches,
+n.topic = row.topic, n.pressrelease = row.pressrelease, n.outcome = row.outcome, n.year = toInteger(row.year),
+n.month = toInteger(row.month), n.day = toInteger(row.day)
     """
     log("Loading metadata..")
-    graph.execute_query_without_transaction(add_meta_query)
+    graph.load_file(file_path, add_meta_query, 1000, concurrency=config.BOLT_WRITERS)
     log("Done.")
 
 
+# the Meta node of a meeting is shared by all of its speeches, so single speeches update it in place
+UPSERT_META = """
+UNWIND $rows AS row
+MERGE (m:Meta {basename: row.basename})
+SET m.date = CASE WHEN row.date <> "" THEN date(row.date) END, m.num_speeches = row.num_speeches,
+    m.topic = row.topic, m.pressrelease = row.pressrelease, m.outcome = row.outcome, m.year = toInteger(row.year),
+    m.month = toInteger(row.month), m.day = toInteger(row.day)
+"""
+
+
 def get_fieldnames_in_file(file, delimiter="\t"):
     fieldnames = None
     with open(file, encoding="utf-8") as f:
@@ -32,50 +47,98 @@ def get_fieldnames_in_file(file, delimiter="\t"):
     return fieldnames
 
 
-def link_meta_to_speeches(graph):
+# the relations of only some speeches or meetings, for updates and single speeches
+LINK_META_SCOPED = """
+MATCH (m:Meta) WHERE m.basename IN $basenames
+MATCH (s:Speech) WHERE s.basename = m.basename
+MERGE (s)-[:HAS_METADATA]->(m)
+"""
+
+NEXT_SPEECH_SCOPED = """
+MATCH (m:Meta) WHERE m.basename IN $basenames
+MATCH (s1:Speech)-[:HAS_METADATA]->(m)<-[:HAS_METADATA]-(s2:Speech)
+WHERE toInteger(s1.index) = toInteger(s2.index)-1
+MERGE (s1)-[:NEXT]->(s2)
+"""
+
+NEXT_PARAGRAPH_SCOPED = """
+MATCH (s:Speech) WHERE s.id IN $speeches
+MATCH (p2:Paragraph)<-[:CONTAINS]-(s)-[:CONTAINS]->(p1:Paragraph)
+WHERE toInteger(p1.index) = toInteger(p2.index)-1
+MERGE (p1)-[:NEXT]->(p2)
+"""
+
+NEXT_SENTENCE_SCOPED = """
+MATCH (sp:Speech)-[:CONTAINS]->(p:Paragraph) WHERE sp.id IN $speeches
+MATCH (s1:Sentence)<-[:CONTAINS]-(p)-[:CONTAINS]->(s2:Sentence)
+WHERE toInteger(s1.index) = toInteger(s2.index)-1
+MERGE (s1)-[:NEXT]->(s2)
+"""
+
+SPOKE_SCOPED = """
+MATCH (speech:Speech) WHERE speech.id IN $speeches
+MATCH (speak:Speaker)-[:SPOKE]->(speech)-[:CONTAINS]->(p:Paragraph)-[:CONTAINS]->(s:Sentence)
+MERGE (speak)-[:SPOKE]->(p)
+MERGE (speak)-[:SPOKE]->(s)
+"""
+
+
+def link_meta_to_speeches(graph, basenames=None):
     log("Linking speeches to their Metadata..")
     query = """
     MATCH (s:Speech), (m:Meta)
     WHERE s.basename = m.basename
-    CREATE (s)-[:HAS_METADATA]->(m)
+    MERGE (s)-[:HAS_METADATA]->(m)
     """
-    graph.execute_query(query)
+    if basenames is None:
+        graph.execute_query(query)
+    else:
+        graph.execute_query(LINK_META_SCOPED, {"basenames": list(basenames)})
     log("Done.")
 
 
 @timer
-def create_next_speech_relation(graph):
+def create_next_speech_relation(graph, basenames=None):
     log("Creating NEXT relation for speeches..")
     query = """
     MATCH (s1:Speech)-[:HAS_METADATA]->(m:Meta)<-[:HAS_METADATA]-(s2:Speech)
     WHERE toInteger(s1.index) = toInteger(s2.index)-1
-    CREATE (s1)-[:NEXT]->(s2)
+    MERGE (s1)-[:NEXT]->(s2)
     """
-    graph.execute_query(query)
+    if basenames is None:
+        graph.execute_query(query)
+    else:
+        graph.execute_query(NEXT_SPEECH_SCOPED, {"basenames": list(basenames)})
     log("Done.")
 
 
 @timer
-def create_next_paragraph_relation(graph: HelloWorldExample):
+def create_next_paragraph_relation(graph: HelloWorldExample, speeches=None):
     log("Creating NEXT relation for paragraphs..")
     query = """
     MATCH (p2:Paragraph)<-[:CONTAINS]-(s:Speech)-[:CONTAINS]->(p1:Paragraph)
     WHERE toInteger(p1.index) = toInteger(p2.index)-1
-    CREATE (p1)-[:NEXT]->(p2)
+    MERGE (p1)-[:NEXT]->(p2)
     """
-    graph.execute_query(query)
+    if speeches is None:
+        graph.execute_query(query)
+    else:
+        graph.execute_query(NEXT_PARAGRAPH_SCOPED, {"speeches": list(speeches)})
     log("Done.")
 
 
 @timer
-def create_next_sentence_relation(graph: HelloWorldExample):
+def create_next_sentence_relation(graph: HelloWorldExample, speeches=None):
     log("Creating NEXT relation for sentences..")
     query = """
     MATCH (s1:Sentence)<-[:CONTAINS]-(p:Paragraph)-[:CONTAINS]->(s2:Sentence)
     WHERE toInteger(s1.index) = toInteger(s2.index)-1
-    CREATE (s1)-[:NEXT]->(s2)
+    MERGE (s1)-[:NEXT]->(s2)
     """
-    graph.execute_query_without_transaction(query)
+    if speeches is None:
+        graph.execute_query_without_transaction(query)
+    else:
+        graph.execute_query_without_transaction(NEXT_SENTENCE_SCOPED, {"speeches": list(speeches)})
     log("Done.")
 
 
@@ -90,6 +153,79 @@ def split_into_sentences(speech: str) -> List[str]:
         yield sent.text
 
 
+def get_speech_name(filename: str) -> str:
+    return ".".join(filename.split(".")[:-1])
+
+
+def get_speech_basename(speech_name: str) -> str:
+    return "_".join(speech_name.split("_")[:-1])
+
+
+def parse_speech_file(path, path_to_paragraphs=config.PARAGRAPHS_PATH):
+    speech_name = get_speech_name(path.name)
+    basename = get_speech_basename(speech_name)
+    speech_uid = IDS.assign(SPEECH, speech_name)
+    raw_speech = remove_initial_stub(load_file(path))
+    indices = []
+    paragraph_stuff = []
+    # positions within the speech without gaps, empty paragraphs and sentences are not counted
+    s_index_in_speech = p_index_in_speech = 0
+    for p_index, paragraph in enumerate(split_speech_into_paragraphs(raw_speech)):
+        paragraph_folder = Path(path_to_paragraphs, f"{speech_name}")
+        paragraph_folder.mkdir(parents=True, exist_ok=True)
+
+        paragraph_id = Path(paragraph_folder, f"{p_index}")
+        p_uid = IDS.assign(PARAGRAPH, paragraph_id)
+        clean_paragraph = []
+
+        for s_index, sentence in enumerate(split_into_sentences(paragraph)):
+            sentence = sentence.strip().replace("\t", " ")
+            if len(sentence.strip()):
+                clean_paragraph.append(sentence)
+                # the s_id and paragraph path are left out, they follow from the p_id
+                indices.append({
+                    "speech_name": speech_name,
+                    "speech_basename": basename,
+                    "p_index": p_index,
+                    "s_index": s_index,
+                    "p_index_in_speech": p_index_in_speech,
+                    "s_index_in_speech": s_index_in_speech,
+                    "p_id": paragraph_id,
+                    "text": sentence,
+                    "filename": path.name,
+                    "speech_uid": speech_uid,
+                    "p_uid": p_uid,
+                    "s_uid": IDS.assign(SENTENCE, f"{paragraph_id}_{s_index}")}
+                )
+                s_index_in_speech += 1
+        if clean_paragraph:
+            p_index_in_speech += 1
+
+        write_to_path("\n".join(clean_paragraph), paragraph_path_of(paragraph_id))
+        paragraph_stuff.append({"p_id": paragraph_id, "p_uid": p_uid})
+    return indices, paragraph_stuff
+
+
+def parse_corpus(path_to_speeches=config.SPEECHES_FOLDER, path_to_paragraphs=config.PARAGRAPHS_PATH,
+                 meta_dump_path=config.PARSED_DATA, paragraph_meta_path=config.PARAGRAPH_META):
+    log("Splitting speeches into paragraphs, sentences and removing clutter.")
+    Path(path_to_paragraphs).mkdir(parents=True, exist_ok=True)
+    indices = []
+    paragraph_stuff = []
+    with os.scandir(path_to_speeches) as root_dir:
+        total = get_number_of_files_in_path(path_to_speeches)
+        if total == 0:
+            log(f"No files in {path_to_speeches}!", LogLevel.WARNING)
+        for path in tqdm(root_dir, total=total):
+            if path.is_file():
+                speech_indices, speech_paragraphs = parse_speech_file(path, path_to_paragraphs)
+                indices.extend(speech_indices)
+                paragraph_stuff.extend(speech_paragraphs)
+    dump_tsv(meta_dump_path, indices, list(indices[0].keys()))
+    dump_tsv(paragraph_meta_path, paragraph_stuff)
+    IDS.save()
+
+
 def add_president_label(graph: HelloWorldExample):
     log("Adding president label..")
     query = """
@@ -100,66 +236,132 @@ def add_president_label(graph: HelloWorldExample):
 
 
 @timer
-def link_paragraph_and_sentence_to_speakers(graph: HelloWorldExample):
+def link_paragraph_and_sentence_to_speakers(graph: HelloWorldExample, speeches=None):
     query = """
     MATCH (speak:Speaker)-[:SPOKE]->(speech:Speech)-[:CONTAINS]->(p:Paragraph)-[:CONTAINS]->(s:Sentence) 
     MERGE (speak)-[:SPOKE]->(p)
     MERGE (speak)-[:SPOKE]->(s)
     """
-    graph.execute_query(query)
+    if speeches is None:
+        graph.execute_query(query)
+    else:
+        graph.execute_query(SPOKE_SCOPED, {"speeches": list(speeches)})
 
 
 @timer
 def load_sentences_into_graph(graph: HelloWorldExample, file_path=config.PARSED_DATA):
     log("Loading sentences..")
-    statement = """
-        USING PERIODIC COMMIT 5000
-        LOAD CSV WITH HEADERS FROM 'file:///%s' AS row
-        FIELDTERMINATOR "\t"
-        CREATE (s:Sentence {index: toInteger(row.s_index), index_in_speech: toInteger(row.s_index_in_speech),
-                            id: row.s_id, text: row.text})
-        MERGE (p:Paragraph {index: toInteger(row.p_index), id: row.p_id})
-        MERGE (sp:Speech {basename : row.speech_basename, id: row.speech_name, filename: row.filename })
-        MERGE (sp)-[:CONTAINS]->(p)
-        MERGE (sp)-[:CONTAINS]->(s)
-        MERGE (p)-[:CONTAINS]->(s)
-        """ % file_path
-
-    graph.execute_query_without_transaction(statement)
+    if "s_uid" not in get_fieldnames_in_file(file_path):
+        if file_path != config.PARSED_DATA:
+            raise ValueError(f"{file_path} has no uid columns, run `python make.py ids` first.")
+        log(f"{file_path} was parsed before uids existed, adding them..", LogLevel.WARNING)
+        add_uids_to_parsed_data()
+    if "s_index_in_speech" not in get_fieldnames_in_file(file_path):
+        if file_path != config.PARSED_DATA:
+            raise ValueError(f"{file_path} has no position columns, run `python make.py positions` first.")
+        log(f"{file_path} was parsed before positions existed, adding them..", LogLevel.WARNING)
+        add_positions_to_parsed_data()
+    # in compact mode the text itself is read from the text store by s_uid
+    parameters = {"compact": config.COMPACT_TEXT, "preview_characters": config.TEXT_PREVIEW_CHARACTERS}
+    # all rows of a speech go into the same batch, so concurrent batches never merge the same paragraph or speech
+    graph.load_file(file_path, LOAD_SENTENCES.text, concurrency=config.BOLT_WRITERS, group_by="speech_uid",
+                    parameters=parameters)
     log("Done.")
 
-@timer
-def add_speech_meta_to_nodes(graph: HelloWorldExample):
-    log("Adding speech meta data..")
-    statement = f"""
-        USING PERIODIC COMMIT 5000
-        LOAD CSV WITH HEADERS FROM 'file:///{config.SPEAKER}' AS row
-        FIELDTERMINATOR "\t"
-        MATCH (speech:Speech) WHERE speech.filename = row.filename
-        MATCH (speech)-[:CONTAINS]->(p:Paragraph)
-        MATCH (p)-[:CONTAINS]->(s:Sentence)
-        MERGE (speaker:Speaker {{name: row.speaker, participanttype: row.participanttype, role_in_un : coalesce(row.role_in_un, 'N/A'), country: row.country}})
-        MERGE (a1:AgendaItem {{name: row.agenda_item1}})
-        MERGE (speech)-[:AGENDA1]->(a1)
-        MERGE (a2:AgendaItem {{name: row.agenda_item2}})
-        MERGE (speech)-[:AGENDA2]->(a2)
-        MERGE (a3:AgendaItem {{name: row.agenda_item3}})
-        MERGE (speech)-[:AGENDA3]->(a3)
-        MERGE (i:Institution {{name: row.country}})
+def add_positions_to_parsed_data(file_path=config.PARSED_DATA):
+    """Adds s_index_in_speech and p_index_in_speech to a main.tsv written before they existed. The rows of a speech
+    are in reading order, so both are running counts per speech."""
+    if not Path(file_path).is_file() or "s_index_in_speech" in get_fieldnames_in_file(file_path):
+        return
+    tmp = f"{file_path}.tmp"
+    with open(file_path, encoding="utf-8") as inf, open(tmp, "w", encoding="utf-8") as outf:
+        reader = csv.DictReader(inf, delimiter="\t")
+        writer = csv.DictWriter(outf, list(reader.fieldnames) + ["p_index_in_speech", "s_index_in_speech"],
+                                delimiter="\t")
+        writer.writeheader()
+        speech, paragraph, s_index_in_speech, p_index_in_speech = None, None, 0, -1
+        for row in reader:
+            if row["speech_name"] != speech:
+                speech, paragraph, s_index_in_speech, p_index_in_speech = row["speech_name"], None, 0, -1
+            if row["p_id"] != paragraph:
+                paragraph = row["p_id"]
+                p_index_in_speech += 1
+            row["p_index_in_speech"] = p_index_in_speech
+            row["s_index_in_speech"] = s_index_in_speech
+            s_index_in_speech += 1
+            writer.writerow(row)
+    Path(tmp).replace(file_path)
+    log(f"Added positions to {file_path}.")
+
+
+SPEAKER_KEY = "{name: row.speaker, participanttype: row.participanttype, role_in_un: row.role_in_un, country: row.country}"
+
+
+def collect_speech_meta(rows):
+    """Deduplicates the speakers, institutions and agenda items of speaker.tsv rows and lists the relationships
+    between them and the speeches."""
+    speakers, institutions, agenda_items = {}, set(), set()
+    spoke, agenda = [], {}
+    ordered_agenda = {1: [], 2: [], 3: []}
+    for row in rows:
+        speaker = {"speaker": row["speaker"], "participanttype": row["participanttype"],
+                   "role_in_un": row["role_in_un"] or "N/A", "country": row["country"]}
+        speakers[tuple(speaker.values())] = speaker
+        spoke.append({"filename": row["filename"], **speaker})
+        if row["country"]:
+            institutions.add(row["country"])
+        for position in (1, 2, 3):
+            name = row[f"agenda_item{position}"]
+            if not name:
+                continue
+            agenda_items.add(name)
+            ordered_agenda[position].append({"filename": row["filename"], "name": name})
+            agenda[(row["filename"], name)] = {"filename": row["filename"], "name": name}
+    return {"speakers": list(speakers.values()), "institutions": [{"name": name} for name in sorted(institutions)],
+            "agenda_items": [{"name": name} for name in sorted(agenda_items)], "spoke": spoke,
+            "represents": [speaker for speaker in speakers.values() if speaker["country"]],
+            "agenda": list(agenda.values()), "ordered_agenda": ordered_agenda}
+
+
+AGENDA_QUERY = """
+UNWIND $rows AS row
+MATCH (speech:Speech {filename: row.filename})
+MATCH (a:AgendaItem {name: row.name})
+MERGE (speech)-[:%s]->(a)
+"""
+
+
+def speech_meta_statements(meta) -> List[Tuple[str, str, List[Dict]]]:
+    """The (description, query, rows) that write the output of `collect_speech_meta`, in the order they have to run."""
+    statements = [
+        ("Speaker", f"UNWIND $rows AS row MERGE (:Speaker {SPEAKER_KEY})", meta["speakers"]),
+        ("Institution", "UNWIND $rows AS row MERGE (:Institution {name: row.name})", meta["institutions"]),
+        ("AgendaItem", "UNWIND $rows AS row MERGE (:AgendaItem {name: row.name})", meta["agenda_items"]),
+        ("SPOKE", f"""
+        UNWIND $rows AS row
+        MATCH (speech:Speech {{filename: row.filename}})
+        MATCH (speaker:Speaker {SPEAKER_KEY})
         MERGE (speaker)-[:SPOKE]->(speech)
+        """, meta["spoke"]),
+        ("REPRESENTS", f"""
+        UNWIND $rows AS row
+        MATCH (speaker:Speaker {SPEAKER_KEY})
+        MATCH (i:Institution {{name: row.country}})
         MERGE (speaker)-[:REPRESENTS]->(i)
-    """
-    graph.execute_query_without_transaction(statement)
-    log("Done.")
+        """, meta["represents"])]
+    for position, rows in meta["ordered_agenda"].items():
+        statements.append((f"AGENDA{position}", AGENDA_QUERY % f"AGENDA{position}", rows))
+    statements.append(("AGENDA", AGENDA_QUERY % "AGENDA", meta["agenda"]))
+    return statements
 
 
 @timer
-def unify_agenda_relation(graph: HelloWorldExample):
-    statements = ["MATCH (s:Speech)-[:AGENDA1]->(a:AgendaItem) MERGE (s)-[:AGENDA]->(a)",
-                  "MATCH (s:Speech)-[:AGENDA2]->(a:AgendaItem) MERGE (s)-[:AGENDA]->(a)",
-                  "MATCH (s:Speech)-[:AGENDA3]->(a:AgendaItem) MERGE (s)-[:AGENDA]->(a)"]
-    for s in statements:
-        graph.execute_query(s)
+def add_speech_meta_to_nodes(graph: HelloWorldExample, file_path=config.SPEAKER):
+    log("Adding speech meta data..")
+    meta = collect_speech_meta(load_tsv(file_path))
+    for desc, query, rows in speech_meta_statements(meta):
+        graph.write_batches(query, rows, desc=desc)
+    log("Done.")
 
 
 def get_sentence_and_line_number_by_offset(path, offset):
@@ -179,7 +381,8 @@ def inject_sids_from_pids(file_path: str):
     with open(file_path, encoding="utf-8") as f:
         reader = csv.DictReader(f, delimiter="\t")
         for i, line in enumerate(tqdm(reader, total=total)):
-            line_number, new_offset = get_sentence_and_line_number_by_offset(line['paragraph_path'], line['offset'])
+            line_number, new_offset = get_sentence_and_line_number_by_offset(paragraph_path_of(line['p_id']),
+                                                                               line['offset'])
             s_id = f"{line['p_id']}_{line_number}"
             line["s_id"] = s_id
             line["offset"] = new_offset
@@ -0,0 +1,104 @@
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional, Set
+
+from config import MENTION_MIN_SCORE, MENTION_MIN_SUPPORT, MENTION_TOP_K, MENTION_STOPLIST
+from unscne.metrics import metrics
+from unscne.util import log
+
+STOPLIST = "stoplist"
+SCORE = "score"
+SUPPORT = "support"
+TOP_K = "top_k"
+FILTERS = (STOPLIST, SCORE, SUPPORT, TOP_K)
+
+
+def load_stoplist(path) -> Set[str]:
+    if not path or not Path(path).is_file():
+        return set()
+    with open(path, encoding="utf-8") as f:
+        return {line.strip().lower() for line in f if line.strip() and not line.startswith("#")}
+
+
+def _number(value, cast) -> Optional[float]:
+    return cast(value) if value not in ("", None) else None
+
+
+class MentionFilter:
+    """Drops Spotlight mentions by surface form, similarity score and support, then keeps the `top_k` best scored
+    mentions of each sentence. Rows are streamed, top-k relies on the rows of a sentence being adjacent, which they
+    are in ners.tsv since every paragraph is annotated in one request."""
+
+    def __init__(self, min_score=MENTION_MIN_SCORE, min_support=MENTION_MIN_SUPPORT, top_k=MENTION_TOP_K,
+                 stoplist=MENTION_STOPLIST):
+        self.min_score = min_score
+        self.min_support = min_support
+        self.top_k = top_k
+        self.stoplist = load_stoplist(stoplist)
+        self.removed: Dict[str, int] = {name: 0 for name in FILTERS}
+        self.removed_uris: Dict[str, Set[str]] = {name: set() for name in FILTERS}
+        self.kept = 0
+        self.kept_uris: Set[str] = set()
+        self.seen_uris: Set[str] = set()
+
+    @property
+    def active(self) -> bool:
+        return bool(self.stoplist or self.min_score or self.min_support or self.top_k)
+
+    def _reason(self, row) -> Optional[str]:
+        if self.stoplist and (row["surfaceForm"] or "").strip().lower() in self.stoplist:
+            return STOPLIST
+        score = _number(row["similarityScore"], float)
+        if self.min_score and score is not None and score < self.min_score:
+            return SCORE
+        support = _number(row["support"], int)
+        if self.min_support and support is not None and support < self.min_support:
+            return SUPPORT
+        return None
+
+    def _remove(self, row, reason):
+        self.removed[reason] += 1
+        self.removed_uris[reason].add(row["uri"])
+
+    def _keep(self, row):
+        self.kept += 1
+        self.kept_uris.add(row["uri"])
+        return row
+
+    def _best(self, rows: List[Dict[str, str]]) -> Iterator[Dict[str, str]]:
+        rows.sort(key=lambda row: _number(row["similarityScore"], float) or 0.0, reverse=True)
+        for row in rows[self.top_k:]:
+            self._remove(row, TOP_K)
+        for row in rows[:self.top_k]:
+            yield self._keep(row)
+
+    def filter(self, rows: Iterable[Dict[str, str]]) -> Iterator[Dict[str, str]]:
+        sentence, current = None, []
+        for row in rows:
+            self.seen_uris.add(row["uri"])
+            reason = self._reason(row)
+            if reason is not None:
+                self._remove(row, reason)
+            elif not self.top_k:
+                yield self._keep(row)
+            else:
+                if row["s_id"] != sentence:
+                    yield from self._best(current)
+                    sentence, current = row["s_id"], []
+                current.append(row)
+        yield from self._best(current)
+
+    def report(self):
+        if not self.active:
+            return
+        total = self.kept + sum(self.removed.values())
+        for name in FILTERS:
+            # a concept only disappears if none of its mentions survived
+            concepts = len(self.removed_uris[name] - self.kept_uris)
+            metrics.incr(f"mentions.pruned.{name}", self.removed[name])
+            metrics.incr(f"mentions.pruned_concepts.{name}", concepts)
+            if self.removed[name]:
+                log(f"Filter {name} removed {self.removed[name]} mentions, {concepts} concepts lost their last one.")
+        removed_concepts = len(self.seen_uris - self.kept_uris)
+        metrics.incr("mentions.kept", self.kept)
+        log(f"Kept {self.kept} of {total} mentions and {len(self.kept_uris)} of {len(self.seen_uris)} concepts "
+            f"({removed_concepts} removed).")
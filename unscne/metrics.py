@@ -0,0 +1,205 @@
+import atexit
+import datetime
+import json
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+from config import REPORTS_FOLDER
+
+try:
+    import resource
+except ImportError:  # not available on windows
+    resource = None
+
+SUMMARY_COUNTERS = ["nodes_created", "nodes_deleted", "relationships_created", "relationships_deleted",
+                    "properties_set", "labels_added", "labels_removed", "indexes_added", "constraints_added"]
+
+
+def get_peak_rss_mb() -> Optional[float]:
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes everywhere else
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def percentile(values: List[float], q: float) -> float:
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(q / 100 * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+def summarize_histogram(values: List[float]) -> Dict[str, float]:
+    return {"count": len(values), "min": min(values), "max": max(values), "mean": sum(values) / len(values),
+            "p50": percentile(values, 50), "p90": percentile(values, 90), "p99": percentile(values, 99)}
+
+
+class Span:
+
+    def __init__(self, name: str):
+        self.name = name
+        self.started = time.time()
+        self.duration = None
+        self.calls = 0
+        self.counters: Dict[str, float] = {}
+        self.histograms: Dict[str, List[float]] = {}
+        # the peak RSS is a process wide high-water mark, a span can only tell how far it raised it
+        self.peak_rss_growth_mb = None
+
+    def to_dict(self) -> Dict:
+        result = {"calls": self.calls, "duration_s": round(self.duration or 0.0, 3),
+                  "peak_rss_growth_mb": self.peak_rss_growth_mb, "counters": dict(sorted(self.counters.items())),
+                  "histograms": {name: summarize_histogram(values) for name, values in sorted(self.histograms.items())}}
+        rows = self.counters.get("rows_written", 0)
+        if rows and self.duration:
+            result["rows_per_s"] = round(rows / self.duration, 1)
+        return result
+
+
+class Metrics:
+    """Collects named spans with counters and histograms, spans nest per thread. Work handed to other threads is
+    wrapped with `bind` to count towards the spans that started it."""
+
+    def __init__(self):
+        self.started = datetime.datetime.now()
+        self.root = Span("run")
+        self.spans: Dict[str, Span] = {}
+        self.sections: Dict[str, object] = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _stack(self) -> List[Span]:
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+        return self._local.stack
+
+    def current(self) -> Span:
+        stack = self._stack()
+        return stack[-1] if stack else self.root
+
+    def _active(self) -> List[Span]:
+        # numbers count towards every open span of this thread, so a stage includes the steps it calls
+        active = [self.root]
+        for span in self._stack():
+            if span not in active:
+                active.append(span)
+        return active
+
+    @contextmanager
+    def span(self, name: str):
+        with self._lock:
+            span = self.spans.get(name)
+            if span is None:
+                span = self.spans[name] = Span(name)
+        self._stack().append(span)
+        started = time.time()
+        rss_before = get_peak_rss_mb()
+        try:
+            yield span
+        finally:
+            self._stack().pop()
+            rss_after = get_peak_rss_mb()
+            with self._lock:
+                span.calls += 1
+                span.duration = (span.duration or 0.0) + time.time() - started
+                if rss_before is not None:
+                    span.peak_rss_growth_mb = max(span.peak_rss_growth_mb or 0.0, round(rss_after - rss_before, 1))
+
+    def bind(self, func: Callable) -> Callable:
+        """Wraps `func` so that it counts towards the spans open in this thread, wherever it runs."""
+        parents = list(self._stack())
+
+        @wraps(func)
+        def bound(*args, **kwargs):
+            previous = self._stack()
+            self._local.stack = parents + previous
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self._local.stack = previous
+
+        return bound
+
+    def incr(self, name: str, value: float = 1):
+        with self._lock:
+            for span in self._active():
+                span.counters[name] = span.counters.get(name, 0) + value
+
+    def observe(self, name: str, value: float):
+        with self._lock:
+            for span in self._active():
+                span.histograms.setdefault(name, []).append(value)
+
+    def record_summary(self, summary):
+        counters = summary.counters
+        for name in SUMMARY_COUNTERS:
+            value = getattr(counters, name, 0)
+            if value:
+                self.incr(f"neo4j.{name}", value)
+        rows = counters.nodes_created + counters.relationships_created + counters.nodes_deleted + \
+            counters.relationships_deleted
+        if rows:
+            self.incr("rows_written", rows)
+
+    def record_response(self, response):
+        host = response.url.split("/")[2] if "://" in response.url else "unknown"
+        self.incr(f"http.{host}.requests")
+        self.incr(f"http.{host}.status_{response.status_code}")
+        self.observe(f"http.{host}.latency_ms", response.elapsed.total_seconds() * 1000)
+        retries = getattr(getattr(response.raw, "retries", None), "history", ())
+        if retries:
+            self.incr(f"http.{host}.retries", len(retries))
+
+    def add_section(self, name: str, content):
+        with self._lock:
+            self.sections[name] = content
+
+    def report(self) -> Dict:
+        self.root.duration = (datetime.datetime.now() - self.started).total_seconds()
+        result = {"started": f"{self.started:%Y-%m-%dT%H:%M:%S}", "argv": sys.argv, "run": self.root.to_dict(),
+                  "process_peak_rss_mb": get_peak_rss_mb(),
+                  "stages": {name: span.to_dict() for name, span in sorted(self.spans.items())}}
+        # sections given as callables are evaluated when the report is written
+        result.update(sorted((name, content() if callable(content) else content)
+                             for name, content in self.sections.items()))
+        return result
+
+    def write_report(self, name: str) -> Path:
+        Path(REPORTS_FOLDER).mkdir(parents=True, exist_ok=True)
+        path = Path(REPORTS_FOLDER, f"{name}_{self.started:%Y%m%d_%H%M%S}.json")
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.report(), f, indent=2, sort_keys=True, default=str)
+        return path
+
+
+metrics = Metrics()
+
+
+def write_report_at_exit(name: str):
+    atexit.register(metrics.write_report, name)
+
+
+def compare_reports(old_path, new_path):
+    with open(old_path, encoding="utf-8") as f:
+        old = json.load(f)["stages"]
+    with open(new_path, encoding="utf-8") as f:
+        new = json.load(f)["stages"]
+    print(f"{'stage':40} {'old (s)':>10} {'new (s)':>10} {'change':>8}")
+    for name in sorted(set(old.keys()) | set(new.keys())):
+        before = old.get(name, {}).get("duration_s")
+        after = new.get(name, {}).get("duration_s")
+        change = f"{(after - before) / before:+.0%}" if before and after is not None else "n/a"
+        print(f"{name:40} {before if before is not None else '-':>10} {after if after is not None else '-':>10} "
+              f"{change:>8}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print("Usage: python -m unscne.metrics <OLD_REPORT> <NEW_REPORT>")
+    else:
+        compare_reports(sys.argv[1], sys.argv[2])
@@ -1,31 +1,71 @@
 import csv
+import queue
 import sys
+import threading
+from bisect import bisect_right
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
-from typing import List, Union, Dict, Any
+from typing import List, Union, Dict, Any, Optional, Tuple
 
 import requests
 from tqdm import tqdm
 
 from config import DBPEDIA_TO_WIKIDATA, WD_CLASSES, URL_TO_DBPEDIA_SERVICE, WD_GFS_ENDPOINT, \
     URL_TO_DBPEDIA_ENDPOINT, DBPEDIA_NERS, PARAGRAPH_META, WD_LABELS, WD_HIERARCHY, DBPEDIA_TO_WIKIDATA_INTERNAL, \
-    DBPEDIA_TO_WIKIDATA_AMBIGUOUS, WD_SPARQL_ENDPOINT, COUNTRY_MAPPING
-from unscne.load_meta import inject_sids_from_pids
+    DBPEDIA_TO_WIKIDATA_AMBIGUOUS, WD_SPARQL_ENDPOINT, COUNTRY_MAPPING, SPOTLIGHT_BATCH_CHARACTERS, \
+    SPOTLIGHT_BATCH_VERIFICATION_SAMPLE, SPOTLIGHT_BATCH_MIN_AGREEMENT, MENTION_WRITERS, WRITE_BATCH_SIZE, BOLT_WRITERS, \
+    ANNOTATION_DEAD_LETTER, SPOTLIGHT_RETRY_WORKERS
+from unscne.annotation_status import AnnotationStatus, FAILED
+from unscne.load_meta import inject_sids_from_pids, get_sentence_and_line_number_by_offset
 from unscne.graph import HelloWorldExample
+from unscne.ids import IDS, SENTENCE, add_uids_to_parsed_data, paragraph_path_of
 from tqdm.auto import tqdm
 
-from unscne.util import timer, create_retrying_session, dump_tsv, load_tsv, load_file, log, LogLevel
+from unscne.mention_filters import MentionFilter
+from unscne.metrics import metrics
+from unscne.statements import run_sparql, Iri, cypher_name, WD_INSTANCE_OF, WD_SUBCLASS_OF, WD_LABEL_OF, \
+    WD_ENTITY_BY_LABEL, DBPEDIA_SAME_AS, INSTITUTION_ENTITY
+from unscne.util import timer, create_retrying_session, dump_tsv, load_tsv, load_file, log, LogLevel, batched, \
+    count_lines_in_file
 
 
-def request_dbpedia_ners_from_text(text: str, key_mapping: Dict[str, str]) -> List[Dict[str, Union[str, None]]]:
-    response = requests.get(URL_TO_DBPEDIA_SERVICE, params={"text": text}, headers={"accept": "application/json"})
-    if response:
-        json = response.json()
-        if "Resources" in json.keys():
-            for result in json["Resources"]:
-                entry = {}
-                for dbpedia_key, neo4j_key in key_mapping.items():
-                    entry[neo4j_key] = result.get(dbpedia_key, None)
-                yield entry
+spotlight = create_retrying_session()
+
+
+DBPEDIA_KEY_MAPPING = {"@URI": "uri",
+                       "@support": "support",
+                       "@types": "types",
+                       "@surfaceForm": "surfaceForm",
+                       "@offset": "offset",
+                       "@similarityScore": "similarityScore",
+                       "@percentageOfSecondRank": "percentageOfSecondRank"
+                       }
+# joins paragraphs of one batched request, the full stop keeps spotlight from spotting across paragraphs
+SPOTLIGHT_SEPARATOR = "\n.\n\n"
+
+
+class SpotlightError(Exception):
+    """Spotlight answered, but not with annotations."""
+
+
+# anything that leaves a paragraph without a trustworthy answer, non JSON bodies raise a ValueError
+ANNOTATION_ERRORS = (requests.exceptions.RequestException, SpotlightError, ValueError)
+
+
+def request_dbpedia_ners_from_text(text: str, key_mapping: Dict[str, str], post=False) -> List[Dict[str, Union[str, None]]]:
+    if post:
+        response = spotlight.post(URL_TO_DBPEDIA_SERVICE, data={"text": text}, headers={"accept": "application/json"})
+    else:
+        response = spotlight.get(URL_TO_DBPEDIA_SERVICE, params={"text": text}, headers={"accept": "application/json"})
+    if not response:
+        raise SpotlightError(f"HTTP {response.status_code}")
+    json = response.json()
+    if "Resources" in json.keys():
+        for result in json["Resources"]:
+            entry = {}
+            for dbpedia_key, neo4j_key in key_mapping.items():
+                entry[neo4j_key] = result.get(dbpedia_key, None)
+            yield entry
 
 
 def extract_dbpedia_ners_from_text(text: str, key_mapping: Dict[str, str]) -> List[Dict[str, Union[str, None]]]:
@@ -34,6 +74,59 @@ def extract_dbpedia_ners_from_text(text: str, key_mapping: Dict[str, str]) -> Li
         yield entry
 
 
+def make_paragraph_batches(paragraph_metas: List[Dict[str, str]], max_characters: int = SPOTLIGHT_BATCH_CHARACTERS):
+    """Groups paragraphs into batches whose joined text stays within `max_characters`."""
+    batch, size = [], 0
+    for paragraph_meta in paragraph_metas:
+        text = load_file(paragraph_path_of(paragraph_meta["p_id"]))
+        added = len(text) + (len(SPOTLIGHT_SEPARATOR) if batch else 0)
+        if batch and size + added > max_characters:
+            yield batch
+            batch, size = [], 0
+            added = len(text)
+        batch.append((paragraph_meta, text))
+        size += added
+    if batch:
+        yield batch
+
+
+def extract_dbpedia_ners_from_batch(batch, key_mapping: Dict[str, str]):
+    """Annotates several paragraphs in one request, yields each entry with its paragraph and local offset."""
+    starts = []
+    position = 0
+    for _, text in batch:
+        starts.append(position)
+        position += len(text) + len(SPOTLIGHT_SEPARATOR)
+    joined = SPOTLIGHT_SEPARATOR.join(text for _, text in batch)
+    for entry in request_dbpedia_ners_from_text(joined, key_mapping, post=True):
+        del entry["types"]
+        offset = int(entry["offset"])
+        index = bisect_right(starts, offset) - 1
+        paragraph_meta, text = batch[index]
+        local_offset = offset - starts[index]
+        if local_offset + len(entry["surfaceForm"] or "") > len(text):
+            # spotted inside the separator
+            continue
+        entry["offset"] = str(local_offset)
+        yield paragraph_meta, entry
+
+
+def _annotation_key(entry):
+    return entry["uri"], str(entry["offset"]), entry["surfaceForm"]
+
+
+def verify_batch(batch, batched_entries, key_mapping: Dict[str, str]) -> float:
+    """Annotates the paragraphs of a batch one by one, returns the share of annotations both runs agree on."""
+    batched = {(paragraph_meta["p_id"],) + _annotation_key(entry) for paragraph_meta, entry in batched_entries}
+    single = set()
+    for paragraph_meta, text in batch:
+        single.update((paragraph_meta["p_id"],) + _annotation_key(entry)
+                      for entry in extract_dbpedia_ners_from_text(text, key_mapping))
+    if not batched and not single:
+        return 1.0
+    return len(batched & single) / len(batched | single)
+
+
 def _make_load_dbpedia_dump_statement(appendix, filename):
     load_from_csv = """
     USING PERIODIC COMMIT 1000
@@ -74,22 +167,89 @@ def check_if_sids_in_ners_inject_if_not():
         log("Done.")
 
 
+MENTION_TYPES = {"support": int, "offset": int, "similarityScore": float, "percentageOfSecondRank": float}
+
+# a sentence mentions a concept at most once per offset, merging on it lets the stage rerun without duplicates
+WRITE_MENTIONS_QUERY = """
+UNWIND $rows AS row
+MATCH (s:Sentence {uid: row.s_uid})
+MATCH (d:DBConcept {uri: row.uri})
+MERGE (s)-[m:MENTIONS {offset: row.offset}]->(d)
+SET m.surfaceForm = row.surfaceForm, m.support = row.support, m.similarityScore = row.similarityScore,
+    m.percentageOfSecondRank = row.percentageOfSecondRank
+"""
+
+
+def make_mention_row(row: Dict[str, str], s_uid: int) -> Dict[str, Any]:
+    mention = {"s_uid": s_uid, "uri": row["uri"], "surfaceForm": row["surfaceForm"]}
+    for key, cast in MENTION_TYPES.items():
+        mention[key] = cast(row[key]) if row[key] not in ("", None) else None
+    return mention
+
+
+def _generate_ner_rows(file_path):
+    with open(file_path, encoding="utf-8") as f:
+        yield from csv.DictReader(f, delimiter="\t")
+
+
+def _write_mention_lane(graph: HelloWorldExample, lane: "queue.Queue"):
+    while True:
+        batch = lane.get()
+        if batch is None:
+            return
+        graph.execute_query(WRITE_MENTIONS_QUERY, {"rows": batch})
+
+
+def _put(lane: "queue.Queue", writer: Future, batch):
+    while True:
+        if writer.done():
+            # the writer only stops early if it failed, result() raises its exception
+            writer.result()
+        try:
+            lane.put(batch, timeout=1)
+            return
+        except queue.Full:
+            pass
+
+
 @timer
-def write_dbpedia_annotations_to_graph(graph: HelloWorldExample):
+def write_dbpedia_annotations_to_graph(graph: HelloWorldExample, file_path=DBPEDIA_NERS, workers=MENTION_WRITERS,
+                                       batch_size=WRITE_BATCH_SIZE):
     log("Annotating sentences with dbpedia..")
     check_if_sids_in_ners_inject_if_not()
-    statement = f"""
-    USING PERIODIC COMMIT 5000
-    LOAD CSV WITH HEADERS FROM 'file:///{DBPEDIA_NERS}' AS row
-    FIELDTERMINATOR "\t"
-    MATCH (s:Sentence)
-    WHERE s.id = row.s_id
-    MERGE (d:DBConcept {{uri : row.uri}})
-    CREATE (s)-[
-        :MENTIONS {{surfaceForm: row.surfaceForm, support : row.support, offset : row.offset, similarityScore : row.similarityScore, percentageOfSecondRank : row.percentageOfSecondRank}}
-    ]->(d)
-    """
-    graph.execute_query_without_transaction(statement)
+    # creating the concepts up front leaves only MATCHes for the second phase, so popular concepts are not merged
+    # by every writer at once. Both phases see the same filtered rows, concepts without mentions are never created
+    mention_filter = MentionFilter()
+    uris = sorted({row["uri"] for row in mention_filter.filter(_generate_ner_rows(file_path))})
+    mention_filter.report()
+    graph.write_batches("UNWIND $rows AS uri MERGE (:DBConcept {uri: uri})", uris, batch_size, "DBConcept")
+    # every sentence belongs to exactly one lane and each lane has a single writer, so no two transactions ever
+    # touch the same sentence
+    lanes = [queue.Queue(maxsize=2) for _ in range(workers)]
+    buffers: List[List[Dict[str, Any]]] = [[] for _ in range(workers)]
+    with ThreadPoolExecutor(workers) as pool:
+        writers = [pool.submit(metrics.bind(_write_mention_lane), graph, lane) for lane in lanes]
+        try:
+            rows = tqdm(_generate_ner_rows(file_path), total=count_lines_in_file(file_path) - 1, desc="MENTIONS")
+            for row in MentionFilter().filter(rows):
+                s_uid = IDS.get(SENTENCE, row["s_id"])
+                if s_uid is None:
+                    metrics.incr("mentions.unknown_sentence")
+                    continue
+                lane = s_uid % workers
+                buffers[lane].append(make_mention_row(row, s_uid))
+                if len(buffers[lane]) >= batch_size:
+                    _put(lanes[lane], writers[lane], buffers[lane])
+                    buffers[lane] = []
+            for lane, buffer in enumerate(buffers):
+                if buffer:
+                    _put(lanes[lane], writers[lane], buffer)
+        finally:
+            for lane, writer in zip(lanes, writers):
+                if not writer.done():
+                    lane.put(None)
+        for writer in writers:
+            writer.result()
     log("Done.")
 
 
@@ -116,40 +276,170 @@ def load_paragraph_meta_without_double_p_ids(sth, pid_key="p_id"):
     return hottu
 
 
+def get_ner_header(sids_injected: bool) -> List[str]:
+    header = ["p_id", "uri", "support", "surfaceForm", "offset", "similarityScore",
+              "percentageOfSecondRank"]
+    if sids_injected:
+        header.append("s_id")
+    return header
+
+
+def make_ner_row(paragraph_meta, ner, sids_injected: bool):
+    p_id = paragraph_meta["p_id"]
+    ner["p_id"] = p_id
+    if sids_injected:
+        line_number, ner["offset"] = get_sentence_and_line_number_by_offset(paragraph_path_of(p_id), ner["offset"])
+        ner["s_id"] = f"{p_id}_{line_number}"
+    return ner
+
+
+def ners_have_sids(file_path=DBPEDIA_NERS) -> bool:
+    if not Path(file_path).is_file():
+        return False
+    with open(file_path, encoding="utf-8") as f:
+        return "s_id" in next(csv.reader(f, delimiter="\t"), [])
+
+
+def paragraph_batches(paragraph_metas):
+    """Batches of (paragraph_meta, text) pairs, one paragraph each if batching is disabled."""
+    if SPOTLIGHT_BATCH_CHARACTERS > 0:
+        yield from make_paragraph_batches(paragraph_metas)
+    else:
+        for paragraph_meta in paragraph_metas:
+            yield [(paragraph_meta, load_file(paragraph_path_of(paragraph_meta["p_id"])))]
+
+
+def annotate_batch(batch, status: AnnotationStatus) -> Optional[List[Tuple[Dict, Dict]]]:
+    """Annotates the paragraphs of `batch` in one request. If it fails, all of them are recorded as failed and None
+    is returned. Successful batches are only recorded by the caller, once their annotations are written."""
+    try:
+        if SPOTLIGHT_BATCH_CHARACTERS > 0:
+            entries = list(extract_dbpedia_ners_from_batch(batch, DBPEDIA_KEY_MAPPING))
+        else:
+            paragraph_meta, text = batch[0]
+            entries = [(paragraph_meta, ner) for ner in extract_dbpedia_ners_from_text(text, DBPEDIA_KEY_MAPPING)]
+    except ANNOTATION_ERRORS as e:
+        status.record([paragraph_meta for paragraph_meta, _ in batch], FAILED, e)
+        return None
+    metrics.incr("annotate.batches")
+    return entries
+
+
+def annotate_paragraphs(paragraph_metas, status: AnnotationStatus):
+    """Annotates `paragraph_metas`, returns the batches that succeeded with their annotations."""
+    results = []
+    for batch in paragraph_batches(paragraph_metas):
+        entries = annotate_batch(batch, status)
+        if entries is not None:
+            results.append((batch, entries))
+    return results
+
+
+def report_annotation_status(status: AnnotationStatus):
+    counts = status.counts()
+    log(f"Paragraph status: {counts['ok']} ok, {counts['empty']} empty, {counts['failed']} failed.")
+    if counts["failed"]:
+        log(f"{counts['failed']} paragraphs could not be annotated, they are listed in {ANNOTATION_DEAD_LETTER}. "
+            f"Run `python make.py retry-failed` to annotate them again.", LogLevel.WARNING)
+
+
 def make_dbpedia_dump():
-    DBPEDIA_KEY_MAPPING = {"@URI": "uri",
-                           "@support": "support",
-                           "@types": "types",
-                           "@surfaceForm": "surfaceForm",
-                           "@offset": "offset",
-                           "@similarityScore": "similarityScore",
-                           "@percentageOfSecondRank": "percentageOfSecondRank"
-                           }
+    # rows written before uids existed still carry the paragraph path
+    add_uids_to_parsed_data()
     paragraph_paths = load_tsv(PARAGRAPH_META)
     already_parsed = set()
     log("Making dbpedia dump..")
     prev_run = load_tsv(DBPEDIA_NERS) if Path(DBPEDIA_NERS).exists() else []
     already_parsed = collect_pid_from_file(prev_run)
     sth = load_paragraph_meta_without_double_p_ids(paragraph_paths)
-    todo = list(filter(lambda elem: not elem["p_id"] in already_parsed, sth))
+    # paragraphs that came back empty or failed are not requested again, failed ones are left to retry-failed
+    status = AnnotationStatus()
+    todo = list(filter(lambda elem: not elem["p_id"] in already_parsed and not status.is_settled(elem["p_id"]), sth))
     if len(already_parsed):
         log(f"Found {len(already_parsed)} already annotated sentences, {len(todo)} left to do..")
+    metrics.incr("annotate.cache_hits", len(sth) - len(todo))
+    metrics.incr("annotate.paragraphs_requested", len(todo))
 
+    # once s_ids were injected, offsets are relative to the sentence, so new rows have to follow suit
+    sids_injected = len(prev_run) > 0 and "s_id" in prev_run[0].keys()
     with open(DBPEDIA_NERS, "w", encoding="utf-8") as outf:
-        header = ["p_id", "uri", "paragraph_path", "support", "surfaceForm", "offset", "similarityScore",
-                  "percentageOfSecondRank"]
-        without_writer = csv.DictWriter(outf, header, delimiter="\t")
+        without_writer = csv.DictWriter(outf, get_ner_header(sids_injected), delimiter="\t")
         without_writer.writeheader()
         for e in prev_run:
             without_writer.writerow(e)
-        for paragraph_meta in tqdm(todo):
-            p_id = paragraph_meta["p_id"]
-            path = paragraph_meta["paragraph_path"]
-            paragraph = load_file(path)
-            for ner in extract_dbpedia_ners_from_text(paragraph, DBPEDIA_KEY_MAPPING):
-                ner["p_id"] = p_id
-                ner["paragraph_path"] = path
-                without_writer.writerow(ner)
+
+        def write(paragraph_meta, ner):
+            without_writer.writerow(make_ner_row(paragraph_meta, ner, sids_injected))
+
+        agreements = []
+        with tqdm(total=len(todo)) as progress:
+            for batch in paragraph_batches(todo):
+                progress.update(len(batch))
+                entries = annotate_batch(batch, status)
+                if entries is None:
+                    continue
+                if len(agreements) < SPOTLIGHT_BATCH_VERIFICATION_SAMPLE and len(batch) > 1:
+                    try:
+                        agreements.append(verify_batch(batch, entries, DBPEDIA_KEY_MAPPING))
+                    except ANNOTATION_ERRORS:
+                        pass
+                    else:
+                        metrics.observe("annotate.batch_agreement", agreements[-1])
+                        if len(agreements) == SPOTLIGHT_BATCH_VERIFICATION_SAMPLE:
+                            _report_batch_agreement(agreements)
+                for paragraph_meta, ner in entries:
+                    write(paragraph_meta, ner)
+                # the status must never claim more than the file holds
+                outf.flush()
+                status.record_annotated(batch, entries)
+        if 0 < len(agreements) < SPOTLIGHT_BATCH_VERIFICATION_SAMPLE:
+            _report_batch_agreement(agreements)
+    status.compact()
+    report_annotation_status(status)
+
+
+@timer
+def retry_failed_annotations(workers=SPOTLIGHT_RETRY_WORKERS):
+    """Annotates the paragraphs in the dead letter file again, one request per paragraph."""
+    status = AnnotationStatus()
+    failed = [row for row in status.failed() if Path(row["paragraph_path"]).is_file()]
+    if not failed:
+        log("No failed paragraphs to retry.")
+        return
+    log(f"Retrying {len(failed)} failed paragraphs..")
+    add_uids_to_parsed_data()
+    sids_injected = ners_have_sids()
+    exists = Path(DBPEDIA_NERS).is_file()
+    lock = threading.Lock()
+    with open(DBPEDIA_NERS, "a", encoding="utf-8") as outf:
+        writer = csv.DictWriter(outf, get_ner_header(sids_injected), delimiter="\t")
+        if not exists:
+            writer.writeheader()
+
+        def retry(paragraph_meta):
+            batch = [(paragraph_meta, load_file(paragraph_path_of(paragraph_meta["p_id"])))]
+            entries = annotate_batch(batch, status)
+            if entries is None:
+                return
+            with lock:
+                writer.writerows(make_ner_row(meta, ner, sids_injected) for meta, ner in entries)
+                outf.flush()
+            status.record_annotated(batch, entries)
+
+        with ThreadPoolExecutor(workers) as pool:
+            for _ in tqdm(pool.map(metrics.bind(retry), failed), total=len(failed)):
+                pass
+    status.compact()
+    report_annotation_status(status)
+
+
+def _report_batch_agreement(agreements):
+    agreement = sum(agreements) / len(agreements)
+    level = LogLevel.INFO if agreement >= SPOTLIGHT_BATCH_MIN_AGREEMENT else LogLevel.WARNING
+    log(f"Batched and per paragraph annotations agree on {agreement:.1%} of the annotations in "
+        f"{len(agreements)} sampled batches.", level)
+    if agreement < SPOTLIGHT_BATCH_MIN_AGREEMENT:
+        log("Consider lowering SPOTLIGHT_BATCH_CHARACTERS or setting it to 0.", LogLevel.WARNING)
 
 
 def filter_for_wikidata_concepts(candidates: List[str]):
@@ -166,13 +456,7 @@ def get_wikidata_entry_from_global_thingy(uri, http):
 
 
 def get_wikidata_equivalent_for_dbpedia_uri(uri, http):
-    dbpedia_query = f"""prefix owl:<http://www.w3.org/2002/07/owl#>
-    SELECT DISTINCT ?sameAs WHERE {{
-    <{uri}> owl:sameAs ?sameAs 
-    FILTER ( strstarts(str(?sameAs), "http://www.wikidata.org/") )
-    }}"""
-    response = http.get(URL_TO_DBPEDIA_ENDPOINT, params={"query": dbpedia_query},
-                        headers={"accept": "application/json"})
+    response = run_sparql(http, URL_TO_DBPEDIA_ENDPOINT, DBPEDIA_SAME_AS, uri=Iri(uri))
 
     resp = response.json()
     entries = []
@@ -205,9 +489,13 @@ def _split_ambiguous_from_unambiguous_linkings(data):
     return ambiguous, unambiguous
 
 
+LINKING_HEADER = ["db_uri", "wd_uri", "keep"]
+
+
 def split_ambiguous_from_unambiguous_linkings(data):
     ambiguous, _ = _split_ambiguous_from_unambiguous_linkings(data)
-    dump_tsv(DBPEDIA_TO_WIKIDATA_AMBIGUOUS, ambiguous)
+    # the header is written even if nothing is ambiguous
+    dump_tsv(DBPEDIA_TO_WIKIDATA_AMBIGUOUS, ambiguous, LINKING_HEADER)
 
 
 def make_dbpedia_to_wikidata_dump(data, dump_path):
@@ -218,7 +506,7 @@ def make_dbpedia_to_wikidata_dump(data, dump_path):
         for uri in sameAs_uris:
             links.append({"db_uri": item, "wd_uri": uri, "keep": ""})
     split_ambiguous_from_unambiguous_linkings(links)
-    dump_tsv(dump_path, links)
+    dump_tsv(dump_path, links, LINKING_HEADER)
 
 
 def sanity_check_db_wd_linking():
@@ -261,23 +549,24 @@ def filter_linking_for_applicables_and_merge(force=False):
     return encountered_errors
 
 
+LINK_WIKIDATA_QUERY = """
+MERGE (db:DBConcept {uri : row.db_uri})
+MERGE (wd:WDConcept {uri : row.wd_uri})
+MERGE (db)-[:owl_sameAs]->(wd)
+MERGE (db)<-[:owl_sameAs]-(wd)
+"""
+
+
 @timer
 def link_dbpedia_with_wikidata(graph: HelloWorldExample, force=False):
-    query = f""" USING PERIODIC COMMIT 5000
-        LOAD CSV WITH HEADERS FROM 'file:///{DBPEDIA_TO_WIKIDATA_INTERNAL}' AS row
-        FIELDTERMINATOR "\t"
-        MERGE (db:DBConcept {{uri : row.db_uri}})
-        MERGE (wd:WDConcept {{uri : row.wd_uri}})
-        MERGE (db)-[:owl_sameAs]->(wd)
-        MERGE (db)<-[:owl_sameAs]-(wd)
-        """
     if not Path(DBPEDIA_TO_WIKIDATA).is_file():
         log(
             f"No link dump found at {DBPEDIA_TO_WIKIDATA}, building now (This will require human intervention later!)..")
         select_query = """MATCH (d:DBConcept)
         RETURN DISTINCT d.uri
         """
-        db_uris = [e["d.uri"] for e in graph.select(select_query)]
+        # read the uris up front, the requests take minutes and would hold the read session open all along
+        db_uris = list(graph.stream_column(select_query))
         make_dbpedia_to_wikidata_dump(db_uris, DBPEDIA_TO_WIKIDATA)
         log("Done.")
         log(LINKING_MANUAL)
@@ -285,28 +574,14 @@ def link_dbpedia_with_wikidata(graph: HelloWorldExample, force=False):
     else:
         encountered_errors = filter_linking_for_applicables_and_merge(force)
         if not encountered_errors or force:
-            graph.execute_query_without_transaction(query)
+            graph.load_file(DBPEDIA_TO_WIKIDATA_INTERNAL, LINK_WIKIDATA_QUERY)
         else:
             log(LINKING_MANUAL)
             sys.exit(1)
 
 
 def query_wd_for_P31(batch, http):
-    baseuri = "https://query.wikidata.org/sparql"
-    query = f"""PREFIX wd: <http://www.wikidata.org/prop/direct/>
-PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
-PREFIX skos: <http://www.w3.org/2004/02/skos/core#>
-
-SELECT DISTINCT ?instance ?class 
-  WHERE {{
-    VALUES (?instance) {{
-        {' '.join(f"(<{elem['wd.uri']}>)" for elem in batch)}
-    }}
-    ?instance wd:P31 ?class.
-  }}
-"""
-    response = http.get(baseuri, params={"query": query},
-                        headers={"accept": "application/json"})
+    response = run_sparql(http, WD_SPARQL_ENDPOINT, WD_INSTANCE_OF, uris=[Iri(uri) for uri in batch])
     resp = response.json()
     entries = []
     if resp:
@@ -319,11 +594,10 @@ SELECT DISTINCT ?instance ?class
 
 @timer
 def _get_classes_for_wd(graph: HelloWorldExample):
-    all_uris = graph.select("MATCH (wd:WDConcept) RETURN DISTINCT wd.uri")
+    all_uris = list(graph.stream_column("MATCH (wd:WDConcept) RETURN DISTINCT wd.uri"))
     http = create_retrying_session()
     data = []
-    batches = [all_uris[i:i + 100] for i in range(0, len(all_uris), 100)]
-    for batch in tqdm(batches):
+    for batch in tqdm(batched(all_uris, 100)):
         for instance, clazz in query_wd_for_P31(batch, http):
             data.append({
                 "instance": instance, "class": clazz})
@@ -335,34 +609,17 @@ def get_classes_for_wd(graph: HelloWorldExample):
         log(f"{WD_CLASSES} does not exist, creating..")
         _get_classes_for_wd(graph)
 
-    query = f"""
-        USING PERIODIC COMMIT 5000
-        LOAD CSV WITH HEADERS FROM 'file:///{WD_CLASSES}' AS row
-        FIELDTERMINATOR "\t"
+    query = """
         MATCH (a:WDConcept)
         WHERE a.uri = row.instance
-        MERGE (b:WDConcept {{uri: row.class}})
+        MERGE (b:WDConcept {uri: row.class})
         MERGE (a)-[:wd_P31]->(b)
         """
-    graph.execute_query_without_transaction(query)
+    graph.load_file(WD_CLASSES, query)
 
 
 def query_wd_for_P279(batch, http):
-    baseuri = "https://query.wikidata.org/sparql"
-    query = f"""PREFIX wd: <http://www.wikidata.org/prop/direct/>
-    PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
-    PREFIX skos: <http://www.w3.org/2004/02/skos/core#>
-
-    SELECT DISTINCT ?class ?superclass 
-      WHERE {{
-        VALUES (?class) {{
-            {' '.join(f"(<{elem}>)" for elem in batch)}
-        }}
-        ?class wd:P279 ?superclass.
-      }}
-    """
-    response = http.get(baseuri, params={"query": query},
-                        headers={"accept": "application/json"})
+    response = run_sparql(http, WD_SPARQL_ENDPOINT, WD_SUBCLASS_OF, uris=[Iri(uri) for uri in batch])
     resp = response.json()
     entries = []
     if resp:
@@ -374,15 +631,14 @@ def query_wd_for_P279(batch, http):
 
 
 def _get_hierarchy_for_wd(graph: HelloWorldExample):
-    uris_to_query = [uri["class.uri"] for uri in graph.select("MATCH (class:WDConcept) RETURN DISTINCT class.uri")]
+    uris_to_query = list(graph.stream_column("MATCH (class:WDConcept) RETURN DISTINCT class.uri"))
     http = create_retrying_session()
     data = []
     depth = 5
     already_queried = set()
     for _ in tqdm(range(depth)):
         tmp = []
-        batches = [uris_to_query[i:i + 100] for i in range(0, len(uris_to_query), 100)]
-        for batch in tqdm(batches, leave=False):
+        for batch in tqdm(batched(uris_to_query, 100), leave=False):
             for clazz, superclazz in query_wd_for_P279(batch, http):
                 already_queried.add(clazz)
                 tmp.append({
@@ -402,37 +658,17 @@ def get_class_hierarchy_for_wd(graph: HelloWorldExample):
     if not Path(WD_HIERARCHY).is_file():
         log(f"{WD_HIERARCHY} does not exist, creating..")
         _get_hierarchy_for_wd(graph)
-    query = f"""
-        USING PERIODIC COMMIT 5000
-        LOAD CSV WITH HEADERS FROM 'file:///{WD_HIERARCHY}' AS row
-        FIELDTERMINATOR "\t"
-        MERGE (class:WDConcept {{uri : row.class}})
-        MERGE (super:WDConcept {{uri : row.superclass}})
+    query = """
+        MERGE (class:WDConcept {uri : row.class})
+        MERGE (super:WDConcept {uri : row.superclass})
         MERGE (class)-[:wd_P279]->(super)
         """
-    graph.execute_query_without_transaction(query)
+    graph.load_file(WD_HIERARCHY, query)
     log("Done.")
 
 
 def query_wd_for_label(batch, http):
-    query = f"""PREFIX wd: <http://www.wikidata.org/prop/direct/>
-    PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
-    PREFIX skos: <http://www.w3.org/2004/02/skos/core#>
-
-    SELECT DISTINCT ?uri ?uriLabel 
-      WHERE {{
-        VALUES (?uri) {{
-            {' '.join(f"(<{elem['wd.uri']}>)" for elem in batch)}
-        }}
-    SERVICE wikibase:label {{
-      bd:serviceParam wikibase:language "en" .
-    }}
-      }}
-    """
-    baseuri = "https://query.wikidata.org/sparql"
-
-    response = http.get(baseuri, params={"query": query},
-                        headers={"accept": "application/json"})
+    response = run_sparql(http, WD_SPARQL_ENDPOINT, WD_LABEL_OF, uris=[Iri(uri) for uri in batch])
     resp = response.json()
     entries = []
     if resp:
@@ -444,12 +680,11 @@ def query_wd_for_label(batch, http):
 
 def _get_label_for_wd(graph: HelloWorldExample):
     query = """MATCH (wd:WDConcept) RETURN DISTINCT wd.uri"""
-    all_uris = graph.select(query)
-    batches = [all_uris[i:i + 100] for i in range(0, len(all_uris), 100)]
+    all_uris = list(graph.stream_column(query))
     data = []
 
     http = create_retrying_session()
-    for batch in tqdm(batches):
+    for batch in tqdm(batched(all_uris, 100)):
         for uri, uri_label in query_wd_for_label(batch, http):
             data.append({"uri": uri, "uri_label": uri_label})
     dump_tsv(WD_LABELS, data)
@@ -462,15 +697,12 @@ def get_label_for_wd(graph: HelloWorldExample):
         log(f"{WD_LABELS} does not exist, creating..")
         _get_label_for_wd(graph)
 
-    query = f"""
-        USING PERIODIC COMMIT 5000
-        LOAD CSV WITH HEADERS FROM 'file:///{WD_LABELS}' AS row
-        FIELDTERMINATOR "\t"
+    query = """
         MATCH (a:WDConcept)
         WHERE a.uri = row.uri
         SET a.label = row.uri_label
         """
-    graph.execute_query_without_transaction(query)
+    graph.load_file(WD_LABELS, query, concurrency=BOLT_WRITERS)
     log("Done.")
 
 
@@ -485,23 +717,8 @@ def extract_bindings_or_empty_list(response: requests.Response) -> Union[List[Di
 
 
 def get_label_and_uri_from_wikidata_for_label_and_type(label, type):
-    query = f"""
-                PREFIX wd: <http://www.wikidata.org/prop/direct/>
-        SELECT DISTINCT ?uri ?label 
-                WHERE {{
-                    VALUES(?label) {{
-                       ( "{label}" )
-                      }}
-                    ?uri ?p ?label
-                     ; wd:P31/wd:P279* <{type}>
-
-               SERVICE wikibase:label {{
-                 bd:serviceParam wikibase:language "en" .
-               }}
-                }}"""
-
-    r = http.get(WD_SPARQL_ENDPOINT, params={'format': 'json', 'query': query})
-    return r
+    # bound as an escaped literal, so labels with quotes or backslashes can't break the query
+    return run_sparql(http, WD_SPARQL_ENDPOINT, WD_ENTITY_BY_LABEL, label=label, type=Iri(type))
 
 
 stupid_capitalization = {
@@ -572,13 +789,5 @@ def annotate_speech_country2(graph):
 
 def batch_add_from_file_to_db_with_entity_label(graph, annotation_file, entity_label):
     log(f"Annotating {entity_label} label from {annotation_file}..")
-    query = f"""
-    LOAD CSV WITH HEADERS FROM 'file:///{annotation_file}' AS row
-    FIELDTERMINATOR ";"
-    MATCH (e:Institution {{name : row.{entity_label}}})
-    SET e:{entity_label}
-    MERGE (w:WDConcept {{uri : row.uri}})
-    MERGE (w)-[:owl_sameAs]->(e)
-    MERGE (w)<-[:owl_sameAs]-(e)
-    """
-    graph.execute_query(query)
+    query = INSTITUTION_ENTITY.text % cypher_name(entity_label)
+    graph.load_file(annotation_file, query, delimiter=";", parameters={"column": entity_label})
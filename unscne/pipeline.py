@@ -0,0 +1,74 @@
+from functools import partial
+
+import config
+from unscne import aggregates, load_meta, ner, spacy_ner
+from unscne.incremental import commit_stage, compute_fingerprints
+from unscne.stages import Stage
+
+
+def record_load_manifest():
+    commit_stage("load", compute_fingerprints())
+
+
+def build_stages(graph):
+    # a stage whose inputs changed runs again on top of what it wrote before, so all of them merge instead of create
+    return [
+        Stage("make", graph.create_indices_and_constraints),
+        Stage("meta", load_meta.load_metadata_into_graph, requires=("make",), inputs=(config.META,),
+              labels=("Meta",)),
+        Stage("sentences", load_meta.load_sentences_into_graph, requires=("make",), inputs=(config.PARSED_DATA,),
+              labels=("Speech", "Paragraph", "Sentence"), relationships=("CONTAINS",)),
+        Stage("link_meta", load_meta.link_meta_to_speeches, requires=("meta", "sentences"),
+              relationships=("HAS_METADATA",), locks=("Speech",)),
+        Stage("next_speech", load_meta.create_next_speech_relation, requires=("link_meta",),
+              relationships=("NEXT",), locks=("Speech",)),
+        Stage("next_sentence", load_meta.create_next_sentence_relation, requires=("sentences",),
+              relationships=("NEXT",), locks=("Sentence",)),
+        Stage("next_paragraph", load_meta.create_next_paragraph_relation, requires=("sentences",),
+              relationships=("NEXT",), locks=("Paragraph",)),
+        Stage("speech_to_nodes", load_meta.add_speech_meta_to_nodes, requires=("sentences",),
+              inputs=(config.SPEAKER,), labels=("Speaker", "Institution", "AgendaItem"),
+              relationships=("SPOKE", "REPRESENTS", "AGENDA1", "AGENDA2", "AGENDA3", "AGENDA"), locks=("Speech",)),
+        Stage("link_text", load_meta.link_paragraph_and_sentence_to_speakers, requires=("speech_to_nodes",),
+              relationships=("SPOKE",), locks=("Paragraph", "Sentence")),
+        Stage("president", load_meta.add_president_label, requires=("speech_to_nodes",), labels=("President",)),
+        Stage("country", ner.annotate_speech_country2, requires=("speech_to_nodes",),
+              inputs=(config.COUNTRY_MAPPING,), labels=("Country",), relationships=("owl_sameAs",),
+              locks=("Institution",)),
+        Stage("annotate_dbpedia", ner.annotate_dbpedia_spotlight_to_sentences, requires=("sentences",),
+              inputs=(config.DBPEDIA_NERS,), labels=("DBConcept",), relationships=("MENTIONS",),
+              locks=("Sentence",)),
+        Stage("spacy", spacy_ner.load_spacy_annotations_into_graph, requires=("sentences",),
+              inputs=(config.SPACY_ENTITIES, config.SPACY_SENTIMENT), labels=("SpacyEntity",),
+              relationships=("SPACY_MENTIONS",), locks=("Sentence",)),
+        Stage("manifest", record_load_manifest,
+              requires=("meta", "sentences", "link_meta", "next_speech", "next_sentence", "next_paragraph",
+                        "speech_to_nodes", "link_text", "president", "annotate_dbpedia")),
+        Stage("link_dbpedia", ner.link_dbpedia_with_wikidata, requires=("annotate_dbpedia", "manifest"),
+              inputs=(config.DBPEDIA_TO_WIKIDATA, config.DBPEDIA_TO_WIKIDATA_AMBIGUOUS),
+              labels=("WDConcept",), relationships=("owl_sameAs",), locks=("DBConcept",)),
+        Stage("aggregates", aggregates.write_aggregates,
+              requires=("country", "link_dbpedia", "link_meta", "speech_to_nodes", "annotate_dbpedia"),
+              inputs=(config.DBPEDIA_NERS, config.DBPEDIA_TO_WIKIDATA_INTERNAL, config.COUNTRY_MAPPING),
+              labels=("Year",), relationships=("MENTIONED", "FREQ"), locks=("Institution", "DBConcept")),
+    ]
+
+
+def finalize_stages(graph, force=False):
+    # each Wikidata step queries the WDConcept nodes its predecessor added, so they form a chain
+    steps = ner
+    if config.ASYNC_ENRICHMENT:
+        # only imported when enabled, it needs the async API of the neo4j driver
+        from unscne import enrichment
+        steps = enrichment
+    return [
+        Stage("link_dbpedia", partial(ner.link_dbpedia_with_wikidata, force=force),
+              inputs=(config.DBPEDIA_TO_WIKIDATA, config.DBPEDIA_TO_WIKIDATA_AMBIGUOUS),
+              labels=("WDConcept",), relationships=("owl_sameAs",), locks=("DBConcept",)),
+        Stage("class", steps.get_classes_for_wd, requires=("link_dbpedia",), outputs=(config.WD_CLASSES,),
+              relationships=("wd_P31",), locks=("WDConcept",)),
+        Stage("hierarchy", steps.get_class_hierarchy_for_wd, requires=("class",), outputs=(config.WD_HIERARCHY,),
+              relationships=("wd_P279",), locks=("WDConcept",)),
+        Stage("labels", steps.get_label_for_wd, requires=("hierarchy",), outputs=(config.WD_LABELS,),
+              locks=("WDConcept",)),
+    ]
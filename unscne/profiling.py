@@ -0,0 +1,137 @@
+import re
+import threading
+from typing import Dict, List, Optional
+
+import neo4j
+
+from config import PROFILE_SAMPLE_ROWS
+from unscne.metrics import metrics
+from unscne.util import log, LogLevel
+
+EXPLAIN = "EXPLAIN"
+PROFILE = "PROFILE"
+
+# operators that usually mean an index or constraint is missing or a pattern is not connected
+SUSPICIOUS_OPERATORS = {
+    "AllNodesScan": "all nodes scan",
+    "NodeByLabelScan": "label scan",
+    "CartesianProduct": "cartesian product",
+    "DirectedAllRelationshipsScan": "all relationships scan",
+    "UndirectedAllRelationshipsScan": "all relationships scan",
+}
+
+SCHEMA_STATEMENT = re.compile(r"^\s*(CREATE|DROP)\s+(CONSTRAINT|INDEX|FULLTEXT|DATABASE)|^\s*CALL\s+(db|apoc)\.",
+                              re.IGNORECASE)
+PERIODIC_COMMIT = re.compile(r"USING\s+PERIODIC\s+COMMIT\s*\d*", re.IGNORECASE)
+SUBQUERY = re.compile(r"CALL\s*{", re.IGNORECASE)
+LOAD_CSV = re.compile(r"(LOAD\s+CSV.*?\s+AS\s+row(\s+FIELDTERMINATOR\s+\S+)?)", re.IGNORECASE | re.DOTALL)
+WRITE_CLAUSE = re.compile(r"\b(MERGE|CREATE|SET|DELETE|DETACH|REMOVE|FOREACH)\b", re.IGNORECASE)
+
+
+def _is_top_level(statement: str, position: int) -> bool:
+    prefix = statement[:position]
+    return all(prefix.count(opening) == prefix.count(closing) for opening, closing in ["()", "{}", "[]"])
+
+
+def make_sample_statement(statement: str, sample_rows: int = PROFILE_SAMPLE_ROWS) -> Optional[str]:
+    """Restricts a statement to the first rows it reads, from a LOAD CSV or the clauses before its first write.
+    Returns None if the statement can't be sampled."""
+    if LOAD_CSV.search(statement):
+        statement = PERIODIC_COMMIT.sub("", statement)
+        return LOAD_CSV.sub(lambda match: f"{match.group(1)}\n    WITH row LIMIT {sample_rows}", statement, count=1)
+    if SUBQUERY.search(statement):
+        # batched deletes and wipes run in inner transactions, which a rolled back transaction can't hold
+        return None
+    for match in WRITE_CLAUSE.finditer(statement):
+        if _is_top_level(statement, match.start()):
+            if not statement[:match.start()].strip():
+                # nothing is read before the write, so there are no rows to limit
+                return None
+            return f"{statement[:match.start()]}WITH * LIMIT {sample_rows}\n{statement[match.start():]}"
+    return None
+
+
+def _operator_name(plan: Dict) -> str:
+    return plan.get("operatorType", "").split("@")[0]
+
+
+def _flatten(plan: Dict, depth=0) -> List[Dict]:
+    args = plan.get("args", {})
+    operator = {
+        "operator": _operator_name(plan),
+        "depth": depth,
+        "details": args.get("Details", ""),
+        "estimated_rows": round(args.get("EstimatedRows", 0.0), 1),
+    }
+    for key, name in [("rows", "rows"), ("dbHits", "db_hits"), ("pageCacheHits", "page_cache_hits"),
+                      ("pageCacheMisses", "page_cache_misses")]:
+        if key in plan:
+            operator[name] = plan[key]
+    operators = [operator]
+    for child in plan.get("children", []):
+        operators.extend(_flatten(child, depth + 1))
+    return operators
+
+
+def summarize_plan(plan: Dict) -> Dict:
+    operators = _flatten(plan)
+    flags = sorted({f"{SUSPICIOUS_OPERATORS[op['operator']]} ({op['details']})".replace(" ()", "")
+                    for op in operators if op["operator"] in SUSPICIOUS_OPERATORS})
+    summary = {"operators": operators, "flags": flags}
+    for key in ["db_hits", "page_cache_hits", "page_cache_misses"]:
+        if any(key in op for op in operators):
+            summary[key] = sum(op.get(key, 0) for op in operators)
+    return summary
+
+
+class QueryProfiler:
+    """Captures the plan of every distinct statement a graph wrapper executes."""
+
+    def __init__(self, mode: str = EXPLAIN, sample_rows: int = PROFILE_SAMPLE_ROWS):
+        if mode not in (EXPLAIN, PROFILE):
+            raise ValueError(f"Unknown profiling mode {mode}, use {EXPLAIN} or {PROFILE}")
+        self.mode = mode
+        self.sample_rows = sample_rows
+        self.plans: Dict[str, Dict] = {}
+        self._lock = threading.Lock()
+        metrics.add_section("query_plans", self.plans)
+
+    def _run_profile(self, driver, statement, parameters):
+        sample = make_sample_statement(statement, self.sample_rows)
+        if sample is None:
+            return EXPLAIN, self._run_explain(driver, statement, parameters)
+        with driver.session() as session:
+            tx = session.begin_transaction()
+            try:
+                summary = tx.run(f"{PROFILE} {sample}", parameters).consume()
+            finally:
+                # a profile runs the statement for real, so the sample is never committed
+                tx.rollback()
+        return f"{PROFILE} (first {self.sample_rows} rows)", summary.profile
+
+    @staticmethod
+    def _run_explain(driver, statement, parameters):
+        with driver.session() as session:
+            return session.run(f"{EXPLAIN} {PERIODIC_COMMIT.sub('', statement)}", parameters).consume().plan
+
+    def capture(self, driver, statement: str, parameters=None):
+        key = " ".join(statement.split())
+        if SCHEMA_STATEMENT.match(key):
+            return
+        with self._lock:
+            if key in self.plans:
+                return
+            self.plans[key] = {"step": metrics.current().name}
+        try:
+            if self.mode == PROFILE:
+                mode, plan = self._run_profile(driver, statement, parameters)
+            else:
+                mode, plan = EXPLAIN, self._run_explain(driver, statement, parameters)
+        except neo4j.exceptions.Neo4jError as e:
+            self.plans[key]["error"] = f"{e.code}: {e.message}"
+            return
+        summary = summarize_plan(plan)
+        summary["mode"] = mode
+        self.plans[key].update(summary)
+        for flag in summary["flags"]:
+            log(f"Query plan in {self.plans[key]['step']} contains a {flag}.", LogLevel.WARNING)
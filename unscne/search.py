@@ -0,0 +1,84 @@
+import datetime
+import re
+from typing import Dict, List, Optional, Union
+
+import config
+from unscne.graph import HelloWorldExample, FULLTEXT_SENTENCE_TEXT, FULLTEXT_WD_LABEL, FULLTEXT_AGENDA_NAME
+
+LUCENE_SPECIAL_CHARACTERS = re.compile(r'([+\-!(){}\[\]^"~*?:\\/]|&&|\|\|)')
+
+DateLike = Union[datetime.date, str, None]
+
+# the page is cut before the speeches and dates are looked up, so that only happens for the sentences returned
+SENTENCE_PAGE = """
+WITH node, score
+ORDER BY score DESC, node.uid
+SKIP $skip LIMIT $limit
+MATCH (speech:Speech)-[:CONTAINS]->(node)
+OPTIONAL MATCH (speech)-[:HAS_METADATA]->(m:Meta)
+RETURN node.uid AS s_uid, node.id AS s_id, node.text AS text, speech.id AS speech, m.date AS date, score
+ORDER BY score DESC, s_uid
+"""
+
+SENTENCE_QUERY = f"""
+CALL db.index.fulltext.queryNodes("{FULLTEXT_SENTENCE_TEXT}", $keyword) YIELD node, score
+{SENTENCE_PAGE}"""
+
+# with a date range the speeches are found through the range index on Meta.date first, the full-text matches are
+# then kept by the speech_uid they carry
+SENTENCE_IN_RANGE_QUERY = f"""
+MATCH (m:Meta) WHERE {{where}}
+MATCH (speech:Speech)-[:HAS_METADATA]->(m)
+WITH collect(speech.uid) AS speeches
+CALL db.index.fulltext.queryNodes("{FULLTEXT_SENTENCE_TEXT}", $keyword) YIELD node, score
+WITH node, score WHERE node.speech_uid IN speeches
+{SENTENCE_PAGE}"""
+
+LABEL_QUERY = """
+CALL db.index.fulltext.queryNodes($index, $keyword) YIELD node, score
+RETURN node.{property} AS {property}, {extra} score
+ORDER BY score DESC
+SKIP $skip LIMIT $limit
+"""
+
+
+def escape(text: str) -> str:
+    """Escapes Lucene syntax, so `text` is searched for literally."""
+    return LUCENE_SPECIAL_CHARACTERS.sub(r"\\\1", text)
+
+
+def _as_date(value: DateLike) -> Optional[datetime.date]:
+    if value is None or isinstance(value, datetime.date):
+        return value
+    return datetime.date.fromisoformat(value)
+
+
+def _run(graph: HelloWorldExample, query, parameters) -> List[Dict]:
+    return [dict(record) for record in graph.stream(query, parameters)]
+
+
+def search_sentences(graph: HelloWorldExample, keyword: str, start: DateLike = None, end: DateLike = None,
+                     skip=0, limit=20) -> List[Dict]:
+    """Sentences matching the Lucene query `keyword` in debates held between `start` and `end` (inclusive), best
+    matches first."""
+    if config.COMPACT_TEXT:
+        # only the text is indexed, which the graph doesn't hold in compact mode
+        raise ValueError("Keyword search needs the sentence texts in the graph, build it with COMPACT_TEXT = False.")
+    parameters = {"keyword": keyword, "start": _as_date(start), "end": _as_date(end), "skip": skip, "limit": limit}
+    bounds = [condition for condition, value in [("m.date >= $start", start), ("m.date <= $end", end)]
+              if value is not None]
+    if bounds:
+        query = SENTENCE_IN_RANGE_QUERY.format(where=" AND ".join(bounds))
+    else:
+        query = SENTENCE_QUERY
+    return _run(graph, query, parameters)
+
+
+def search_concepts(graph: HelloWorldExample, keyword: str, skip=0, limit=20) -> List[Dict]:
+    query = LABEL_QUERY.format(property="label", extra="node.uri AS uri,")
+    return _run(graph, query, {"index": FULLTEXT_WD_LABEL, "keyword": keyword, "skip": skip, "limit": limit})
+
+
+def search_agenda_items(graph: HelloWorldExample, keyword: str, skip=0, limit=20) -> List[Dict]:
+    query = LABEL_QUERY.format(property="name", extra="")
+    return _run(graph, query, {"index": FULLTEXT_AGENDA_NAME, "keyword": keyword, "skip": skip, "limit": limit})
@@ -0,0 +1,158 @@
+import csv
+import time
+from pathlib import Path
+from typing import Set
+
+from tqdm import tqdm
+
+from config import PARSED_DATA, SPACY_ENTITIES, SPACY_SENTIMENT, SPACY_BATCH_SIZE, SPACY_PROCESSES, BOLT_WRITERS
+from unscne.graph import HelloWorldExample
+from unscne.ids import IDS, SENTENCE, add_uids_to_parsed_data
+from unscne.metrics import metrics
+from unscne.util import timer, log, LogLevel, count_lines_in_file, make_annotation_pipeline
+
+ENTITY_HEADER = ["s_uid", "start_char", "end_char", "text", "label"]
+SENTIMENT_HEADER = ["s_uid", "polarity", "subjectivity"]
+
+
+def _migrate_to_uids(path, header):
+    """Rewrites a file written before uids existed, keyed by s_id, to s_uid. Rows of sentences that are not in the
+    id map are dropped, they are annotated again."""
+    if not Path(path).is_file():
+        return
+    with open(path, encoding="utf-8") as f:
+        if "s_id" not in next(csv.reader(f, delimiter="\t"), []):
+            return
+    tmp = f"{path}.tmp"
+    unknown = 0
+    with open(path, encoding="utf-8") as inf, open(tmp, "w", encoding="utf-8") as outf:
+        writer = csv.DictWriter(outf, header, delimiter="\t", extrasaction="ignore")
+        writer.writeheader()
+        for row in csv.DictReader(inf, delimiter="\t"):
+            row["s_uid"] = IDS.get(SENTENCE, row["s_id"])
+            if row["s_uid"] is None:
+                unknown += 1
+                continue
+            writer.writerow(row)
+    Path(tmp).replace(path)
+    log(f"Migrated {path} from s_ids to s_uids.")
+    if unknown:
+        log(f"Dropped {unknown} rows of {path} whose sentences have no uid.", LogLevel.WARNING)
+
+
+def migrate_spacy_files(entities_path=SPACY_ENTITIES, sentiment_path=SPACY_SENTIMENT):
+    add_uids_to_parsed_data()
+    _migrate_to_uids(entities_path, ENTITY_HEADER)
+    _migrate_to_uids(sentiment_path, SENTIMENT_HEADER)
+
+
+def _collect_annotated_sentences(sentiment_path) -> Set[str]:
+    # every annotated sentence gets exactly one sentiment row, which is only written once its entities are flushed
+    if not Path(sentiment_path).is_file():
+        return set()
+    with open(sentiment_path, encoding="utf-8") as f:
+        return {row["s_uid"] for row in csv.DictReader(f, delimiter="\t")}
+
+
+def _drop_entities_of_unfinished_sentences(entities_path, done: Set[str]):
+    if not Path(entities_path).is_file():
+        return
+    tmp = f"{entities_path}.tmp"
+    with open(entities_path, encoding="utf-8") as inf, open(tmp, "w", encoding="utf-8") as outf:
+        writer = csv.DictWriter(outf, ENTITY_HEADER, delimiter="\t")
+        writer.writeheader()
+        for row in csv.DictReader(inf, delimiter="\t"):
+            if row["s_uid"] in done:
+                writer.writerow(row)
+    Path(tmp).replace(entities_path)
+
+
+def _open_for_append(path, header):
+    exists = Path(path).is_file()
+    f = open(path, "a", encoding="utf-8")
+    writer = csv.DictWriter(f, header, delimiter="\t")
+    if not exists:
+        writer.writeheader()
+    return f, writer
+
+
+def _flush_batch(entities_file, sentiment_file, sentiment_writer, pending):
+    # a sentiment row marks its sentence as done, so it must not reach the disk before the entities of the sentence
+    entities_file.flush()
+    sentiment_writer.writerows(pending)
+    sentiment_file.flush()
+    pending.clear()
+
+
+def _generate_todo(source, done: Set[str]):
+    with open(source, encoding="utf-8") as f:
+        for row in csv.DictReader(f, delimiter="\t"):
+            if row["s_uid"] not in done:
+                yield row["text"], row["s_uid"]
+
+
+@timer
+def annotate_sentences_with_spacy(source=PARSED_DATA, entities_path=SPACY_ENTITIES, sentiment_path=SPACY_SENTIMENT,
+                                  batch_size=SPACY_BATCH_SIZE, n_process=SPACY_PROCESSES):
+    log("Annotating sentences with spacy NER and sentiment..")
+    migrate_spacy_files(entities_path, sentiment_path)
+    done = _collect_annotated_sentences(sentiment_path)
+    _drop_entities_of_unfinished_sentences(entities_path, done)
+    total = count_lines_in_file(source) - 1
+    if len(done):
+        log(f"Found {len(done)} already annotated sentences, {total - len(done)} left to do..")
+    metrics.incr("spacy.cache_hits", len(done))
+    nlp = make_annotation_pipeline()
+    entities_file, entities_writer = _open_for_append(entities_path, ENTITY_HEADER)
+    sentiment_file, sentiment_writer = _open_for_append(sentiment_path, SENTIMENT_HEADER)
+    started = time.time()
+    annotated = 0
+    pending = []
+    try:
+        docs = nlp.pipe(_generate_todo(source, done), as_tuples=True, batch_size=batch_size, n_process=n_process)
+        for doc, s_uid in tqdm(docs, total=total - len(done)):
+            for ent in doc.ents:
+                entities_writer.writerow({"s_uid": s_uid, "start_char": ent.start_char, "end_char": ent.end_char,
+                                          "text": ent.text.replace("\t", " "), "label": ent.label_})
+                metrics.incr("spacy.entities")
+            pending.append({"s_uid": s_uid, "polarity": round(doc._.polarity, 4),
+                            "subjectivity": round(doc._.subjectivity, 4)})
+            annotated += 1
+            if len(pending) >= batch_size:
+                _flush_batch(entities_file, sentiment_file, sentiment_writer, pending)
+    finally:
+        _flush_batch(entities_file, sentiment_file, sentiment_writer, pending)
+        entities_file.close()
+        sentiment_file.close()
+    elapsed = time.time() - started
+    if annotated and elapsed > 0:
+        per_core = annotated / elapsed / max(1, n_process)
+        metrics.incr("spacy.sentences", annotated)
+        metrics.observe("spacy.sentences_per_s_per_core", per_core)
+        log(f"Annotated {annotated} sentences in {elapsed:.0f} s, {per_core:.1f} sentences/s per core "
+            f"({n_process} processes).")
+    log("Done.")
+
+
+@timer
+def load_spacy_annotations_into_graph(graph: HelloWorldExample, entities_path=SPACY_ENTITIES,
+                                      sentiment_path=SPACY_SENTIMENT):
+    if not Path(sentiment_path).is_file():
+        log(f"File with spacy annotations does not exist ({sentiment_path}).", LogLevel.WARNING)
+        return
+    migrate_spacy_files(entities_path, sentiment_path)
+    log("Loading spacy sentiment..")
+    sentiment = """
+    MATCH (s:Sentence {uid: toInteger(row.s_uid)})
+    SET s.polarity = toFloat(row.polarity), s.subjectivity = toFloat(row.subjectivity)
+    """
+    graph.load_file(sentiment_path, sentiment, concurrency=BOLT_WRITERS)
+    log("Loading spacy entities..")
+    # a type of its own keeps them apart from the DBpedia MENTIONS, merging on the span lets the stage rerun
+    entities = """
+    MATCH (s:Sentence {uid: toInteger(row.s_uid)})
+    MERGE (e:SpacyEntity {text: row.text, label: row.label})
+    MERGE (s)-[:SPACY_MENTIONS {start_char: toInteger(row.start_char), end_char: toInteger(row.end_char)}]->(e)
+    """
+    graph.load_file(entities_path, entities)
+    log("Done.")
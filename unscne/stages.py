@@ -0,0 +1,167 @@
+import csv
+import datetime
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from dataclasses import dataclass
+from inspect import signature
+from pathlib import Path
+from typing import Callable, Tuple, Dict, List, Iterable, Optional
+
+from config import CHECKPOINTS, MAX_PARALLEL_STAGES
+from unscne.graph import HelloWorldExample
+from unscne.metrics import metrics
+from unscne.util import log, LogLevel
+
+
+@dataclass
+class Stage:
+    name: str
+    func: Callable
+    requires: Tuple[str, ...] = ()
+    # files read / written by the stage
+    inputs: Tuple[str, ...] = ()
+    outputs: Tuple[str, ...] = ()
+    # node labels and relationship types the stage writes into the graph
+    labels: Tuple[str, ...] = ()
+    relationships: Tuple[str, ...] = ()
+    # node labels the stage attaches relationships to, stages sharing one never run at the same time
+    locks: Tuple[str, ...] = ()
+
+
+def load_checkpoints(path=CHECKPOINTS) -> Dict[str, Dict[str, str]]:
+    if not Path(path).is_file():
+        return {}
+    with open(path, encoding="utf-8") as f:
+        return {row["stage"]: row for row in csv.DictReader(f, delimiter="\t")}
+
+
+def write_checkpoints(checkpoints: Dict[str, Dict[str, str]], path=CHECKPOINTS):
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, ["stage", "fingerprint", "finished"], delimiter="\t")
+        writer.writeheader()
+        for name in sorted(checkpoints.keys()):
+            writer.writerow(checkpoints[name])
+
+
+def _describe_file(path) -> str:
+    if not Path(path).exists():
+        return f"{path}:missing"
+    stat = Path(path).stat()
+    return f"{path}:{stat.st_size}:{stat.st_mtime_ns}"
+
+
+class StageScheduler:
+
+    def __init__(self, graph: HelloWorldExample, stages: Iterable[Stage], checkpoint_path=CHECKPOINTS,
+                 max_workers=MAX_PARALLEL_STAGES):
+        self.graph = graph
+        self.stages = {stage.name: stage for stage in stages}
+        self.checkpoint_path = checkpoint_path
+        self.checkpoints = load_checkpoints(checkpoint_path)
+        self.max_workers = max_workers
+        self._lock = threading.Lock()
+        for stage in self.stages.values():
+            for requirement in stage.requires:
+                if requirement not in self.stages:
+                    raise ValueError(f"Stage {stage.name} requires unknown stage {requirement}")
+
+    def fingerprint(self, stage: Stage) -> str:
+        parts = [_describe_file(path) for path in stage.inputs]
+        for requirement in stage.requires:
+            checkpoint = self.checkpoints.get(requirement, {})
+            parts.append(f"{requirement}:{checkpoint.get('fingerprint')}:{checkpoint.get('finished')}")
+        return hashlib.sha1("\n".join(parts).encode("utf-8")).hexdigest()
+
+    def _graph_outputs_present(self, stage: Stage) -> bool:
+        for label in stage.labels:
+            if not self.graph.select(f"MATCH (n:`{label}`) RETURN count(n) > 0")[0][0]:
+                return False
+        for rel_type in stage.relationships:
+            if not self.graph.select(f"MATCH ()-[r:`{rel_type}`]->() RETURN count(r) > 0")[0][0]:
+                return False
+        return True
+
+    def is_valid(self, stage: Stage) -> bool:
+        checkpoint = self.checkpoints.get(stage.name)
+        if checkpoint is None or checkpoint["fingerprint"] != self.fingerprint(stage):
+            return False
+        if not all(Path(path).exists() for path in stage.outputs):
+            return False
+        return self._graph_outputs_present(stage)
+
+    def _closure(self, targets: Iterable[str]) -> List[str]:
+        ordered = []
+
+        def visit(name, trail):
+            if name in trail:
+                raise ValueError(f"Cycle in stage dependencies: {' -> '.join(trail + (name,))}")
+            if name in ordered:
+                return
+            for requirement in self.stages[name].requires:
+                visit(requirement, trail + (name,))
+            ordered.append(name)
+
+        for target in targets:
+            visit(target, ())
+        return ordered
+
+    def _call(self, stage: Stage):
+        log(f"Calling {stage.name}")
+        with metrics.span(f"stage.{stage.name}"):
+            if len(signature(stage.func).parameters) == 0:
+                stage.func()
+            else:
+                stage.func(self.graph)
+
+    def _finish(self, stage: Stage):
+        with self._lock:
+            self.checkpoints[stage.name] = {"stage": stage.name, "fingerprint": self.fingerprint(stage),
+                                            "finished": f"{datetime.datetime.now():%Y-%m-%dT%H:%M:%S.%f}"}
+            write_checkpoints(self.checkpoints, self.checkpoint_path)
+
+    def run(self, targets: Optional[Iterable[str]] = None, force: bool = False):
+        """Runs `targets` (all stages by default) and whatever they require that is not checkpointed yet.
+
+        Independent stages run concurrently. With `force`, the targets themselves are rerun even if valid.
+        """
+        targets = list(self.stages.keys()) if targets is None else list(targets)
+        forced = set(targets) if force else set()
+        pending = self._closure(targets)
+        done = set()
+        running = {}
+        failed = None
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while pending or running:
+                if failed is None:
+                    for name in list(pending):
+                        stage = self.stages[name]
+                        if not all(requirement in done for requirement in stage.requires):
+                            continue
+                        held = {lock for other in running.values() for lock in other.locks}
+                        if held.intersection(stage.locks) or len(running) >= self.max_workers:
+                            continue
+                        pending.remove(name)
+                        if name not in forced and self.is_valid(stage):
+                            log(f"Skipping {name}, its outputs are still valid.")
+                            metrics.incr("stages_skipped")
+                            done.add(name)
+                            continue
+                        running[executor.submit(metrics.bind(self._call), stage)] = stage
+                if not running:
+                    if failed is not None or not pending:
+                        break
+                    continue
+                finished, _ = wait(running.keys(), return_when=FIRST_COMPLETED)
+                for future in finished:
+                    stage = running.pop(future)
+                    exception = future.exception()
+                    if exception is not None:
+                        log(f"Stage {stage.name} failed: {exception!r}", LogLevel.ERROR)
+                        failed = failed or exception
+                    else:
+                        self._finish(stage)
+                        done.add(stage.name)
+        if failed is not None:
+            raise failed
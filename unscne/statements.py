@@ -0,0 +1,196 @@
+import re
+import string
+import threading
+from collections import Counter
+from typing import Dict, NamedTuple
+
+from unscne.metrics import metrics
+
+CYPHER = "cypher"
+SPARQL = "sparql"
+
+# characters that may not appear in an IRIREF, see the SPARQL 1.1 grammar
+INVALID_IRI_CHARACTERS = re.compile(r'[\x00-\x20<>"{}|^`\\]')
+SPARQL_ESCAPES = {"\\": "\\\\", '"': '\\"', "'": "\\'", "\n": "\\n", "\r": "\\r", "\t": "\\t", "\b": "\\b",
+                  "\f": "\\f"}
+CYPHER_IDENTIFIER = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+
+# string and number literals and IRIs, blanked out to tell statements apart that only differ in their values
+LITERALS = re.compile(r"'(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\"|<[^<>\s]+>|\b\d+(?:\.\d+)?\b")
+VALUE_ROWS = re.compile(r"(\(\s*\?\s*\)\s*)+")
+WHITESPACE = re.compile(r"\s+")
+
+
+class Iri(str):
+    """Marks a SPARQL binding as an IRI instead of a string literal."""
+
+
+def sparql_literal(value: str) -> str:
+    return '"' + "".join(SPARQL_ESCAPES.get(character, character) for character in value) + '"'
+
+
+def sparql_iri(value: str) -> str:
+    if INVALID_IRI_CHARACTERS.search(value):
+        raise ValueError(f"Not a valid IRI: {value!r}")
+    return f"<{value}>"
+
+
+def sparql_term(value) -> str:
+    if isinstance(value, Iri):
+        return sparql_iri(value)
+    if isinstance(value, str):
+        return sparql_literal(value)
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, (int, float)):
+        return repr(value)
+    # anything iterable becomes the rows of a VALUES block
+    return " ".join(f"({sparql_term(item)})" for item in value)
+
+
+def cypher_name(name: str) -> str:
+    """Labels and relationship types can't be parameters. Plain names are used as they are, others are quoted."""
+    if CYPHER_IDENTIFIER.match(name):
+        return name
+    return "`" + name.replace("`", "``") + "`"
+
+
+class Statement(NamedTuple):
+    name: str
+    kind: str
+    text: str
+
+    def bind(self, **bindings) -> str:
+        """Renders a SPARQL template. Every `$name` is replaced by its binding as an escaped RDF term: `Iri` as an
+        IRI, strings as literals and lists as VALUES rows. Cypher statements get their values as driver parameters."""
+        if self.kind != SPARQL:
+            raise ValueError(f"{self.name} is a {self.kind} statement, pass its values as parameters.")
+        return string.Template(self.text).substitute({key: sparql_term(value) for key, value in bindings.items()})
+
+
+CATALOG: Dict[str, Statement] = {}
+
+
+def register(name: str, text: str, kind=CYPHER) -> Statement:
+    if name in CATALOG:
+        raise ValueError(f"Statement {name} is already registered.")
+    statement = CATALOG[name] = Statement(name, kind, text)
+    return statement
+
+
+def shape(text: str) -> str:
+    return WHITESPACE.sub(" ", VALUE_ROWS.sub("(?)* ", LITERALS.sub("?", text))).strip()
+
+
+class PlanCacheTracker:
+    """Neo4j caches query plans by statement text, so every execution of a text that ran before can reuse its plan.
+    The hit rate is the share of executions whose text is not new. Texts are also grouped by their shape, with
+    literals blanked out. A shape with many texts belongs to a statement that interpolates values instead of taking
+    parameters. SPARQL endpoints don't take parameters at all, their VALUES blocks always differ."""
+
+    def __init__(self):
+        self.texts: Dict[str, Counter] = {CYPHER: Counter(), SPARQL: Counter()}
+        self._lock = threading.Lock()
+
+    def record(self, kind: str, text: str):
+        with self._lock:
+            self.texts[kind][text] += 1
+
+    def summary(self, kind: str) -> Dict:
+        with self._lock:
+            texts = Counter(self.texts[kind])
+        executions = sum(texts.values())
+        shapes = Counter(shape(text) for text in texts)
+        return {
+            "executions": executions,
+            "distinct_texts": len(texts),
+            "hit_rate": round((executions - len(texts)) / executions, 4) if executions else None,
+            "interpolated": [{"shape": text[:300], "texts": count} for text, count in shapes.most_common(10)
+                             if count > 1],
+        }
+
+    def report(self) -> Dict:
+        return {kind: self.summary(kind) for kind in self.texts}
+
+
+plan_cache = PlanCacheTracker()
+metrics.add_section("plan_cache", plan_cache.report)
+
+
+def run_sparql(http, endpoint, statement: Statement, **bindings):
+    text = statement.bind(**bindings)
+    plan_cache.record(SPARQL, text)
+    return http.get(endpoint, params={"query": text}, headers={"accept": "application/json"})
+
+
+WD_INSTANCE_OF = register("wd_instance_of", """PREFIX wd: <http://www.wikidata.org/prop/direct/>
+SELECT DISTINCT ?instance ?class
+  WHERE {
+    VALUES (?instance) { $uris }
+    ?instance wd:P31 ?class.
+  }
+""", SPARQL)
+
+WD_SUBCLASS_OF = register("wd_subclass_of", """PREFIX wd: <http://www.wikidata.org/prop/direct/>
+SELECT DISTINCT ?class ?superclass
+  WHERE {
+    VALUES (?class) { $uris }
+    ?class wd:P279 ?superclass.
+  }
+""", SPARQL)
+
+WD_LABEL_OF = register("wd_label_of", """SELECT DISTINCT ?uri ?uriLabel
+  WHERE {
+    VALUES (?uri) { $uris }
+    SERVICE wikibase:label {
+      bd:serviceParam wikibase:language "en" .
+    }
+  }
+""", SPARQL)
+
+WD_ENTITY_BY_LABEL = register("wd_entity_by_label", """PREFIX wd: <http://www.wikidata.org/prop/direct/>
+SELECT DISTINCT ?uri ?label
+  WHERE {
+    VALUES (?label) { ($label) }
+    ?uri ?p ?label ;
+         wd:P31/wd:P279* $type .
+    SERVICE wikibase:label {
+      bd:serviceParam wikibase:language "en" .
+    }
+  }
+""", SPARQL)
+
+DBPEDIA_SAME_AS = register("dbpedia_same_as", """PREFIX owl: <http://www.w3.org/2002/07/owl#>
+SELECT DISTINCT ?sameAs
+  WHERE {
+    $uri owl:sameAs ?sameAs
+    FILTER ( strstarts(str(?sameAs), "http://www.wikidata.org/") )
+  }
+""", SPARQL)
+
+# the text is stored in full, or only as a preview if the text store holds it. main.tsv has no s_id column, the
+# path style id of a sentence is the one of its paragraph followed by its index
+LOAD_SENTENCES = register("load_sentences", """
+MERGE (s:Sentence {uid: toInteger(row.s_uid)})
+SET s.index = toInteger(row.s_index), s.speech_uid = toInteger(row.speech_uid),
+    s.index_in_speech = toInteger(row.s_index_in_speech), s.id = row.p_id + '_' + row.s_index,
+    s.text = CASE WHEN $compact THEN null ELSE row.text END,
+    s.preview = CASE WHEN $compact THEN left(row.text, $preview_characters) END
+MERGE (p:Paragraph {uid: toInteger(row.p_uid)})
+ON CREATE SET p.index = toInteger(row.p_index), p.id = row.p_id, p.speech_uid = toInteger(row.speech_uid),
+    p.index_in_speech = toInteger(row.p_index_in_speech)
+MERGE (sp:Speech {uid: toInteger(row.speech_uid)})
+ON CREATE SET sp.basename = row.speech_basename, sp.id = row.speech_name, sp.filename = row.filename
+MERGE (sp)-[:CONTAINS]->(p)
+MERGE (sp)-[:CONTAINS]->(s)
+MERGE (p)-[:CONTAINS]->(s)
+""")
+
+# only the label is spliced in, as a quoted name, the column holding the institution name is a parameter
+INSTITUTION_ENTITY = register("institution_entity", """
+MATCH (e:Institution {name: row[$column]})
+SET e:%s
+MERGE (w:WDConcept {uri: row.uri})
+MERGE (w)-[:owl_sameAs]->(e)
+MERGE (w)<-[:owl_sameAs]-(e)
+""")
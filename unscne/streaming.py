@@ -0,0 +1,251 @@
+import csv
+import queue
+import shutil
+import threading
+from collections import defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Set
+
+import config
+from unscne import load_meta
+from unscne.ids import IDS, add_uids_to_parsed_data
+from unscne.incremental import commit_stage, compute_fingerprints, filter_tsv, speech_name_of_paragraph
+from unscne.load_meta import get_speech_name
+from unscne.metrics import metrics
+from unscne.annotation_status import AnnotationStatus
+from unscne.ner import annotate_paragraphs, get_ner_header, make_ner_row, ners_have_sids, report_annotation_status
+from unscne.util import timer, log, get_speech_file_paths
+
+PARSED = "parsed.tsv"
+ANNOTATED = "annotated.tsv"
+
+
+class Checkpoint:
+    """Append only list of the speeches a stage has finished."""
+
+    def __init__(self, path):
+        self.path = path
+        self.names: Set[str] = set()
+        if Path(path).is_file():
+            with open(path, encoding="utf-8") as f:
+                self.names = {line.strip() for line in f if line.strip()}
+        self._file = open(path, "a", encoding="utf-8")
+
+    def add(self, names: List[str]):
+        self._file.write("".join(f"{name}\n" for name in names))
+        self._file.flush()
+        self.names.update(names)
+
+    def __contains__(self, name):
+        return name in self.names
+
+    def __len__(self):
+        return len(self.names)
+
+    def close(self):
+        self._file.close()
+
+
+class _TsvAppender:
+
+    def __init__(self, path, fieldnames=None):
+        self._file = None
+        self.path = path
+        self.writer = None
+        if Path(path).is_file() and Path(path).stat().st_size > 0:
+            with open(path, encoding="utf-8") as f:
+                fieldnames = next(csv.reader(f, delimiter="\t"))
+            self._open(fieldnames, header=False)
+        elif fieldnames is not None:
+            self._open(fieldnames, header=True)
+
+    def _open(self, fieldnames, header):
+        self._file = open(self.path, "a" if not header else "w", encoding="utf-8")
+        self.writer = csv.DictWriter(self._file, fieldnames, delimiter="\t")
+        if header:
+            self.writer.writeheader()
+
+    def write(self, rows):
+        if not rows:
+            return
+        if self.writer is None:
+            # the columns of main.tsv are only known from its first row
+            self._open(list(rows[0].keys()), header=True)
+        self.writer.writerows(rows)
+
+    def flush(self):
+        if self._file is not None:
+            self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+
+
+def _keep_only(path, keep):
+    if not Path(path).is_file():
+        return
+    tmp = f"{path}.tmp"
+    filter_tsv(path, tmp, keep)
+    shutil.move(tmp, path)
+
+
+def _speeches_in(path) -> Set[str]:
+    with open(path, encoding="utf-8") as f:
+        return {row["speech_name"] for row in csv.DictReader(f, delimiter="\t")}
+
+
+def _paragraphs_by_speech(speeches: Set[str]) -> Dict[str, List[Dict[str, str]]]:
+    paragraphs = defaultdict(list)
+    if Path(config.PARAGRAPH_META).is_file():
+        with open(config.PARAGRAPH_META, encoding="utf-8") as f:
+            for row in csv.DictReader(f, delimiter="\t"):
+                speech_name = speech_name_of_paragraph(row["p_id"])
+                if speech_name in speeches:
+                    paragraphs[speech_name].append(row)
+    return paragraphs
+
+
+def _annotated_paragraphs() -> Set[str]:
+    if not Path(config.DBPEDIA_NERS).is_file():
+        return set()
+    with open(config.DBPEDIA_NERS, encoding="utf-8") as f:
+        return {row["p_id"] for row in csv.DictReader(f, delimiter="\t")}
+
+
+class _NerWriter:
+    """Writes the annotations of a speech and checkpoints it in one step, shared by all annotators."""
+
+    def __init__(self, annotated: Checkpoint, status: AnnotationStatus, sids_injected: bool):
+        self.annotated = annotated
+        self.status = status
+        self.sids_injected = sids_injected
+        self.out = _TsvAppender(config.DBPEDIA_NERS, get_ner_header(sids_injected))
+        self._lock = threading.Lock()
+
+    def write(self, speech_name, results):
+        rows = [make_ner_row(paragraph_meta, ner, self.sids_injected)
+                for _, entries in results for paragraph_meta, ner in entries]
+        with self._lock:
+            self.out.write(rows)
+            self.out.flush()
+            for batch, entries in results:
+                self.status.record_annotated(batch, entries)
+            self.annotated.add([speech_name])
+        metrics.incr("pipeline.speeches_annotated")
+
+    def close(self):
+        self.out.close()
+
+
+def _annotate(todo: "queue.Queue", writer: _NerWriter):
+    while True:
+        item = todo.get()
+        if item is None:
+            return
+        speech_name, paragraphs = item
+        writer.write(speech_name, annotate_paragraphs(paragraphs, writer.status))
+
+
+def _put(todo: "queue.Queue", annotators: List[Future], item):
+    while True:
+        for annotator in annotators:
+            if annotator.done():
+                # annotators only stop early if they failed, result() raises their exception
+                annotator.result()
+        try:
+            todo.put(item, timeout=1)
+            return
+        except queue.Full:
+            pass
+
+
+def _prepare_checkpoints(folder) -> bool:
+    """Drops what a previous run wrote past its last checkpoint. Returns whether this run resumes one."""
+    Path(folder).mkdir(parents=True, exist_ok=True)
+    if not Path(folder, PARSED).is_file():
+        return False
+    parsed = Checkpoint(Path(folder, PARSED))
+    annotated = Checkpoint(Path(folder, ANNOTATED))
+    parsed.close()
+    annotated.close()
+    _keep_only(config.PARSED_DATA, lambda row: row["speech_name"] in parsed)
+    _keep_only(config.PARAGRAPH_META, lambda row: speech_name_of_paragraph(row["p_id"]) in parsed)
+    for path in (config.DBPEDIA_NERS, config.ANNOTATION_STATUS, config.ANNOTATION_DEAD_LETTER):
+        _keep_only(path, lambda row: speech_name_of_paragraph(row["p_id"]) in annotated)
+    log(f"Resuming with {len(parsed)} parsed and {len(annotated)} annotated speeches..")
+    return True
+
+
+@timer
+def run_pipeline(folder=config.PIPELINE_FOLDER, annotators=config.PIPELINE_ANNOTATORS,
+                 queue_size=config.PIPELINE_QUEUE_SIZE, checkpoint_every=config.PIPELINE_CHECKPOINT_EVERY):
+    """Parses the corpus and annotates it with DBpedia Spotlight at the same time. Each parsed speech is handed to
+    the annotators through a bounded queue, so parsing never runs more than `queue_size` speeches ahead."""
+    fingerprints = compute_fingerprints()
+    resuming = _prepare_checkpoints(folder)
+    parsed = Checkpoint(Path(folder, PARSED))
+    annotated = Checkpoint(Path(folder, ANNOTATED))
+    # the appenders below keep the columns of the files they append to
+    add_uids_to_parsed_data()
+    if not resuming and Path(config.PARSED_DATA).is_file():
+        # a finished `make.py parse`, only the annotation is left to do
+        load_meta.add_positions_to_parsed_data()
+        parsed.add(sorted(_speeches_in(config.PARSED_DATA)))
+    # without checkpoints of their own, earlier annotations are only known by paragraph
+    done_paragraphs = set() if resuming else _annotated_paragraphs()
+    pending = _paragraphs_by_speech(parsed.names - annotated.names)
+    main = _TsvAppender(config.PARSED_DATA)
+    paragraph_meta = _TsvAppender(config.PARAGRAPH_META, ["p_id", "p_uid"])
+    status = AnnotationStatus()
+    writer = _NerWriter(annotated, status, ners_have_sids())
+    todo = queue.Queue(maxsize=queue_size)
+    unsaved: List[str] = []
+
+    def checkpoint_parsed():
+        main.flush()
+        paragraph_meta.flush()
+        # rows in main.tsv are only kept on resume once the uids they carry are saved
+        IDS.save()
+        parsed.add(unsaved)
+        unsaved.clear()
+
+    with ThreadPoolExecutor(annotators) as pool:
+        futures = [pool.submit(metrics.bind(_annotate), todo, writer) for _ in range(annotators)]
+        try:
+            for path in sorted(get_speech_file_paths(to_list=True), key=lambda p: p.name):
+                speech_name = get_speech_name(path.name)
+                if speech_name in parsed:
+                    if speech_name in annotated:
+                        continue
+                    paragraphs = pending.pop(speech_name, [])
+                else:
+                    indices, paragraphs = load_meta.parse_speech_file(path)
+                    main.write(indices)
+                    paragraph_meta.write(paragraphs)
+                    metrics.incr("pipeline.speeches_parsed")
+                    unsaved.append(speech_name)
+                    if len(unsaved) >= checkpoint_every:
+                        checkpoint_parsed()
+                    if speech_name in annotated:
+                        # annotated before the last run could checkpoint its parse
+                        continue
+                paragraphs = [p for p in paragraphs
+                              if str(p["p_id"]) not in done_paragraphs and not status.is_settled(p["p_id"])]
+                _put(todo, futures, (speech_name, paragraphs))
+            checkpoint_parsed()
+        finally:
+            for future in futures:
+                if not future.done():
+                    todo.put(None)
+        for future in futures:
+            future.result()
+    for f in (main, paragraph_meta, writer, parsed, annotated):
+        f.close()
+    status.compact()
+    commit_stage("parse", fingerprints)
+    commit_stage("annotate", fingerprints)
+    shutil.rmtree(folder)
+    log(f"Parsed and annotated {len(annotated)} speeches.")
+    report_annotation_status(status)
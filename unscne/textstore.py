@@ -0,0 +1,150 @@
+import csv
+import hashlib
+import json
+import threading
+import zlib
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from tqdm import tqdm
+
+from config import PARSED_DATA, TEXT_STORE, TEXT_STORE_CHUNK_SIZE, TEXT_STORE_CACHE_CHUNKS
+from unscne.ids import add_uids_to_parsed_data
+from unscne.metrics import metrics
+from unscne.util import timer, log, LogLevel, count_lines_in_file
+
+TEXTS = "texts.bin"
+CHUNKS = "chunks.tsv"
+SENTENCES = "sentences.tsv"
+
+
+class _ChunkWriter:
+
+    def __init__(self, f, chunk_size):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.pending: List[str] = []
+        self.chunks: List[Tuple[int, int]] = []
+        self.offset = 0
+
+    def add(self, text) -> Tuple[int, int]:
+        location = (len(self.chunks), len(self.pending))
+        self.pending.append(text)
+        if len(self.pending) >= self.chunk_size:
+            self.flush()
+        return location
+
+    def flush(self):
+        if not self.pending:
+            return
+        compressed = zlib.compress(json.dumps(self.pending, ensure_ascii=False).encode("utf-8"), 9)
+        self.f.write(compressed)
+        self.chunks.append((self.offset, len(compressed)))
+        self.offset += len(compressed)
+        self.pending = []
+
+
+@timer
+def build_text_store(source=PARSED_DATA, target=TEXT_STORE, chunk_size=TEXT_STORE_CHUNK_SIZE):
+    """Writes every distinct sentence text of `source` once into zlib compressed chunks of `chunk_size` texts."""
+    log(f"Building text store in {target}..")
+    add_uids_to_parsed_data()
+    Path(target).mkdir(parents=True, exist_ok=True)
+    seen: Dict[bytes, Tuple[int, int]] = {}
+    raw = duplicates = 0
+    # written next to the old store and swapped in at the end, so readers never see a half written one
+    with open(Path(target, f"{TEXTS}.tmp"), "wb") as texts, \
+            open(Path(target, f"{SENTENCES}.tmp"), "w", encoding="utf-8", newline="") as sentences, \
+            open(source, encoding="utf-8") as inf:
+        chunks = _ChunkWriter(texts, chunk_size)
+        writer = csv.writer(sentences, delimiter="\t")
+        writer.writerow(["s_uid", "chunk", "position"])
+        for row in tqdm(csv.DictReader(inf, delimiter="\t"), total=count_lines_in_file(source) - 1):
+            text = row["text"]
+            raw += len(text.encode("utf-8"))
+            # 8 byte digests keep the dedup table small, collisions are negligible at corpus size
+            digest = hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest()
+            location = seen.get(digest)
+            if location is None:
+                location = seen[digest] = chunks.add(text)
+            else:
+                duplicates += 1
+            writer.writerow([row["s_uid"], *location])
+        chunks.flush()
+    with open(Path(target, f"{CHUNKS}.tmp"), "w", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f, delimiter="\t")
+        writer.writerow(["chunk", "offset", "length"])
+        writer.writerows((i, offset, length) for i, (offset, length) in enumerate(chunks.chunks))
+    for name in (TEXTS, SENTENCES, CHUNKS):
+        Path(target, f"{name}.tmp").replace(Path(target, name))
+    metrics.incr("textstore.raw_bytes", raw)
+    metrics.incr("textstore.compressed_bytes", chunks.offset)
+    metrics.incr("textstore.duplicates", duplicates)
+    log(f"Stored {len(seen)} distinct sentences ({duplicates} duplicates) in {len(chunks.chunks)} chunks, "
+        f"{raw / 2 ** 20:.1f} MiB -> {chunks.offset / 2 ** 20:.1f} MiB.")
+
+
+class TextStore:
+    """Random access to the sentence texts of a store written by `build_text_store`, by s_uid."""
+
+    def __init__(self, folder=TEXT_STORE, cache_chunks=TEXT_STORE_CACHE_CHUNKS):
+        if not Path(folder, TEXTS).is_file():
+            log(f"No text store in {folder}, run `python make.py textstore` first.", LogLevel.ERROR)
+            raise FileNotFoundError(Path(folder, TEXTS))
+        with open(Path(folder, CHUNKS), encoding="utf-8", newline="") as f:
+            self.chunks = [(int(row["offset"]), int(row["length"])) for row in csv.DictReader(f, delimiter="\t")]
+        with open(Path(folder, SENTENCES), encoding="utf-8", newline="") as f:
+            self.locations = {int(row["s_uid"]): (int(row["chunk"]), int(row["position"]))
+                              for row in csv.DictReader(f, delimiter="\t")}
+        self.cache_chunks = cache_chunks
+        self._cache: "OrderedDict[int, List[str]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._file = open(Path(folder, TEXTS), "rb")
+
+    def _read_chunk(self, chunk: int) -> List[str]:
+        with self._lock:
+            if chunk in self._cache:
+                self._cache.move_to_end(chunk)
+                metrics.incr("textstore.cache_hits")
+                return self._cache[chunk]
+            offset, length = self.chunks[chunk]
+            self._file.seek(offset)
+            texts = json.loads(zlib.decompress(self._file.read(length)).decode("utf-8"))
+            metrics.incr("textstore.chunks_read")
+            self._cache[chunk] = texts
+            if len(self._cache) > self.cache_chunks:
+                self._cache.popitem(last=False)
+            return texts
+
+    def get(self, s_uid: int) -> Optional[str]:
+        return self.get_many([s_uid]).get(s_uid)
+
+    def get_many(self, s_uids: Iterable[int]) -> Dict[int, str]:
+        """Texts of the known `s_uids`, decompressing each chunk they live in once."""
+        by_chunk: Dict[int, List[Tuple[int, int]]] = {}
+        for s_uid in s_uids:
+            location = self.locations.get(s_uid)
+            if location is not None:
+                by_chunk.setdefault(location[0], []).append((s_uid, location[1]))
+        result = {}
+        for chunk in sorted(by_chunk):
+            texts = self._read_chunk(chunk)
+            for s_uid, position in by_chunk[chunk]:
+                result[s_uid] = texts[position]
+        return result
+
+    def __contains__(self, s_uid):
+        return s_uid in self.locations
+
+    def __len__(self):
+        return len(self.locations)
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
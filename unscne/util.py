@@ -1,22 +1,22 @@
 import csv
+import datetime
+import logging
 import os
 import re
+import sys
 from enum import Enum
 from functools import wraps
 from pathlib import Path
-from random import gauss
-from time import sleep
 from time import time
 from typing import Dict
 
-import requests
 import spacy
-from requests.adapters import HTTPAdapter
 from difflib import ndiff
-from requests.packages.urllib3.util.retry import Retry
 from tqdm import tqdm
 
 from config import REQUIRED_FILES, CORPUS_TAR, SPEECHES_FOLDER
+from unscne import client
+from unscne.metrics import metrics
 
 DEBUG = False
 
@@ -105,7 +105,8 @@ def timer(func):
     def _time_it(*args, **kwargs):
         start = int(round(time() * 1000))
         try:
-            return func(*args, **kwargs)
+            with metrics.span(func.__name__):
+                return func(*args, **kwargs)
         finally:
             end_ = int(round(time() * 1000)) - start
             log(f"Total execution time: {end_ if end_ > 0 else 0} ms")
@@ -113,27 +114,8 @@ def timer(func):
     return _time_it
 
 
-def wait(mu, sigma=3.0):
-    def decorator(func):
-        def wrapper(*args, **kwargs):
-            ret = func(*args, **kwargs)
-            time_to_sleep = abs(gauss(mu, sigma))
-            sleep(time_to_sleep)
-            return ret
-
-        return wrapper
-
-    return decorator
-
-
 def create_retrying_session():
-    http = requests.Session()
-    retry_strategy = Retry(total=100, backoff_factor=4, status_forcelist=[429, 500, 502, 503, 504],
-                           allowed_methods=["HEAD", "GET", "OPTIONS"])
-    adapter = HTTPAdapter(max_retries=retry_strategy)
-    http.mount("https://", adapter)
-    http.mount("http://", adapter)
-    return http
+    return client.create_session()
 
 
 class LogLevel(Enum):
@@ -142,21 +124,26 @@ class LogLevel(Enum):
     ERROR = 2
     PLAIN = 9
 
-import datetime
+
+logger = logging.getLogger("unscne")
+if not logger.handlers:
+    _handler = logging.StreamHandler(sys.stdout)
+    _handler.setFormatter(logging.Formatter("%(message)s"))
+    logger.addHandler(_handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+_LEVELS = {LogLevel.INFO: logging.INFO, LogLevel.WARNING: logging.WARNING, LogLevel.ERROR: logging.ERROR}
 
 
 def log(text: str, level=LogLevel.INFO) -> None:
     now = datetime.datetime.now()
-    if level == LogLevel.INFO:
-        print(f"[INFO] ({now:%Y-%m-%d %H:%M:%S}) {text}")
-    elif level == LogLevel.WARNING:
-        print(f"[WARNING] ({now:%Y-%m-%d %H:%M:%S}) {text}")
-    elif level == LogLevel.ERROR:
-        print(f"[ERROR] ({now:%Y-%m-%d %H:%M:%S}) {text}")
-    elif level == LogLevel.PLAIN:
-        print(text)
+    if level == LogLevel.PLAIN:
+        logger.info(text)
     else:
-        print(f"({now:%Y-%m-%d %H:%M:%S}) text")
+        if level != LogLevel.INFO:
+            metrics.incr(f"log.{level.name.lower()}")
+        logger.log(_LEVELS.get(level, logging.INFO), f"[{level.name}] ({now:%Y-%m-%d %H:%M:%S}) {text}")
 
 
 def dump_tsv(target, data, headers=None, delimiter="\t"):
@@ -193,6 +180,17 @@ def write_to_path(data, path):
         f.write(data)
 
 
+def batched(iterable, batch_size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
 def get_number_of_files_in_path(root):
     total = 0
     for path in os.scandir(root):
@@ -214,7 +212,11 @@ def levenshtein_distance(str1, str2, ):
     return distance
 
 
-nlp = spacy.load('en_core_web_sm')
+def make_annotation_pipeline():
+    from spacytextblob.spacytextblob import SpacyTextBlob  # noqa: F401, registers the factory
+    annotator = spacy.load('en_core_web_sm')
+    annotator.add_pipe('spacytextblob')
+    return annotator
 
 
 def make_sentence_splitter():
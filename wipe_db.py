@@ -1,4 +1,9 @@
+import sys
+
 from unscne.graph import connect_graph
 
 g = connect_graph()
-g.clear()
+if "-fast" in sys.argv:
+    g.reset()
+else:
+    g.clear()